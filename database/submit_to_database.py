@@ -20,6 +20,7 @@ import sys
 from shutil import copyfile as cp
 import math
 import glob
+import functools
 import textwrap as _textwrap
 
 #MWA software imports
@@ -84,14 +85,74 @@ def from_power_to_gain(powers,cfreq,n,coh=True):
     SI_to_Jy = 1e-26
     return (powers*coeff)*SI_to_Jy
 
+@functools.lru_cache(maxsize=None)
+def load_trcvr(trcvr=data_load.TRCVR_FILE):
+    """
+    Reads a receiver temperature csv file once per process into arrays sorted by frequency
+
+    Parameters:
+    -----------
+    trcvr: str
+        OPTIONAL - The location of the MWA receiver temp csv file. Default = <vcstools_data_dir>MWA_Trcvr_tile_56.csv
+
+    Returns:
+    --------
+    freqs: numpy.array
+        The frequencies of the table in MHz
+    trecs: numpy.array
+        The receiver temperatures at each frequency in K
+    """
+    tab = np.genfromtxt(trcvr, delimiter=",", names=True)
+    order = np.argsort(tab["freq"])
+    freqs = tab["freq"][order]
+    trecs = tab["trec"][order]
+    #these are shared by every caller so make sure they aren't modified
+    freqs.flags.writeable = False
+    trecs.flags.writeable = False
+    return freqs, trecs
+
+def trec(freqs, trcvr=data_load.TRCVR_FILE):
+    """
+    Linearly interpolates the receiver temperature at one or many frequencies
+
+    Parameters:
+    -----------
+    freqs: float or array_like
+        The frequencies in MHz, e.g. the frequency of every coarse or fine channel
+    trcvr: str
+        OPTIONAL - The location of the MWA receiver temp csv file. Default = <vcstools_data_dir>MWA_Trcvr_tile_56.csv
+
+    Returns:
+    --------
+    t_rec: float or numpy.array
+        The receiver temperatures in K. Frequencies outside of the table return 0
+    """
+    tab_freqs, tab_trecs = load_trcvr(trcvr)
+    return np.interp(freqs, tab_freqs, tab_trecs, left=0., right=0.)
+
 def get_Trec(tab,obsfreq):
-    Trec = 0.0
-    for r in range(len(tab)-1):
-        if tab[r][0]==obsfreq:
-            Trec = tab[r][1]
-        elif tab[r][0] < obsfreq < tab[r+1][0]:
-            Trec = ((tab[r][1] + tab[r+1][1])/2)
-    if Trec == 0.0:
+    """
+    Linearly interpolates the receiver temperature from a receiver temperature table.
+    See trec() to interpolate straight from the csv file
+
+    Parameters:
+    -----------
+    tab: astropy.table.Table
+        A table of the receiver temperatures with the frequency (MHz) in the first column
+        and the receiver temperature (K) in the second
+    obsfreq: float or array_like
+        The frequencies in MHz
+
+    Returns:
+    --------
+    Trec: float or numpy.array
+        The receiver temperatures in K. Frequencies outside of the table return 0
+    """
+    tab_freqs = np.asarray(tab[tab.colnames[0]], dtype=float)
+    tab_trecs = np.asarray(tab[tab.colnames[1]], dtype=float)
+    order = np.argsort(tab_freqs)
+    Trec = np.interp(obsfreq, tab_freqs[order], tab_trecs[order], left=0., right=0.)
+    if np.any(Trec == 0.0):
         logger.debug("ERROR getting Trec")
     return Trec
 
@@ -8,11 +8,11 @@ import prof_utils
 import os
 import numpy as np
 import json
+from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 
-def get_phase_ranges(archive: str):
-    p, _ = prof_utils.get_from_ascii(archive)
+def get_phase_ranges(p):
     try:
         pdict = prof_utils.auto_gfit(p)
         phase_ranges=[]
@@ -40,34 +40,50 @@ def check_input_kwargs(kwargs):
 
     return kwargs
 
+def select_pa(I, Q, U, phase_ranges):
+    """
+    Calculates the position angle of a profile and keeps the significant values within the phase ranges
+
+    Parameters:
+    -----------
+    I, Q, U: list
+        The Stokes profiles
+    phase_ranges: list
+        A list where every 2 entries is a phase range from 0 to 1. ie. [0.1 0.3 0.4 0.8]
+
+    Returns:
+    --------
+    X_PA: numpy.array
+        The rotational phase of each position angle in radians
+    PA: numpy.array
+        The position angles in radians
+    PA_e: numpy.array
+        The uncertainties in the position angles in radians
+    """
+    _, PA, PA_e = prof_utils.calc_pa(I, Q, U)
+    X_PA = np.arange(len(PA))/len(PA)
+    #keep the significant values (calc_pa() sets the rest to 0) that lie within the phase ranges
+    keep = PA != 0
+    in_range = np.zeros(len(PA), dtype=bool)
+    for lower, upper in zip(phase_ranges[0::2], phase_ranges[1::2]):
+        in_range |= (lower <= X_PA) & (X_PA <= upper)
+    keep &= in_range
+    X_PA, PA, PA_e = X_PA[keep], PA[keep], PA_e[keep]
+
+    #the RVM works in radians of rotational phase and PA
+    return 2*np.pi*X_PA, np.deg2rad(PA), np.deg2rad(PA_e)
+
 def process_args(kwargs):
     #get PA, error and X positions, removing phase values
-    prof_utils.subprocess_pdv(kwargs["archive"], outfile="RVM_fit_archive.txt", pdvops="-FTtlZ")
-    ar_read = np.genfromtxt("RVM_fit_archive.txt", skip_header=1)
+    I, Q, U, _, _ = prof_utils.get_stokes_from_archive(kwargs["archive"])
     if not kwargs["phase_ranges"]:
-        kwargs["phase_ranges"] = get_phase_ranges("RVM_fit_archive.txt")
+        kwargs["phase_ranges"] = get_phase_ranges(I)
     logger.info(f"Using ranges: {kwargs['phase_ranges']}")
-    PA_ = np.array([i[8] for i in ar_read])
-    PA_e = np.array([i[9] for i in ar_read])
-    X_PA = np.linspace(0, 1, len(PA_))
-    #remove values lying out of the phases
-    ranges = []
-    for i, j in zip(kwargs["phase_ranges"][0::2], kwargs["phase_ranges"][1::2]):
-        ranges.append((i, j))
-    for i, val in enumerate(X_PA):
-        if not any(lower <= val <= upper for (lower, upper) in ranges):
-            X_PA[i] = 0 #if the value isn't within range, set to 0
-    #a[b != 0] clips all values in a for indices where b == 0
-    # clip zero values from PA
-    PA = PA_[PA_ != 0]
-    PA_e = PA_e[PA_ != 0]
-    X_PA = X_PA[PA_ != 0]
-    #clip zero values from phase ranges
-    PA = PA[X_PA != 0]
-    PA_e = PA_e[X_PA != 0]
-    X_PA = X_PA[X_PA != 0]
-
+    X_PA, PA, PA_e = select_pa(I, Q, U, kwargs["phase_ranges"])
     fit_dict = {"PA":PA, "PA_e":PA_e, "X_PA":X_PA, "outfile":kwargs["outfile"]}
+    for key in ("n_alpha", "n_beta", "n_phi0", "n_polish", "n_procs", "plot"):
+        if key in kwargs:
+            fit_dict[key] = kwargs[key]
     return fit_dict
 
 def check_processed_kwargs(kwargs):
@@ -76,35 +92,235 @@ def check_processed_kwargs(kwargs):
     if  len(kwargs["X_PA"])==0 or len(kwargs["PA"])==0:
         raise AssertionError("No nonzero values in phase range")
 
+def analytic_pa(phi, alpha, beta, psi_0, phi_0):
+    """
+    The position angle of the Rotating Vector Model
+
+    Parameters:
+    -----------
+    phi: numpy.array
+        The rotational phase in radians
+    alpha: float
+        The angle between the rotation and magnetic axes in radians
+    beta: float
+        The impact parameter of the line of sight in radians
+    psi_0: float
+        The position angle at phi_0 in radians
+    phi_0: float
+        The phase of the steepest PA gradient in radians
+
+    Returns:
+    --------
+    pa: numpy.array
+        The position angle in radians
+    """
+    numerator = np.sin(alpha) * np.sin(phi - phi_0)
+    denominator = np.sin(beta + alpha) * np.cos(alpha) - np.cos(beta + alpha) * np.sin(alpha) * np.cos(phi - phi_0)
+    return np.arctan2(numerator,denominator) + psi_0
+
+def wrap_pa(pa):
+    """
+    Wraps position angles (or their differences) in radians to [-pi/2, pi/2), as the PA is only defined modulo pi
+    """
+    return (np.asarray(pa) + np.pi/2) % np.pi - np.pi/2
+
+def rvm_chi2_grid(X_PA, PA, PA_e, alphas, betas, phi0s):
+    """
+    Evaluates the RVM chi-squared over a grid of (alpha, beta), profiling out psi_0 and phi_0.
+    For each (alpha, beta, phi_0) the best psi_0 is found analytically from the doubled-angle residuals,
+    where chi-squared ~ sum(sin^2(PA - model - psi_0)/PA_e^2) = (sum(w) - |sum(w*exp(2i*(PA - model)))|)/2.
+    phi_0 is then minimised over the phi0s grid.
+
+    Parameters:
+    -----------
+    X_PA: numpy.array
+        The rotational phases in radians
+    PA: numpy.array
+        The position angles in radians
+    PA_e: numpy.array
+        The uncertainties in PA in radians
+    alphas: numpy.array
+        The alpha grid in radians
+    betas: numpy.array
+        The beta grid in radians
+    phi0s: numpy.array
+        The phi_0 grid in radians
+
+    Returns:
+    --------
+    chi2: numpy.array
+        The profiled chi-squared with shape (len(alphas), len(betas))
+    psi0: numpy.array
+        The best psi_0 of each cell in radians
+    phi0: numpy.array
+        The best phi_0 of each cell in radians
+    """
+    w = 1./np.asarray(PA_e)**2
+    data = np.exp(2j*np.asarray(PA))*w
+    dphi = np.asarray(X_PA)[None, :] - np.asarray(phi0s)[:, None]
+    sin_dphi, cos_dphi = np.sin(dphi), np.cos(dphi)
+    chi2 = np.zeros((len(alphas), len(betas)))
+    psi0 = np.zeros(chi2.shape)
+    phi0 = np.zeros(chi2.shape)
+    zeta = np.asarray(betas)[:, None, None]
+    for i, alpha in enumerate(alphas):
+        #model angle exp(i*m) = (den + i*num)/|den + i*num|, shape (beta, phi_0, data)
+        num = np.sin(alpha) * sin_dphi[None]
+        den = np.sin(zeta + alpha) * np.cos(alpha) - np.cos(zeta + alpha) * np.sin(alpha) * cos_dphi[None]
+        rot = den + 1j*num
+        r2 = np.abs(rot)**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            model2 = np.where(r2 > 0, np.conj(rot)**2/r2, 1.)
+        Z = np.sum(data*model2, axis=-1)
+        cell_chi2 = 0.5*(np.sum(w) - np.abs(Z))
+        best = np.argmin(cell_chi2, axis=1)
+        rows = np.arange(len(betas))
+        chi2[i] = cell_chi2[rows, best]
+        psi0[i] = wrap_pa(0.5*np.angle(Z[rows, best]))
+        phi0[i] = np.asarray(phi0s)[best]
+    return chi2, psi0, phi0
+
+def _grid_minima(chi2, n):
+    """
+    Returns the indices of the n lowest local minima of a 2D surface, padded with the lowest other cells if there are fewer
+    """
+    padded = np.pad(chi2, 1, mode="edge")
+    is_min = np.ones(chi2.shape, dtype=bool)
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di or dj:
+                is_min &= chi2 <= padded[1+di:1+di+chi2.shape[0], 1+dj:1+dj+chi2.shape[1]]
+    order = np.argsort(chi2, axis=None)
+    minima = [idx for idx in order if is_min.flat[idx]][:n]
+    minima += [idx for idx in order if idx not in minima][:n-len(minima)]
+    return [np.unravel_index(idx, chi2.shape) for idx in minima]
+
+def _polish(task):
+    """
+    Polishes an RVM fit from a grid cell with curve_fit. task is (X_PA, PA, PA_e, p0, bounds).
+    Returns (chi2, popt, pcov), with a chi2 of inf if the fit failed
+    """
+    X_PA, PA, PA_e, p0, bounds = task
+    def wrapped_pa(phi, *params):
+        #the residual PA - model is wrapped to +/- 90 degrees
+        return PA - wrap_pa(PA - analytic_pa(phi, *params))
+    try:
+        popt, pcov = curve_fit(wrapped_pa, X_PA, PA, p0=p0, bounds=bounds, sigma=PA_e)
+    except (RuntimeError, ValueError) as e:
+        logger.debug(f"RVM fit from {p0} failed: {e}")
+        return np.inf, np.array(p0), np.full((4, 4), np.inf)
+    chi2 = np.sum((wrap_pa(PA - analytic_pa(X_PA, *popt))/PA_e)**2)
+    return chi2, popt, pcov
+
+def rvm_grid_fit(X_PA, PA, PA_e, n_alpha=91, n_beta=91, n_phi0=72, n_polish=5, n_procs=1):
+    """
+    Fits the Rotating Vector Model globally. The chi-squared is evaluated over a dense (alpha, beta) grid with psi_0 and
+    phi_0 profiled out (rvm_chi2_grid()), then the n_polish best local minima of the grid are polished with curve_fit
+
+    Parameters:
+    -----------
+    X_PA: numpy.array
+        The rotational phases in radians
+    PA: numpy.array
+        The position angles in radians
+    PA_e: numpy.array
+        The uncertainties in PA in radians
+    n_alpha: int
+        OPTIONAL - The number of alpha values in the grid, from 0 to 180 degrees. Default: 91
+    n_beta: int
+        OPTIONAL - The number of beta values in the grid, from -90 to 90 degrees. Default: 91
+    n_phi0: int
+        OPTIONAL - The number of phi_0 values that are profiled over, from -180 to 180 degrees. Default: 72
+    n_polish: int
+        OPTIONAL - The number of grid minima to polish. Default: 5
+    n_procs: int
+        OPTIONAL - The number of processes used to polish the minima. Default: 1
+
+    Returns:
+    --------
+    rvm_dict: dictionary
+        contains keys:
+        popt: numpy.array
+            The best (alpha, beta, psi_0, phi_0) in radians
+        pcov: numpy.array
+            The covariance matrix of popt
+        chi2: float
+            The chi-squared of the best fit
+        redchisq: float
+            The reduced chi-squared of the best fit
+        alphas, betas: numpy.array
+            The grid in radians
+        chi2_grid: numpy.array
+            The profiled chi-squared surface with shape (n_alpha, n_beta)
+        psi0_grid, phi0_grid: numpy.array
+            The profiled psi_0 and phi_0 of each cell in radians
+    """
+    X_PA, PA, PA_e = np.asarray(X_PA, dtype=float), np.asarray(PA, dtype=float), np.asarray(PA_e, dtype=float)
+    alphas = np.linspace(0, np.pi, n_alpha)
+    betas = np.linspace(-np.pi/2, np.pi/2, n_beta)
+    phi0s = np.linspace(-np.pi, np.pi, n_phi0, endpoint=False)
+    chi2_grid, psi0_grid, phi0_grid = rvm_chi2_grid(X_PA, PA, PA_e, alphas, betas, phi0s)
+
+    bounds = [(0, -np.pi/2, -np.pi/2, -np.pi), (np.pi, np.pi/2, np.pi/2, np.pi)]
+    tasks = []
+    for i, j in _grid_minima(chi2_grid, n_polish):
+        p0 = np.clip([alphas[i], betas[j], psi0_grid[i, j], phi0_grid[i, j]], np.array(bounds[0])+1e-6, np.array(bounds[1])-1e-6)
+        tasks.append((X_PA, PA, PA_e, p0, bounds))
+    if n_procs > 1 and len(tasks) > 1:
+        with Pool(min(n_procs, len(tasks))) as pool:
+            results = pool.map(_polish, tasks)
+    else:
+        results = [_polish(task) for task in tasks]
+    chi2, popt, pcov = min(results, key=lambda result: result[0])
+    if not np.isfinite(chi2):
+        raise RuntimeError("None of the RVM fits from the grid minima converged")
+
+    dof = max(len(PA) - 4, 1)
+    return {"popt":popt, "pcov":pcov, "chi2":chi2, "redchisq":chi2/dof, "alphas":alphas, "betas":betas,
+            "chi2_grid":chi2_grid, "psi0_grid":psi0_grid, "phi0_grid":phi0_grid}
+
+def plot_chi2_grid(rvm_dict, plotname):
+    """
+    Plots the profiled chi-squared surface of rvm_grid_fit() with the best fit marked
+
+    Parameters:
+    -----------
+    rvm_dict: dictionary
+        The output of rvm_grid_fit()
+    plotname: str
+        The pathname of the plot
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    alphas, betas = np.rad2deg(rvm_dict["alphas"]), np.rad2deg(rvm_dict["betas"])
+    plt.figure(figsize=(10, 8))
+    plt.pcolormesh(alphas, betas, np.log10(rvm_dict["chi2_grid"] - np.min(rvm_dict["chi2_grid"]) + 1).T, shading="auto")
+    plt.colorbar(label=r"log$_{10}$($\Delta\chi^2$ + 1)")
+    plt.plot(*np.rad2deg(rvm_dict["popt"][:2]), "rx", markersize=10)
+    plt.xlabel(r"$\alpha$ (deg)", fontsize=12)
+    plt.ylabel(r"$\beta$ (deg)", fontsize=12)
+    plt.savefig(plotname, bbox_inches="tight")
+    plt.close()
+
 def _fit(kwargs):
     PA = kwargs["PA"]
     PA_e = kwargs["PA_e"]
     X_PA = kwargs["X_PA"]
     outfile = kwargs["outfile"]
-    def analytic_pa(phi, alpha, beta, psi_0, phi_0):
-        #Inputs should be in radians
-        numerator = np.sin(alpha) * np.sin(phi - phi_0)
-        denominator = np.sin(beta + alpha) * np.cos(alpha) - np.cos(beta + alpha) * np.sin(alpha) * np.cos(phi - phi_0)
-        return np.arctan2(numerator,denominator) + psi_0
-
-    min_rad_45 = np.deg2rad(-45) #alpha/beta
-    max_rad_45 = np.deg2rad(45)
-    min_rad_90 = np.deg2rad(-90) #psi_0
-    max_rad_90 = np.deg2rad(90)
-    min_rad_180 = np.deg2rad(-180) #phi_0
-    max_rad_180 = np.deg2rad(180)
-
-    initial = (0,0,0,0)
-    lower_bounds = (min_rad_45, min_rad_45, min_rad_90, min_rad_180)
-    upper_bounds = (max_rad_45, max_rad_45, max_rad_90, max_rad_180)
-    bounds = [lower_bounds, upper_bounds]
-    popt, pcov = curve_fit(analytic_pa, X_PA, PA, p0=initial, bounds=bounds, sigma=PA_e)
+    grid_kwargs = {key:kwargs[key] for key in ("n_alpha", "n_beta", "n_phi0", "n_polish", "n_procs") if kwargs.get(key) is not None}
+    rvm_dict = rvm_grid_fit(X_PA, PA, PA_e, **grid_kwargs)
+    popt, pcov = rvm_dict["popt"], rvm_dict["pcov"]
     logger.info(f"Alpha:    {np.rad2deg(popt[0])}")
     logger.info(f"Beta:     {np.rad2deg(popt[1])}")
     logger.info(f"Psi_0:    {np.rad2deg(popt[2])}")
     logger.info(f"Phi_0:    {np.rad2deg(popt[3])}")
+    logger.info(f"Reduced chi-squared: {rvm_dict['redchisq']}")
+    if kwargs.get("plot"):
+        plot_chi2_grid(rvm_dict, kwargs["plot"])
     if outfile:
-        outdict = {"alpha":popt[0], "beta":popt[1], "psi_0":popt[2], "phi_0":popt[3], "covariance_matrix":np.array(pcov).reshape(4,4).tolist()}
+        outdict = {"alpha":popt[0], "beta":popt[1], "psi_0":popt[2], "phi_0":popt[3], "covariance_matrix":np.array(pcov).reshape(4,4).tolist(),
+                   "redchisq":rvm_dict["redchisq"]}
         with open(outfile, "w") as f:
             json.dump(outdict, f)
     return popt, pcov
@@ -129,6 +345,12 @@ if __name__ == '__main__':
     parser.add_argument("--outfile", type=str, help="The pathname of the file to write the ouput to. If None, will not write. Note: file outputs are in radians")
     parser.add_argument("--phase_ranges", type=float, nargs="+", help="The phase range(s) to fit the RM to. If unsupplied, will find the on-pulse and fit that range.\
                          Supports multiple ranges. eg. 0.1 0.15 0.55 0.62 will fit values from 0.1 to 0.15 and from 0.55 to 0.62.")
+    parser.add_argument("--n_alpha", type=int, default=91, help="The number of alpha values in the chi-squared grid (0 to 180 degrees)")
+    parser.add_argument("--n_beta", type=int, default=91, help="The number of beta values in the chi-squared grid (-90 to 90 degrees)")
+    parser.add_argument("--n_phi0", type=int, default=72, help="The number of phi_0 values to profile over for each grid cell")
+    parser.add_argument("--n_polish", type=int, default=5, help="The number of grid minima to polish with a least squares fit")
+    parser.add_argument("--n_procs", type=int, default=1, help="The number of processes used to polish the grid minima")
+    parser.add_argument("--plot", type=str, help="The pathname of a plot of the chi-squared surface. If None, will not plot")
     parser.add_argument("-L", "--loglvl", type=str, default="INFO", help="Logger verbostity level")
 
     args = parser.parse_args()
@@ -647,7 +647,7 @@ def write_output_source_files(output_data,
                 output_file.write('{} {:4d} {:1.3f} {:1.3f} {:1.3f}  {:.3}   {:6.2f} {:6.2f}'.\
                            format(obsid, duration, enter, leave, max_power, oap, freq, band))
                 if SN_est:
-                    pulsar_sn, pulsar_sn_err = sfe.est_pulsar_sn(source, obsid, plot_flux=plot_est)
+                    pulsar_sn, pulsar_sn_err = sfe.est_pulsar_sn(source, obsid, plot_flux=plot_est, save_cache=False)
                     if pulsar_sn is None:
                         output_file.write('   None    None')
                     else:
@@ -661,6 +661,8 @@ def write_output_source_files(output_data,
                     output_file.write("   {0}\n".format(cal_check_result))
                 else:
                     output_file.write("\n")
+    if SN_est:
+        sfe.save_spectral_model_cache()
     return
 
 
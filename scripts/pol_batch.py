@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+"""
+Measures the rotation measure and fits the rotating vector model of many PSRFITS archives on a pool of processes
+and writes the results to a single csv table that can be resumed if interrupted
+"""
+import os
+import sys
+import argparse
+import logging
+
+import numpy as np
+
+import prof_batch
+import rm_synthesis
+import RVM_fit
+
+logger = logging.getLogger(__name__)
+
+POL_BATCH_COLUMNS = ["file", "status", "error", "period", "dm", "nbin", "nchan", "phase_ranges", "num_gauss", "W10", "W50", "sn",\
+                     "rm", "rm_e", "range_rm", "range_rm_e", "n_pa", "alpha", "alpha_e", "beta", "beta_e", "psi_0", "psi_0_e",\
+                     "phi_0", "phi_0_e", "rvm_redchisq"]
+
+#---------------------------------------------------------------
+def derotate_stokes(freqs, Q, U, rm, weights=None):
+    """
+    Removes the Faraday rotation of each channel and averages the channels, giving the linear polarisation
+    at infinite frequency
+
+    Parameters:
+    -----------
+    freqs: numpy.array
+        The centre frequency of each channel in MHz
+    Q, U: numpy.array
+        The channelised Stokes profiles with shape (nchan, nbin)
+    rm: float
+        The rotation measure in rad/m^2
+    weights: numpy.array
+        OPTIONAL - The weight of each channel. Default: None (equal weights)
+
+    Returns:
+    --------
+    Q, U: numpy.array
+        The derotated, frequency averaged Stokes profiles
+    """
+    l2 = (2.998e8/(np.asarray(freqs, dtype=float)*1e6))**2
+    P = (np.asarray(Q) + 1j*np.asarray(U)) * np.exp(-2j*rm*l2)[:, None]
+    P = np.average(P, axis=0, weights=weights)
+    return np.real(P), np.imag(P)
+
+def analyse_archive(path, phase_ranges=None, force_single=False, max_N=6, cliptype="regular", use_cache=True, phi_range=(-300, 300),\
+                    phi_steps=10000, coarse_to_fine=False, phi_res=None, rmsf_cache=False, rvm=True, n_alpha=91, n_beta=91, n_phi0=72,\
+                    n_polish=5):
+    """
+    Reads the channelised Stokes profiles of an archive once with rm_synthesis._prepare_archive(), which finds the on-pulse phase ranges
+    with a single gaussian fit, and uses them for both
+    the RM synthesis of each range and an RVM fit of the position angles after the channels have been derotated by the RM
+
+    Parameters:
+    -----------
+    path: str
+        The path of the archive
+    phase_ranges: list
+        OPTIONAL - The phase ranges to use, where every 2 entries is a range from 0 to 1. If None, will fit the on-pulse with auto_gfit(). Default: None
+    force_single: boolean
+        OPTIONAL - If True, only use the fitted phase range with the greatest linear polarisation ratio. Default: False
+    max_N: int
+        OPTIONAL - The maximum number of gaussian components to fit. See auto_gfit(). Default: 6
+    cliptype: str
+        OPTIONAL - The range of alphas to try. See auto_gfit(). Default: 'regular'
+    use_cache: boolean
+        OPTIONAL - Whether to use the cache of previous fits. See auto_gfit(). Default: True
+    phi_range: tuple
+        OPTIONAL - The range of Faraday depths to search. See IQU_rm_synth(). Default: (-300, 300)
+    phi_steps: int
+        OPTIONAL - The number of Faraday depths to search. See IQU_rm_synth(). Default: 10000
+    coarse_to_fine: boolean
+        OPTIONAL - Search the Faraday depths coarse to fine. See IQU_rm_synth(). Default: False
+    phi_res: float
+        OPTIONAL - The Faraday depth step of the refined search with coarse_to_fine. See IQU_rm_synth(). Default: None
+    rmsf_cache: boolean
+        OPTIONAL - Keep the RMSF in the on-disk cache so the other archives with the same channels reuse it. Default: False
+    rvm: boolean
+        OPTIONAL - Whether to fit the RVM. Default: True
+    n_alpha, n_beta, n_phi0, n_polish: int
+        OPTIONAL - The size of the RVM chi-squared grid and the number of minima to polish. See RVM_fit.rvm_grid_fit(). Default: 91, 91, 72, 5
+
+    Returns:
+    --------
+    row: dictionary
+        The results, with the keys of POL_BATCH_COLUMNS. Angles are in degrees
+    """
+    row = dict.fromkeys(POL_BATCH_COLUMNS)
+    row["file"] = path
+    #the on-pulse analysis shared by the RM and RVM
+    prep_kwargs = {"work_dir":"", "archive":path, "label":os.path.basename(path), "phase_ranges":phase_ranges, "force_single":force_single,\
+                   "cliptype":cliptype, "max_N":max_N, "use_cache":use_cache}
+    prep_kwargs, ar_dict, fit_dict, I, Q, U, spectra = rm_synthesis._prepare_archive(prep_kwargs)
+    row.update({"period":ar_dict["period"], "dm":ar_dict["dm"], "nbin":ar_dict["nbin"], "nchan":len(ar_dict["freqs"])})
+    if fit_dict is not None:
+        row.update({key:fit_dict[key] for key in ("W10", "W50", "sn")})
+        row["num_gauss"] = int(fit_dict["num_gauss"])
+    phase_ranges = prep_kwargs["phase_ranges"]
+    row["phase_ranges"] = phase_ranges
+
+    rms, rms_e = [], []
+    for freq_hz, I_f, I_fe, Q_f, Q_fe, U_f, U_fe, _, _ in spectra:
+        rm, rm_e = rm_synthesis.IQU_rm_synth(freq_hz, I_f, Q_f, U_f, I_fe, Q_fe, U_fe, phi_range=phi_range, phi_steps=phi_steps,\
+                                             coarse_to_fine=coarse_to_fine, phi_res=phi_res, rmsf_disk_cache=rmsf_cache, verbose=False)
+        rms.append(rm)
+        rms_e.append(rm_e)
+    rms, rms_e = np.array(rms), np.array(rms_e)
+    row.update({"range_rm":rms, "range_rm_e":rms_e})
+    #the inverse variance weighted mean of the phase ranges
+    row["rm"] = np.sum(rms/rms_e**2)/np.sum(1/rms_e**2)
+    row["rm_e"] = np.sqrt(1/np.sum(1/rms_e**2))
+
+    row["status"] = "ok"
+    if not rvm:
+        return row
+    Q, U = derotate_stokes(ar_dict["freqs"], ar_dict["Q"], ar_dict["U"], row["rm"], weights=rm_synthesis.archive_weights(ar_dict))
+    X_PA, PA, PA_e = RVM_fit.select_pa(I, Q, U, phase_ranges)
+    row["n_pa"] = len(PA)
+    if len(PA) <= 4:
+        #keep the RM, there just isn't enough polarised signal to constrain the geometry
+        row["error"] = "Too few significant position angles to fit the RVM"
+        return row
+    rvm_dict = RVM_fit.rvm_grid_fit(X_PA, PA, PA_e, n_alpha=n_alpha, n_beta=n_beta, n_phi0=n_phi0, n_polish=n_polish)
+    popt = np.rad2deg(rvm_dict["popt"])
+    perr = np.rad2deg(np.sqrt(np.abs(np.diag(rvm_dict["pcov"]))))
+    for i, key in enumerate(("alpha", "beta", "psi_0", "phi_0")):
+        row[key] = popt[i]
+        row[key + "_e"] = perr[i]
+    row["rvm_redchisq"] = rvm_dict["redchisq"]
+    return row
+
+#---------------------------------------------------------------
+def pol_batch(archives, outfile, n_procs=1, timeout=None, retry_failed=True, **kwargs):
+    """
+    Analyses the polarisation of many archives on a pool of processes and streams the results to a csv table with the columns POL_BATCH_COLUMNS.
+    An archive that fails or takes longer than timeout seconds gets a row with its error instead of stopping the batch.
+    See prof_batch.run_batch()
+
+    Parameters:
+    -----------
+    archives: list
+        The paths of the archives
+    outfile: str
+        The csv file to write the results to
+    n_procs: int
+        OPTIONAL - The number of processes to use. Default: 1
+    timeout: float
+        OPTIONAL - The maximum time in seconds to spend on each archive. If None, there is no limit. Default: None
+    retry_failed: boolean
+        OPTIONAL - Whether to reanalyse archives that failed or timed out in a previous run. Default: True
+    **kwargs:
+        The keyword arguments for analyse_archive()
+
+    Returns:
+    --------
+    counts: dictionary
+        The number of archives analysed in this run with each status ('ok', 'failed' or 'timeout')
+    """
+    return prof_batch.run_batch(analyse_archive, archives, outfile, POL_BATCH_COLUMNS, n_procs=n_procs, timeout=timeout,\
+                                retry_failed=retry_failed, name="Polarimetry batch", **kwargs)
+
+#---------------------------------------------------------------
+if __name__ == '__main__':
+
+    loglevels = dict(DEBUG=logging.DEBUG,\
+                    INFO=logging.INFO,\
+                    WARNING=logging.WARNING,\
+                    ERROR=logging.ERROR)
+
+    parser = argparse.ArgumentParser(description="""Measures the rotation measure and fits the rotating vector model of many archives in parallel
+                                     and writes the results to a single csv table. If the table already exists, the archives in it are skipped""",\
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    inputs = parser.add_argument_group("Inputs")
+    inputs.add_argument("archives", type=str, nargs="*", help="The archives and/or directories containing them")
+    inputs.add_argument("--file_list", type=str, help="A text file containing one archive or directory per line")
+    inputs.add_argument("--pattern", type=str, default="*.ar", help="The glob pattern used to find archives in directories")
+    inputs.add_argument("--phase_ranges", type=float, nargs="+", help="The phase range(s) to use for every archive. If unsupplied, will fit the\
+                        on-pulse of each archive. eg. 0.1 0.15 0.55 0.62 will use values from 0.1 to 0.15 and from 0.55 to 0.62")
+    inputs.add_argument("--force_single", action="store_true", help="Only use the fitted phase range with the greatest linear polarisation ratio")
+    inputs.add_argument("--max_N", type=int, default=6, help="The maximum number of gaussian components to attempt to fit")
+    inputs.add_argument("--cliptype", type=str, default="regular", choices=["regular", "noisy", "verbose"], help="The range of alphas to try")
+    inputs.add_argument("--no_cache", action="store_true", help="Use this tag to always fit the profiles instead of using the cache of previous fits")
+
+    rm_inputs = parser.add_argument_group("RM Synthesis Inputs")
+    rm_inputs.add_argument("--phi_range", type=float, default=(-300, 300), nargs=2, help="The range of RMs to synthesise")
+    rm_inputs.add_argument("--phi_steps", type=int, default=10000, help="The number of RM steps to synthesise")
+    rm_inputs.add_argument("--coarse_to_fine", action="store_true", help="Search the whole phi_range coarsely and only synthesise a window around the peak finely")
+    rm_inputs.add_argument("--phi_res", type=float, default=None, help="The RM step of the refined window with --coarse_to_fine")
+    rm_inputs.add_argument("--rmsf_cache", action="store_true", help="Keep the RMSF in the on-disk cache so archives with the same channels reuse it")
+
+    rvm_inputs = parser.add_argument_group("RVM Inputs")
+    rvm_inputs.add_argument("--no_rvm", action="store_true", help="Only measure the rotation measures")
+    rvm_inputs.add_argument("--n_alpha", type=int, default=91, help="The number of alpha values in the chi-squared grid (0 to 180 degrees)")
+    rvm_inputs.add_argument("--n_beta", type=int, default=91, help="The number of beta values in the chi-squared grid (-90 to 90 degrees)")
+    rvm_inputs.add_argument("--n_phi0", type=int, default=72, help="The number of phi_0 values to profile over for each grid cell")
+    rvm_inputs.add_argument("--n_polish", type=int, default=5, help="The number of grid minima to polish with a least squares fit")
+
+    batch_inputs = parser.add_argument_group("Batch Inputs")
+    batch_inputs.add_argument("--outfile", type=str, default="pol_batch.csv", help="The csv file to write the results to")
+    batch_inputs.add_argument("--n_procs", type=int, default=1, help="The number of processes to use")
+    batch_inputs.add_argument("--timeout", type=float, default=None, help="The maximum time in seconds to spend on a single archive")
+    batch_inputs.add_argument("--no_retry", action="store_true", help="Don't reanalyse archives that failed or timed out in a previous run")
+    batch_inputs.add_argument("-L", "--loglvl", type=str, default="INFO", help="Logger verbostity level")
+    args = parser.parse_args()
+
+    ch = logging.StreamHandler()
+    ch.setLevel(loglevels[args.loglvl])
+    formatter = logging.Formatter('%(asctime)s  %(filename)s  %(name)s  %(lineno)-4d  %(levelname)-9s :: %(message)s')
+    ch.setFormatter(formatter)
+    for log in (logger, prof_batch.logger):
+        log.setLevel(loglevels[args.loglvl])
+        log.addHandler(ch)
+
+    paths = list(args.archives)
+    if args.file_list:
+        with open(args.file_list) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    archives = prof_batch.find_profiles(paths, pattern=args.pattern)
+    if not archives:
+        logger.error("No archives found")
+        sys.exit(1)
+
+    pol_batch(archives, args.outfile, n_procs=args.n_procs, timeout=args.timeout, retry_failed=not args.no_retry,\
+              phase_ranges=args.phase_ranges, force_single=args.force_single, max_N=args.max_N, cliptype=args.cliptype,\
+              use_cache=not args.no_cache, phi_range=tuple(args.phi_range), phi_steps=args.phi_steps, coarse_to_fine=args.coarse_to_fine,\
+              phi_res=args.phi_res, rmsf_cache=args.rmsf_cache, rvm=not args.no_rvm, n_alpha=args.n_alpha, n_beta=args.n_beta,\
+              n_phi0=args.n_phi0, n_polish=args.n_polish)
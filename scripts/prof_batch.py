@@ -0,0 +1,457 @@
+#! /usr/bin/env python3
+"""
+Analyses many pulse profiles (bestprof, pdv ascii or PSRFITS archives) on a pool of processes
+and writes the results to a single csv table that can be resumed if interrupted
+"""
+import os
+import sys
+import csv
+import glob
+import signal
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import prof_utils
+
+logger = logging.getLogger(__name__)
+
+PROF_BATCH_COLUMNS = ["file", "status", "error", "pulsar", "obsid", "period", "nbins", "method", "alpha", "num_gauss",\
+                      "W10", "W10_e", "W50", "W50_e", "Weq", "Weq_e", "boxcar_width", "Wscat", "Wscat_e", "sn", "sn_e",\
+                      "scattered", "redchisq", "bic", "maxima", "maxima_e", "gaussian_params"]
+ARCHIVE_EXTENSIONS = (".ar", ".fits", ".sf", ".rf", ".calib", ".pfits", ".psrfits")
+
+class TaskTimeoutError(Exception):
+    """Raise when a file takes longer than the allowed time to analyse"""
+    pass
+
+#---------------------------------------------------------------
+def profile_format(path):
+    """
+    Works out the format of a profile file from its name
+
+    Parameters:
+    -----------
+    path: str
+        The path of the profile file
+
+    Returns:
+    --------
+    fmt: str
+        'bestprof', 'archive' or 'ascii'
+    """
+    if path.endswith(".bestprof"):
+        return "bestprof"
+    if path.lower().endswith(ARCHIVE_EXTENSIONS):
+        return "archive"
+    return "ascii"
+
+#---------------------------------------------------------------
+def find_profiles(paths, pattern="*"):
+    """
+    Expands a list of files and directories into a sorted list of profile files
+
+    Parameters:
+    -----------
+    paths: list
+        Profile files and/or directories containing profile files
+    pattern: str
+        OPTIONAL - The glob pattern used to find profile files in directories. Default: '*'
+
+    Returns:
+    --------
+    profiles: list
+        The absolute paths of the profile files
+    """
+    profiles = set()
+    for path in paths:
+        if os.path.isdir(path):
+            profiles.update(f for f in glob.glob(os.path.join(path, pattern)) if os.path.isfile(f))
+        elif os.path.isfile(path):
+            profiles.add(path)
+        else:
+            logger.warning("{} does not exist. Skipping".format(path))
+    return sorted(os.path.abspath(f) for f in profiles)
+
+#---------------------------------------------------------------
+def read_profile(path, period=None):
+    """
+    Reads a pulse profile from a bestprof, pdv ascii or archive file
+
+    Parameters:
+    -----------
+    path: str
+        The path of the profile file
+    period: float
+        OPTIONAL - The pulsar's period in ms. Overwritten by the period in a bestprof file and used instead of the folding period of an archive. Default: None
+
+    Returns:
+    --------
+    prof_info: dictionary
+        contains keys:
+        profile: list
+            The pulse profile
+        period: float
+            The pulsar's period in ms. None if unknown
+        pulsar: str
+            The pulsar's name. None if unknown
+        obsid: int
+            The observation ID. None if unknown
+        format: str
+            The format of the file. See profile_format()
+    """
+    fmt = profile_format(path)
+    pulsar = obsid = None
+    if fmt == "bestprof":
+        obsid, pulsar, _, period, _, _, _, profile, _ = prof_utils.get_from_bestprof(path)
+        period = float(period)
+    elif fmt == "archive":
+        ar_dict = prof_utils.read_archive(path, pscrunch=True)
+        profile = ar_dict["I"]
+        if period is None:
+            period = ar_dict["period"]
+    else:
+        profile = prof_utils.get_from_ascii(path)[0]
+    return {"profile":profile, "period":period, "pulsar":pulsar, "obsid":obsid, "format":fmt}
+
+#---------------------------------------------------------------
+def _timeout_handler(signum, frame):
+    raise TaskTimeoutError("Analysis timed out")
+
+def _format_value(value):
+    """
+    Formats a result for the csv table. Sequences are written as space separated values and None as an empty string
+    """
+    if value is None:
+        return ""
+    if hasattr(value, "__len__") and not isinstance(value, str):
+        return " ".join(str(v) for v in value)
+    return value
+
+def analyse_profile(path, method="gfit", period=None, max_N=6, min_comp_len=None, ignore_threshold=None, cliptype="regular", use_cache=True,\
+                    coarse_nbins=None):
+    """
+    Reads and analyses a single profile
+
+    Parameters:
+    -----------
+    path: str
+        The path of the profile file
+    method: str
+        OPTIONAL - 'gfit' to fit gaussians with auto_gfit(), 'analyse' to use auto_analyse_pulse_prof() or 'boxcar' for the
+        matched filter S/N from matched_filter_sn(). Default: 'gfit'
+    period: float
+        OPTIONAL - The pulsar's period in ms if it can't be read from the file. Default: None
+    max_N: int
+        OPTIONAL - The maximum number of gaussian components to fit. Default: 6
+    min_comp_len: int
+        OPTIONAL - The minimum length of a component in bins. See auto_gfit(). Default: None
+    ignore_threshold: float
+        OPTIONAL - Maxima with values below this fraction of the profile maximum will be ignored. See auto_gfit(). Default: None
+    cliptype: str
+        OPTIONAL - The range of alphas to try. See auto_gfit(). Default: 'regular'
+    use_cache: boolean
+        OPTIONAL - Whether to use the cache of previous fits. See auto_gfit(). Default: True
+    coarse_nbins: int
+        OPTIONAL - The number of bins to downsample high resolution profiles to while searching for the best fit. See auto_gfit(). Default: None
+
+    Returns:
+    --------
+    row: dictionary
+        The results, with the keys of PROF_BATCH_COLUMNS
+    """
+    row = dict.fromkeys(PROF_BATCH_COLUMNS)
+    row.update({"file":path, "method":method})
+    prof_info = read_profile(path, period=period)
+    row.update({key:prof_info[key] for key in ("pulsar", "obsid", "period")})
+    row["nbins"] = len(prof_info["profile"])
+
+    if method == "gfit":
+        fit_dict = prof_utils.auto_gfit(prof_info["profile"], max_N=max_N, min_comp_len=min_comp_len,\
+                                        ignore_threshold=ignore_threshold, period=prof_info["period"], cliptype=cliptype,\
+                                        use_cache=use_cache, coarse_nbins=coarse_nbins)
+        for key in ("alpha", "W10", "W10_e", "W50", "W50_e", "Weq", "Weq_e", "Wscat", "Wscat_e", "sn", "sn_e", "scattered",\
+                    "redchisq", "bic", "maxima", "maxima_e", "gaussian_params"):
+            row[key] = fit_dict[key]
+        row["num_gauss"] = int(fit_dict["num_gauss"])
+    elif method == "analyse":
+        if prof_info["period"] is None:
+            raise ValueError("A period is required for the 'analyse' method")
+        prof_dict = prof_utils.auto_analyse_pulse_prof(prof_info["profile"], prof_info["period"])
+        if not prof_dict:
+            raise prof_utils.NoFitError("The profile could not be analysed")
+        row.update({"Weq":prof_dict["w_equiv_bins"], "Weq_e":prof_dict["w_equiv_bins_e"], "sn":prof_dict["sn"],\
+                    "sn_e":prof_dict["sn_e"], "scattered":prof_dict["scattered"]})
+    elif method == "boxcar":
+        #a quick matched filter S/N to triage profiles before fitting them. The width of the best boxcar is in bins
+        #and isn't an equivalent width, so it has its own column
+        sn_dict = prof_utils.matched_filter_sn(prof_info["profile"])
+        row.update({"sn":sn_dict["sn"], "boxcar_width":sn_dict["width"], "maxima":[sn_dict["phase"]*row["nbins"]]})
+    else:
+        raise ValueError("method not recognised. Options are: 'gfit', 'analyse' or 'boxcar'")
+    row["status"] = "ok"
+    return row
+
+def _batch_task(task):
+    """
+    Runs func(path, **kwargs) for one file with a time limit. Any error is recorded in the returned row instead of being raised.
+    task is (func, columns, path, timeout, kwargs) and func must return a row dictionary with the keys of columns
+    """
+    func, columns, path, timeout, kwargs = task
+    if timeout:
+        old_handler = signal.signal(signal.SIGALRM, _timeout_handler)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        row = func(path, **kwargs)
+    except TaskTimeoutError as e:
+        row = dict.fromkeys(columns)
+        row.update({"file":path, "status":"timeout", "error":str(e)})
+    except Exception as e:
+        row = dict.fromkeys(columns)
+        row.update({"file":path, "status":"failed", "error":"{0}: {1}".format(type(e).__name__, e)})
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+    return _task_row(task, row)
+
+def _task_row(task, row):
+    """
+    Formats the row dictionary of a _batch_task() task as a list of strings in the order of its columns
+    """
+    _, columns, _, _, kwargs = task
+    if "method" in columns and row["method"] is None:
+        row["method"] = kwargs.get("method")
+    return [_format_value(row[key]) for key in columns]
+
+def _pool_results(tasks, n_procs, tasks_per_pool=100):
+    """
+    Runs _batch_task() for each task on a pool of n_procs processes and yields the rows as they finish.
+
+    Only n_procs tasks are given to the pool at a time so that if a worker dies (e.g. it is killed for using too much memory or
+    crashes in a C extension) the pool only loses those tasks. They are then rerun one at a time in their own process and the
+    ones that kill that process too are recorded as failed, instead of the batch waiting forever.
+    The pool is replaced after tasks_per_pool*n_procs tasks so a fit that leaks memory doesn't bring down the whole batch
+    """
+    pending = list(reversed(tasks))
+    while pending:
+        suspects = []
+        with ProcessPoolExecutor(n_procs) as executor:
+            running = {}
+            n_submitted = 0
+            while pending or running:
+                #no new tasks once the pool is broken or has done its share
+                while pending and len(running) < n_procs and n_submitted < tasks_per_pool*n_procs and not suspects:
+                    task = pending.pop()
+                    running[executor.submit(_batch_task, task)] = task
+                    n_submitted += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        row = future.result()
+                    except BrokenProcessPool:
+                        suspects.append(task)
+                        continue
+                    yield row
+
+        for task in suspects:
+            with ProcessPoolExecutor(1) as executor:
+                try:
+                    row = executor.submit(_batch_task, task).result()
+                except BrokenProcessPool:
+                    row = dict.fromkeys(task[1])
+                    row.update({"file":task[2], "status":"failed", "error":"The worker process died"})
+                    row = _task_row(task, row)
+            yield row
+
+#---------------------------------------------------------------
+def read_prof_batch_table(outfile, columns=PROF_BATCH_COLUMNS):
+    """
+    Reads the complete rows of a profile batch table. See prof_batch()
+
+    Parameters:
+    -----------
+    outfile: str
+        The csv table
+    columns: list
+        OPTIONAL - The columns of the table. Default: PROF_BATCH_COLUMNS
+
+    Returns:
+    --------
+    rows: list
+        The rows of the table (excluding the header) as lists of strings
+    """
+    if not os.path.exists(outfile):
+        return []
+    with open(outfile, newline="") as f:
+        rows = [row for row in csv.reader(f)]
+    #a row that was interrupted while it was being written will be short
+    return [row for row in rows[1:] if len(row) == len(columns)]
+
+def run_batch(func, files, outfile, columns, n_procs=1, timeout=None, retry_failed=True, name="Batch", **kwargs):
+    """
+    Runs func(file, **kwargs) for many files on a pool of processes and streams the resulting rows to a csv table.
+    func must return a dictionary with the keys of columns, which must start with 'file', 'status' and 'error'.
+    Each file is stopped if it takes longer than timeout seconds and any error is recorded in its row instead of stopping the batch.
+    A file whose worker process dies is recorded as failed. See _pool_results()
+
+    Files that already have a row in the table are skipped so an interrupted batch can be resumed by rerunning it.
+    The rows of files that failed or timed out are replaced if retry_failed is True.
+
+    Parameters:
+    -----------
+    func: function
+        The module level function that analyses a single file
+    files: list
+        The paths of the files
+    outfile: str
+        The csv file to write the results to
+    columns: list
+        The columns of the table
+    n_procs: int
+        OPTIONAL - The number of processes to use. Default: 1
+    timeout: float
+        OPTIONAL - The maximum time in seconds to spend on each file. If None, there is no limit. Default: None
+    retry_failed: boolean
+        OPTIONAL - Whether to reanalyse files that failed or timed out in a previous run. Default: True
+    name: str
+        OPTIONAL - The name of the batch used in log messages. Default: 'Batch'
+    **kwargs:
+        The keyword arguments for func
+
+    Returns:
+    --------
+    counts: dictionary
+        The number of files analysed in this run with each status ('ok', 'failed' or 'timeout')
+    """
+    status_idx = columns.index("status")
+    rows = read_prof_batch_table(outfile, columns=columns)
+    if retry_failed:
+        rows = [row for row in rows if row[status_idx] == "ok"]
+    done = {row[0] for row in rows}
+    todo = [os.path.abspath(f) for f in files if os.path.abspath(f) not in done]
+    logger.info("{0}: {1} files already done, {2} to do".format(name, len(files) - len(todo), len(todo)))
+
+    #rewrite the table without any partial or retried rows
+    with open(outfile, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+    counts = {"ok":0, "failed":0, "timeout":0}
+    if not todo:
+        return counts
+
+    tasks = [(func, columns, path, timeout, kwargs) for path in todo]
+    if n_procs > 1:
+        results = _pool_results(tasks, n_procs)
+    else:
+        results = map(_batch_task, tasks)
+
+    with open(outfile, "a", newline="") as f:
+        writer = csv.writer(f)
+        for n, row in enumerate(results):
+            writer.writerow(row)
+            f.flush()
+            counts[row[status_idx]] += 1
+            if row[status_idx] != "ok":
+                logger.warning("{0}: {1} {2}. {3}".format(name, row[0], row[status_idx], row[2]))
+            logger.info("{0}: {1}/{2} files done".format(name, n + 1, len(todo)))
+
+    logger.info("{0}: {1} ok, {2} failed, {3} timed out".format(name, counts["ok"], counts["failed"], counts["timeout"]))
+    return counts
+
+def prof_batch(profiles, outfile, n_procs=1, timeout=None, retry_failed=True, **kwargs):
+    """
+    Analyses many profiles on a pool of processes and streams the results to a csv table with the columns PROF_BATCH_COLUMNS.
+    Each profile is read and analysed in a worker process and is stopped if it takes longer than timeout seconds.
+
+    Profiles that already have a row in the table are skipped so an interrupted batch can be resumed by rerunning it.
+    The rows of profiles that failed or timed out are replaced if retry_failed is True.
+
+    Parameters:
+    -----------
+    profiles: list
+        The paths of the profile files. See find_profiles()
+    outfile: str
+        The csv file to write the results to
+    n_procs: int
+        OPTIONAL - The number of processes to use. Default: 1
+    timeout: float
+        OPTIONAL - The maximum time in seconds to spend on each profile. If None, there is no limit. Default: None
+    retry_failed: boolean
+        OPTIONAL - Whether to reanalyse profiles that failed or timed out in a previous run. Default: True
+    **kwargs:
+        The keyword arguments for analyse_profile()
+
+    Returns:
+    --------
+    counts: dictionary
+        The number of profiles analysed in this run with each status ('ok', 'failed' or 'timeout')
+    """
+    return run_batch(analyse_profile, profiles, outfile, PROF_BATCH_COLUMNS, n_procs=n_procs, timeout=timeout,\
+                     retry_failed=retry_failed, name="Profile batch", **kwargs)
+
+#---------------------------------------------------------------
+if __name__ == '__main__':
+
+    loglevels = dict(DEBUG=logging.DEBUG,\
+                    INFO=logging.INFO,\
+                    WARNING=logging.WARNING,\
+                    ERROR=logging.ERROR)
+
+    parser = argparse.ArgumentParser(description="""Analyses many pulse profiles in parallel and writes the results to a single csv table.
+                                     If the table already exists, the profiles in it are skipped""",\
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    inputs = parser.add_argument_group("Inputs")
+    inputs.add_argument("profiles", type=str, nargs="*", help="The profile files (bestprof, pdv ascii or archive) and/or directories containing them")
+    inputs.add_argument("--file_list", type=str, help="A text file containing one profile file or directory per line")
+    inputs.add_argument("--pattern", type=str, default="*", help="The glob pattern used to find profile files in directories")
+    inputs.add_argument("--period", type=float, help="The period of the pulsar in ms for profiles that don't contain one. Used in S/N calculation")
+    inputs.add_argument("--method", type=str, default="gfit", choices=["gfit", "analyse", "boxcar"],\
+                        help="'gfit' fits gaussians to each profile (auto_gfit). 'analyse' uses the clipping based analysis (auto_analyse_pulse_prof).\
+                        'boxcar' only finds the matched filter S/N (matched_filter_sn), which is fast enough to triage many profiles")
+
+    g_inputs = parser.add_argument_group("Gaussian Inputs")
+    g_inputs.add_argument("--max_N", type=int, default=6, help="The maximum number of gaussian components to attempt to fit")
+    g_inputs.add_argument("--min_comp_len", type=int, default=None,\
+                          help="Minimum length of a component to be considered real. Measured in bins. If none, will use 1 percent of total profile length")
+    g_inputs.add_argument("--ignore_threshold", type=float, default=None, help="Maxima with values below this fraction of the profile maximum will be ignored")
+    g_inputs.add_argument("--cliptype", type=str, default="regular", choices=["regular", "noisy", "verbose"], help="The range of alphas to try")
+    g_inputs.add_argument("--coarse_nbins", type=int, default=None, help="Search for the best fit of high resolution profiles after downsampling\
+                          them to about this many bins, then refine the fit at full resolution. If none, will fit at full resolution")
+    g_inputs.add_argument("--no_cache", action="store_true", help="Use this tag to always fit the profiles instead of using the cache of previous fits")
+
+    batch_inputs = parser.add_argument_group("Batch Inputs")
+    batch_inputs.add_argument("--outfile", type=str, default="prof_batch.csv", help="The csv file to write the results to")
+    batch_inputs.add_argument("--n_procs", type=int, default=1, help="The number of processes to use")
+    batch_inputs.add_argument("--timeout", type=float, default=None, help="The maximum time in seconds to spend on a single profile")
+    batch_inputs.add_argument("--no_retry", action="store_true", help="Don't reanalyse profiles that failed or timed out in a previous run")
+    batch_inputs.add_argument("-L", "--loglvl", type=str, default="INFO", help="Logger verbostity level")
+    args = parser.parse_args()
+
+    logger.setLevel(loglevels[args.loglvl])
+    ch = logging.StreamHandler()
+    ch.setLevel(loglevels[args.loglvl])
+    formatter = logging.Formatter('%(asctime)s  %(filename)s  %(name)s  %(lineno)-4d  %(levelname)-9s :: %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    paths = list(args.profiles)
+    if args.file_list:
+        with open(args.file_list) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    profiles = find_profiles(paths, pattern=args.pattern)
+    if not profiles:
+        logger.error("No profiles found")
+        sys.exit(1)
+
+    prof_batch(profiles, args.outfile, n_procs=args.n_procs, timeout=args.timeout, retry_failed=not args.no_retry,\
+               method=args.method, period=args.period, max_N=args.max_N, min_comp_len=args.min_comp_len,\
+               ignore_threshold=args.ignore_threshold, cliptype=args.cliptype, use_cache=not args.no_cache,\
+               coarse_nbins=args.coarse_nbins)
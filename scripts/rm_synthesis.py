@@ -1,15 +1,13 @@
 #! /usr/bin/env python3
 
-import subprocess
 import argparse
 import logging
 import os
-import glob
 import numpy as np
+from multiprocessing import Pool
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import random
 
 import rm as rm_synth
 
@@ -17,28 +15,6 @@ import prof_utils
 
 logger = logging.getLogger(__name__)
 
-def rmfit_quad(archive, phase_min, phase_max):
-    """
-    Runs the PRSCHIVE rmfit command as a python subprocess using the -w option for a quadratic fit
-
-    Parameters:
-    -----------
-    archive: string
-        The name of the archive file to take as an input
-    phase_min: float
-        The minimum phase to begin the fit, should be a float between 0 and 1
-    phase_max: float
-        The maximum phase to use to fit, should be a float between 0 and 1
-    """
-    commands=["rmfit"]
-    commands.append("-m")
-    commands.append("-10,10,20")
-    commands.append("-w")
-    commands.append(f"{phase_min},{phase_max}")
-    commands.append("-Y")
-    commands.append(archive)
-    subprocess.run(commands)
-
 def find_on_pulse_ranges(I, **kwargs):
     """
     Find ranges of pulse components from a pulse profile by fitting a gaussian distribution
@@ -55,11 +31,27 @@ def find_on_pulse_ranges(I, **kwargs):
     phases: list
         A list of phases (from 0 to 1) corresponding to the on-pulse components
     """
-    prof_dict = prof_utils.auto_gfit(I, **kwargs)
+    return gfit_phase_ranges(prof_utils.auto_gfit(I, **kwargs))
+
+def gfit_phase_ranges(prof_dict):
+    """
+    Finds the phase ranges of the pulse components of an existing gaussian fit
+
+    Parameters:
+    -----------
+    prof_dict: dictionary
+        The output of prof_utils.auto_gfit()
+
+    Returns:
+    --------
+    phases: list
+        A list of phases (from 0 to 1) corresponding to the on-pulse components
+    """
+    nbin = len(prof_dict["profile"])
     phases = []
     for comp_no in prof_dict["comp_idx"].keys():
-        phases.append(min(prof_dict["comp_idx"][comp_no])/len(I))
-        phases.append(max(prof_dict["comp_idx"][comp_no])/len(I))
+        phases.append(min(prof_dict["comp_idx"][comp_no])/nbin)
+        phases.append(max(prof_dict["comp_idx"][comp_no])/nbin)
 
     return phases
 
@@ -138,6 +130,65 @@ def read_rmfit_QUVflux(QUVflux):
 
     return [freq_hz, I, I_e, Q, Q_e, U, U_e]
 
+def write_QUVflux(filename, spectra):
+    """
+    Writes the spectra of a phase range in the same format as the QUVflux.out file generated from rmfit
+
+    Parameters:
+    -----------
+    filename: string
+        The pathname of the file to write to
+    spectra: list
+        The output of phase_range_spectra()
+    """
+    freq_hz, I, I_e, Q, Q_e, U, U_e, V, V_e = spectra
+    table = np.column_stack([np.arange(len(freq_hz)), freq_hz/1e6, I, I_e, Q, Q_e, U, U_e, V, V_e])
+    np.savetxt(filename, table, fmt=["%d"] + ["%.6f"] + ["%.6e"]*8)
+
+def phase_range_spectra(ar_dict, phase_min, phase_max, off_pulse=None):
+    """
+    Sums the channelised Stokes profiles of an archive over a phase range, like rmfit -w does for QUVflux.out.
+    The off-pulse mean of each channel is subtracted first and the channels with zero weight are dropped
+
+    Parameters:
+    -----------
+    ar_dict: dictionary
+        The output of prof_utils.read_archive() with fscrunch=False and tscrunch=True
+    phase_min: float
+        The minimum phase of the range, between 0 and 1
+    phase_max: float
+        The maximum phase of the range, between 0 and 1. If less than phase_min, the range wraps around
+    off_pulse: numpy.array
+        OPTIONAL - A boolean mask of the off-pulse bins. Default: None (the bins outside the phase range)
+
+    Returns:
+    --------
+    List containing:
+        freq_hz: numpy.array
+            Frequency values in Hz
+        I, I_e, Q, Q_e, U, U_e, V, V_e: numpy.array
+            The Stokes values and their uncertainties
+    """
+    nbin = ar_dict["nbin"]
+    bin_min = int(round(phase_min*nbin))
+    bin_max = int(round(phase_max*nbin))
+    if bin_max < bin_min:
+        bin_max += nbin
+    on = np.zeros(nbin, dtype=bool)
+    on[np.arange(bin_min, bin_max+1) % nbin] = True
+    if off_pulse is None or np.sum(off_pulse & ~on) < 2:
+        off_pulse = ~on
+    off = off_pulse & ~on
+
+    good = ar_dict["weights"][0] > 0
+    spectra = [ar_dict["freqs"][good]*1e6]
+    for stokes in "IQUV":
+        chans = ar_dict[stokes][good]
+        chans = chans - np.mean(chans[:, off], axis=1)[:, None]
+        spectra.append(np.sum(chans[:, on], axis=1))
+        spectra.append(np.std(chans[:, off], axis=1)*np.sqrt(np.sum(on)))
+    return spectra
+
 def write_rm_to_file(filename, rm_dict):
     """
     Writes the rotation measure and its error to a file
@@ -197,7 +248,82 @@ def find_best_range(I, Q, U, phase_ranges):
 
     return best_phase_range, best_max
 
-def IQU_rm_synth(freq_hz, I, Q, U, I_e, Q_e, U_e, phase_range=None, force_single=False, title=None, plotname=None, phi_range=(-300, 300), phi_steps=10000):
+def coarse_to_fine_phi(freq_hz, Q, U, phi_range=(-300, 300), phi_res=None, coarse_frac=0.25, window=5., n_candidates=3, weights=None):
+    """
+    Finds the Faraday depths to synthesise finely. The FDF is first sampled over the whole range at a fraction of the RMSF FWHM,
+    then the brightest candidate peaks are resampled at phi_res in a window around each and the brightest one is kept
+
+    Parameters:
+    -----------
+    freq_hz: list
+        Frequency values in Hz
+    Q: list
+        Stokes Q values
+    U: list
+        Stokes U values
+    phi_range: tuple
+        OPTIONAL - The range of RMs to search over. Default: (-300, 300)
+    phi_res: float
+        OPTIONAL - The step of the fine Faraday depths in rad/m^2. Default: None (1/32 of the RMSF FWHM)
+    coarse_frac: float
+        OPTIONAL - The step of the coarse Faraday depths as a fraction of the RMSF FWHM. Default: 0.25
+    window: float
+        OPTIONAL - The half width of the fine window in RMSF FWHMs. Default: 5.
+    n_candidates: int
+        OPTIONAL - The maximum number of coarse peaks to refine. Default: 3
+    weights: list
+        OPTIONAL - The weight of each channel. Default: None (uniform)
+
+    Returns:
+    --------
+    phi_axis: numpy.array
+        The fine Faraday depths centred on the brightest peak
+    noise: float
+        The standard deviation of the real part of the coarse FDF, less the RMSF of the peak, away from the peak.
+        None if too few coarse samples are left
+    """
+    freq_hz = np.asarray(freq_hz, dtype=float)
+    weights = np.ones(len(freq_hz)) if weights is None else np.asarray(weights, dtype=float)
+    l2 = (2.998e8/freq_hz)**2
+    dl2 = l2 - np.mean(l2)
+    fwhm = 2.*np.sqrt(3.)/(np.max(l2) - np.min(l2))
+    if phi_res is None:
+        phi_res = fwhm/32.
+    quw = (np.asarray(Q) + 1j*np.asarray(U))*weights/np.sum(weights)
+    half = window*fwhm
+
+    #coarse pass over the whole range
+    phi_min, phi_max = min(phi_range), max(phi_range)
+    ncoarse = max(3, int(np.ceil((phi_max - phi_min)/(coarse_frac*fwhm))) + 1)
+    coarse_phi = np.linspace(phi_min, phi_max, ncoarse)
+    coarse_fdf = rm_synth.faraday_transform(coarse_phi, dl2, quw)
+    coarse = np.abs(coarse_fdf)
+
+    #local maxima within the scalloping loss of the brightest one
+    padded = np.concatenate(([-np.inf], coarse, [-np.inf]))
+    peaks = np.flatnonzero((coarse >= padded[:-2]) & (coarse >= padded[2:]))
+    peaks = peaks[np.argsort(coarse[peaks])[::-1]][:n_candidates]
+    peaks = peaks[coarse[peaks] >= 0.8*coarse[peaks[0]]]
+
+    #fine pass around each candidate
+    best_amp, best_phi, best_fdf = -np.inf, None, None
+    for peak in peaks:
+        fine_phi = coarse_phi[peak] + np.arange(-coarse_frac*fwhm, coarse_frac*fwhm + phi_res/2, phi_res)
+        fine = rm_synth.faraday_transform(fine_phi, dl2, quw)
+        if np.max(np.abs(fine)) > best_amp:
+            best = np.argmax(np.abs(fine))
+            best_amp, best_phi, best_fdf = np.abs(fine[best]), fine_phi[best], fine[best]
+    logger.debug(f"Refined {len(peaks)} of {ncoarse} coarse Faraday depths. Peak at {best_phi:.3f} rad/m^2")
+
+    #remove the RMSF of the peak, as one RM-CLEAN component would, and measure the noise away from it
+    rmsf = rm_synth.faraday_transform(coarse_phi - best_phi, dl2, weights/np.sum(weights))
+    away = np.abs(coarse_phi - best_phi) > half
+    noise = np.std(np.real(coarse_fdf - best_fdf*rmsf)[away]) if np.sum(away) >= 10 else None
+    nhalf = int(np.ceil(half/phi_res))
+    return best_phi + phi_res*np.arange(-nhalf, nhalf+1), noise
+
+def IQU_rm_synth(freq_hz, I, Q, U, I_e, Q_e, U_e, phase_range=None, force_single=False, title=None, plotname=None, phi_range=(-300, 300), phi_steps=10000,
+                 coarse_to_fine=False, phi_res=None, rmsf_disk_cache=False, verbose=True):
     """
     Performs RM synthesis on input data
 
@@ -221,6 +347,15 @@ def IQU_rm_synth(freq_hz, I, Q, U, I_e, Q_e, U_e, phase_range=None, force_single
         OPTIONAL - The range of RMs to search over. Default: (-300, 300)
     phi_steps: int
         OPTINAL - The bumber of RM steps to search over. Default: 10000
+    coarse_to_fine: boolean
+        OPTIONAL - If True, search the whole phi_range coarsely and only synthesise a window around the peak at phi_res
+        with coarse_to_fine_phi(). phi_steps is then ignored. Default: False
+    phi_res: float
+        OPTIONAL - The Faraday depth step of the refined window with coarse_to_fine. Default: None (1/32 of the RMSF FWHM)
+    rmsf_disk_cache: boolean
+        OPTIONAL - If True, keep the RMSF in the on-disk cache so other processes and runs with the same setup reuse it. Default: False
+    verbose: boolean
+        OPTIONAL - If False, don't print the progress of the synthesis and clean. Default: True
     phase_range: tuple
         OPTIONAL - The phase range of the profile used in fitting. Will be displayed on plot. Default: None
     plotname: string
@@ -233,19 +368,30 @@ def IQU_rm_synth(freq_hz, I, Q, U, I_e, Q_e, U_e, phase_range=None, force_single
     rm_e: float
         The uncertainty in the rotation measure
     """
-    p = rm_synth.PolObservation(freq_hz, (I, Q, U), IQUerr=(I_e, Q_e, U_e))
-    phi_axis = np.linspace(*phi_range, phi_steps)
-    p.rmsynthesis(phi_axis)
-    p.rmclean(cutoff=3.)
-    p.get_fdf_peak()
-    p.print_rmstats()
+    p = rm_synth.PolObservation(freq_hz, (I, Q, U), IQUerr=(I_e, Q_e, U_e), verbose=verbose)
+    noise = None
+    if coarse_to_fine:
+        phi_axis, noise = coarse_to_fine_phi(freq_hz, Q, U, phi_range=phi_range, phi_res=phi_res)
+        plot_range = (phi_axis[0], phi_axis[-1])
+    else:
+        phi_axis = np.linspace(*phi_range, phi_steps)
+        plot_range = phi_range
+    p.rmsynthesis(phi_axis, rmsf_disk_cache=rmsf_disk_cache, verbose=verbose)
+    p.rmclean(cutoff=3., verbose=verbose)
+    p.get_fdf_peak(verbose=verbose)
+    if verbose:
+        p.print_rmstats()
     rm = p.cln_fdf_peak_rm
     rm_e = p.cln_fdf_peak_rm_err
+    if noise is not None:
+        #the window is dominated by the peak, so use the noise of the wide coarse search
+        rm_e = p.rmsf_fwhm/(2.355*p.fdf_peak/noise)
     norm_factor = max(abs(p.fdf))
 
     if plotname:
+        phi_range = plot_range
         plt.figure(figsize=(12, 10))
-        rm_string='RM: {0:7.3f}+/-{1:6.3f}'.format(p.cln_fdf_peak_rm, p.cln_fdf_peak_rm_err)
+        rm_string='RM: {0:7.3f}+/-{1:6.3f}'.format(rm, rm_e)
         phi_min = min(phi_range)
         plt.text(min(phi_range)+0.05*abs(phi_min), 0.95, rm_string, fontsize=12)
         if phase_range:
@@ -264,12 +410,147 @@ def IQU_rm_synth(freq_hz, I, Q, U, I_e, Q_e, U_e, phase_range=None, force_single
         if title:
             plt.title(title, fontsize=16)
         plt.savefig(plotname, bbox_inches='tight')
+        plt.close()
 
     return rm, rm_e
 
-def rm_synth_pipe(kwargs):
+def fdf_peaks(phi_axis, fdf, rmsf_fwhm, l20):
+    """
+    Finds the peak of each Faraday dispersion function the same way as rm.PolObservation.get_fdf_peak(),
+    fitting a parabola to the peak bin and its neighbours
+
+    Parameters:
+    -----------
+    phi_axis: numpy.array
+        The regularly spaced Faraday depths of the FDFs
+    fdf: numpy.array
+        The FDFs with shape (nspec, len(phi_axis))
+    rmsf_fwhm: float
+        The FWHM of the RMSF in rad/m^2
+    l20: float
+        The reference lambda squared in m^2
+
+    Returns:
+    --------
+    peak_dict: dictionary
+        contains keys:
+        rm: numpy.array
+            The Faraday depth of each peak in rad/m^2
+        rm_e: numpy.array
+            The uncertainty in rm
+        peak: numpy.array
+            The amplitude of each peak
+        pa: numpy.array
+            The RM-corrected position angle at each peak in degrees
+    """
+    amp = np.abs(fdf)
+    nspec, nphi = amp.shape
+    rows = np.arange(nspec)
+    x0 = np.argmax(amp, axis=1)
+    rm = phi_axis[x0].astype(float)
+    peak = amp[rows, x0]
+    inner = (x0 > 0) & (x0 < nphi - 1)
+    xi = x0[inner]
+    y0, y1, y2 = amp[rows[inner], xi - 1], amp[rows[inner], xi], amp[rows[inner], xi + 1]
+    curv = y0 - 2*y1 + y2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = np.where(curv != 0, 0.5*(y0 - y2)/curv, 0.)
+    rm[inner] = phi_axis[xi] + offset*(phi_axis[1] - phi_axis[0])
+    peak[inner] = y1 - 0.25*(y0 - y2)*offset
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rm_e = rmsf_fwhm / (2.355*peak/np.std(np.real(fdf), axis=1))
+    rotpeak = fdf[rows, x0]*np.exp(-2j*rm*l20)
+    pa = np.rad2deg(0.5*np.angle(rotpeak))
+    return {"rm":rm, "rm_e":rm_e, "peak":peak, "pa":pa}
+
+def rm_synth_cube(freq_hz, Q, U, phi_axis, weights=None, bins=None, max_mem=2**28, keep_cube=True):
+    """
+    Performs RM synthesis on every phase bin at once. The (channel, bin) Q and U matrix is transformed against the
+    phase kernel shared by all bins, in chunks of bins so that no chunk of the (bin, phi) cube exceeds max_mem bytes
+
+    Parameters:
+    -----------
+    freq_hz: numpy.array
+        Frequency values in Hz with shape (nchan,)
+    Q: numpy.array
+        Stokes Q with shape (nchan, nbin)
+    U: numpy.array
+        Stokes U with shape (nchan, nbin)
+    phi_axis: numpy.array
+        The regularly spaced Faraday depths to synthesise in rad/m^2
+    weights: numpy.array
+        OPTIONAL - The weight of each channel. Channels with zero weight are ignored. Default: None (uniform)
+    bins: list
+        OPTIONAL - The phase bins to synthesise. Default: None (all bins)
+    max_mem: int
+        OPTIONAL - The memory budget in bytes for each chunk of the cube. Default: 2**28
+    keep_cube: boolean
+        OPTIONAL - If False, only the peaks are kept and the cube is discarded chunk by chunk. Default: True
+
+    Returns:
+    --------
+    cube_dict: dictionary
+        contains keys:
+        bins: numpy.array
+            The phase bins that were synthesised
+        phi: numpy.array
+            The Faraday depths
+        fdf: numpy.array
+            The Faraday dispersion function of each bin with shape (len(bins), len(phi)). None if keep_cube is False
+        rm, rm_e, peak, pa: numpy.array
+            The peak of each bin from fdf_peaks()
+        rmsf_fwhm: float
+            The FWHM of the RMSF in rad/m^2
+    """
+    Q = np.atleast_2d(np.asarray(Q, dtype=float))
+    U = np.atleast_2d(np.asarray(U, dtype=float))
+    phi_axis = np.asarray(phi_axis, dtype=float)
+    bins = np.arange(Q.shape[1]) if bins is None else np.asarray(bins, dtype=int)
+    weights = np.ones(len(freq_hz)) if weights is None else np.asarray(weights, dtype=float)
+    good = weights > 0
+    l2 = (2.998e8/np.asarray(freq_hz, dtype=float)[good])**2
+    l20 = np.mean(l2)
+    K = 1./np.sum(weights[good])
+    rmsf_fwhm = 2.*np.sqrt(3.)/(np.max(l2) - np.min(l2))
+    quw = (Q[good] + 1j*U[good])*weights[good, None]
+
+    cube = np.zeros((len(bins), len(phi_axis)), dtype=complex) if keep_cube else None
+    peak_dict = {key:np.zeros(len(bins)) for key in ("rm", "rm_e", "peak", "pa")}
+    nb = max(1, int(max_mem//(16*len(phi_axis))))
+    for b0 in range(0, len(bins), nb):
+        chunk = bins[b0:b0+nb]
+        fdf = K*rm_synth.faraday_transform(phi_axis, l2 - l20, quw[:, chunk], max_mem=max_mem).T
+        chunk_peaks = fdf_peaks(phi_axis, fdf, rmsf_fwhm, l20)
+        for key in peak_dict.keys():
+            peak_dict[key][b0:b0+nb] = chunk_peaks[key]
+        if keep_cube:
+            cube[b0:b0+nb] = fdf
+        logger.debug(f"Synthesised bins {b0} - {b0+len(chunk)} of {len(bins)}")
+
+    cube_dict = {"bins":bins, "phi":phi_axis, "fdf":cube, "rmsf_fwhm":rmsf_fwhm}
+    cube_dict.update(peak_dict)
+    return cube_dict
+
+def write_rm_cube_to_file(filename, cube_dict, nbin):
     """
-    Performs all the nexessary operations on an archive file to attain a rotation measure through the RM synthesis technique
+    Writes the peak RM of every phase bin from rm_synth_cube() to a file
+
+    Parameters:
+    -----------
+    filename: str
+        The pathname of the file to write to
+    cube_dict: dictionary
+        The output of rm_synth_cube()
+    nbin: int
+        The number of bins in the profile
+    """
+    table = np.column_stack([cube_dict["bins"], cube_dict["bins"]/nbin, cube_dict["rm"], cube_dict["rm_e"], cube_dict["peak"], cube_dict["pa"]])
+    np.savetxt(filename, table, fmt=["%d", "%.6f", "%.4f", "%.4f", "%.6e", "%.3f"], header="bin phase rm rm_e peak pa")
+
+def rm_synth_cube_pipe(kwargs):
+    """
+    Reads the channelised Stokes profiles from an archive, removes the off-pulse mean of each channel and performs RM synthesis
+    on every phase bin with rm_synth_cube()
 
     Parameters:
     -----------
@@ -277,6 +558,212 @@ def rm_synth_pipe(kwargs):
         The name of the archive file to use
     work_dir: string
         OPTIONAL - The directory to work in. Default: './'
+    label: string
+        OPTIONAL - A label used to identify the output files. Default: the archive name
+    cube_min_sn: float
+        OPTIONAL - Only synthesise the bins where the baseline subtracted Stokes I is at least this many sigma. Default: None (all bins)
+    phi_range: tuple
+        OPTIONAL - The range of RMs to synthesise. Default: (-300, 300)
+    phi_steps: int
+        OPTIONAL - The number of RM steps. Default: 10000
+    max_mem: int
+        OPTIONAL - The memory budget in MB for each chunk of the cube. Default: 256
+    write: boolean
+        OPTIONAL - If True, will write the RM of each bin to a file. Default: False
+    plot: boolean
+        OPTIONAL - If True, will plot the amplitude of the cube. Default: False
+
+    Returns:
+    --------
+    cube_dict: dictionary
+        The output of rm_synth_cube()
+    filename: str
+        The path of the file that was written to. None if not written
+    """
+    archive = os.path.join(kwargs["work_dir"], kwargs["archive"])
+    label = kwargs.get("label") or os.path.splitext(os.path.basename(kwargs["archive"]))[0]
+    ar_dict = prof_utils.read_archive(archive, fscrunch=False, dedisperse_chans=True)
+    freq_hz = ar_dict["freqs"]*1e6
+    weights = archive_weights(ar_dict)
+
+    #remove the off-pulse mean of each channel like phase_range_spectra()
+    _, clipped = prof_utils.sigmaClip(np.average(ar_dict["I"], axis=0, weights=weights))
+    off_pulse = ~np.isnan(clipped)
+    I, Q, U = [ar_dict[stokes] - np.mean(ar_dict[stokes][:, off_pulse], axis=1)[:, None] for stokes in "IQU"]
+
+    bins = None
+    if kwargs.get("cube_min_sn") is not None:
+        I = np.average(I, axis=0, weights=weights)
+        sigma, _ = prof_utils.sigmaClip(I)
+        bins = np.flatnonzero(I >= kwargs["cube_min_sn"]*sigma)
+        logger.info(f"Synthesising {len(bins)} of {len(I)} bins above S/N {kwargs['cube_min_sn']}")
+
+    phi_axis = np.linspace(*kwargs.get("phi_range", (-300, 300)), kwargs.get("phi_steps", 10000))
+    cube_dict = rm_synth_cube(freq_hz, Q, U, phi_axis, weights=weights, bins=bins, max_mem=int(kwargs.get("max_mem", 256)*2**20),
+                              keep_cube=bool(kwargs.get("plot")))
+
+    if kwargs.get("plot"):
+        plotname = os.path.join(kwargs["work_dir"], f"{label}_RMcube.png")
+        plt.figure(figsize=(12, 8))
+        plt.imshow(np.abs(cube_dict["fdf"]).T, aspect="auto", origin="lower", interpolation="none",
+                   extent=(cube_dict["bins"][0], cube_dict["bins"][-1]+1, phi_axis[0], phi_axis[-1]))
+        plt.xlabel("Phase bin", fontsize=12)
+        plt.ylabel("RM (rad/m2)", fontsize=12)
+        plt.title(f"{label} Faraday depth cube", fontsize=16)
+        plt.savefig(plotname, bbox_inches="tight")
+        plt.close()
+
+    filename = None
+    if kwargs.get("write"):
+        filename = os.path.join(kwargs["work_dir"], f"{label}_RMcube.txt")
+        write_rm_cube_to_file(filename, cube_dict, ar_dict["nbin"])
+
+    return cube_dict, filename
+
+def archive_weights(ar_dict):
+    """
+    The channel weights of the first subintegration of an archive read by prof_utils.read_archive(). Uniform if they are all zero
+    """
+    weights = ar_dict["weights"][0]
+    if np.sum(weights) <= 0:
+        weights = np.ones(len(weights))
+    return weights
+
+def _prepare_archive(kwargs):
+    """
+    Reads the channelised Stokes profiles of an archive, finds the phase range(s) to fit with prof_utils.auto_gfit() if needed
+    (using the optional "max_N" and "use_cache" of kwargs) and sums the spectrum of each.
+    Returns the kwargs of the archive (with the phase ranges and label filled in), the archive dictionary, the gaussian fit
+    (None if the phase ranges were given), the weighted averages of I, Q and U over the channels and the spectra
+    """
+    archive = os.path.join(kwargs["work_dir"], kwargs["archive"])
+    ar_dict = prof_utils.read_archive(archive, fscrunch=False, dedisperse_chans=True)
+    if "U" not in ar_dict:
+        raise ValueError(f"{archive} has no linear polarisation")
+    weights = archive_weights(ar_dict)
+    I, Q, U = [np.average(ar_dict[stokes], axis=0, weights=weights) for stokes in "IQU"]
+
+    #find the phase range(s) to fit:
+    fit_dict = None
+    if not kwargs["phase_ranges"]:
+        gfit_kwargs = {key:kwargs[key] for key in ("max_N", "use_cache") if key in kwargs}
+        fit_dict = prof_utils.auto_gfit(I, period=ar_dict["period"], cliptype=kwargs["cliptype"], **gfit_kwargs)
+        kwargs["phase_ranges"] = gfit_phase_ranges(fit_dict)
+        if kwargs["force_single"]:
+            logger.info("Forcing use of a single phase range")
+            kwargs["phase_ranges"], _ = find_best_range(I, Q, U, kwargs["phase_ranges"])
+    logger.info(f"{kwargs['label']}: Using phase ranges: {kwargs['phase_ranges']}")
+
+    _, clipped = prof_utils.sigmaClip(I)
+    off_pulse = ~np.isnan(clipped)
+    spectra = [phase_range_spectra(ar_dict, phase_min, phase_max, off_pulse=off_pulse)
+               for phase_min, phase_max in zip(kwargs["phase_ranges"][0::2], kwargs["phase_ranges"][1::2])]
+    return kwargs, ar_dict, fit_dict, I, Q, U, spectra
+
+def _rm_synth_task(task):
+    """
+    Performs RM synthesis on the spectra of one phase range. task is (spectra, IQU_rm_synth keyword arguments)
+    """
+    spectra, rm_kwargs = task
+    freq_hz, I, I_e, Q, Q_e, U, U_e, _, _ = spectra
+    return IQU_rm_synth(freq_hz, I, Q, U, I_e, Q_e, U_e, **rm_kwargs)
+
+def _map(func, tasks, n_procs):
+    """
+    Maps func over tasks, in a pool of n_procs processes if n_procs > 1
+    """
+    if n_procs > 1 and len(tasks) > 1:
+        with Pool(min(n_procs, len(tasks))) as pool:
+            return pool.map(func, tasks)
+    return [func(task) for task in tasks]
+
+def rm_synth_pipes(kwargs_list, n_procs=1):
+    """
+    Runs rm_synth_pipe() on many archives. The archives are read in parallel and then all of their phase ranges are
+    synthesised in parallel
+
+    Parameters:
+    -----------
+    kwargs_list: list
+        A list of kwargs dictionaries for rm_synth_pipe(), one for each archive
+    n_procs: int
+        OPTIONAL - The number of processes to use. Default: 1
+
+    Returns:
+    --------
+    results: list
+        The (rm_dict, filename) output of rm_synth_pipe() for each archive
+    """
+    kwargs_list = [dict(kwargs) for kwargs in kwargs_list]
+    for kwargs in kwargs_list:
+        if not kwargs.get("label"):
+            kwargs["label"] = os.path.splitext(os.path.basename(kwargs["archive"]))[0]
+        logger.info(f"Applying label: {kwargs['label']}")
+    prepared = _map(_prepare_archive, kwargs_list, n_procs)
+
+    #one task for every phase range of every archive. The RM synthesis statistics are only printed when debugging
+    #as the processes would interleave them
+    verbose = logger.isEnabledFor(logging.DEBUG)
+    tasks = []
+    for kwargs, *_, spectra in prepared:
+        nranges = len(spectra)
+        for i, (phase_min, phase_max) in enumerate(zip(kwargs["phase_ranges"][0::2], kwargs["phase_ranges"][1::2])):
+            plotname = None
+            if kwargs["plot"]:
+                plotname = f"{kwargs['label']}_"
+                if nranges > 1:
+                    plotname += f"{i}_"
+                plotname += "RMsynthesis.png"
+                plotname = os.path.join(kwargs["work_dir"], plotname)
+            rm_kwargs = {"phase_range":(phase_min, phase_max), "force_single":kwargs["force_single"],
+                         "title":f"{kwargs['label']} RM Synthesis", "plotname":plotname,
+                         "phi_range":kwargs["phi_range"], "phi_steps":kwargs["phi_steps"],
+                         "coarse_to_fine":kwargs.get("coarse_to_fine", False), "phi_res":kwargs.get("phi_res"),
+                         "rmsf_disk_cache":kwargs.get("rmsf_cache", False), "verbose":verbose}
+            tasks.append((spectra[i], rm_kwargs))
+    rms = iter(_map(_rm_synth_task, tasks, n_procs))
+
+    results = []
+    task_iter = iter(tasks)
+    for kwargs, *_, spectra in prepared:
+        rm_dict = {}
+        for i in range(len(spectra)):
+            rm, rm_e = next(rms)
+            _, rm_kwargs = next(task_iter)
+            rm_dict[str(i)] = {}
+            rm_dict[str(i)]["rm"]           = rm
+            rm_dict[str(i)]["rm_e"]         = rm_e
+            rm_dict[str(i)]["phase_range"]  = rm_kwargs["phase_range"]
+            rm_dict[str(i)]["plotname"]     = rm_kwargs["plotname"]
+            rm_dict[str(i)]["label"]        = kwargs["label"]
+
+            #keep quvflux if needed
+            if kwargs["keep_QUV"]:
+                quvflux_name = kwargs["label"]
+                if len(spectra) > 1:
+                    quvflux_name += f"_{i}"
+                quvflux_name += "_QUVflux.out"
+                write_QUVflux(os.path.join(kwargs["work_dir"], quvflux_name), spectra[i])
+
+        filename = None
+        if kwargs["write"]:
+            filename = os.path.join(kwargs["work_dir"], f"{kwargs['label']}_RMsynthesis.txt")
+            write_rm_to_file(filename, rm_dict)
+        results.append((rm_dict, filename))
+
+    return results
+
+def rm_synth_pipe(kwargs):
+    """
+    Performs all the nexessary operations on an archive file to attain a rotation measure through the RM synthesis technique.
+    The spectrum of each phase range is read from the archive in-process and the phase ranges are synthesised in parallel
+
+    Parameters:
+    -----------
+    archive: string
+        The name of the archive file to use
+    work_dir: string
+        OPTIONAL - The directory the archive is in and the outputs are written to. Default: './'
     pulsar: string
         OPTIONAL - The name of the puslar (used for naming purposes). Default: None
     obsid: int
@@ -286,11 +773,13 @@ def rm_synth_pipe(kwargs):
     write: boolean
         OPTIONAL - If True, will write the result to a file. Default: False
     label: string
-        OPTIONAL - A label used to identify the output files. If None, will generate a 64 bit string
+        OPTIONAL - A label used to identify the output files. If None, will use the archive name
     keep_QUV: boolean
-        OPTIONAL - If True, will keep the QUVflux.out file generated from rmfit
+        OPTIONAL - If True, will write the spectrum of each phase range to a QUVflux.out file like rmfit
     force_single: boolean
         OPTIONAL - If True, will find the phase range with the greates lin_pol ratio and fit with only this (only if kwargs_rms['phase_range'] is None). Default: False
+    n_procs: int
+        OPTIONAL - The number of processes used to synthesise the phase ranges. Default: 1
     kwagrs_rms: dict
         keyword arguments for IQU_rm_synth()
     kwargs_gfit: dict
@@ -310,107 +799,38 @@ def rm_synth_pipe(kwargs):
             phase_range: tuple
                 The range of phases used for this run
             plotname: str
-                The name of the output plot. None if no plot
+                The path of the output plot. None if no plot
             label: str
                 The label used
     filename: str
         The path of the file that was written to. None if not written
     """
-    randomgen = random.getrandbits(64)
-    if not kwargs["label"]:
-        kwargs["label"] = randomgen
-    logger.info(f"Applying label: {kwargs['label']}")
-
-    #Move to directory and make temporary working dir
-    os.chdir(kwargs["work_dir"])
-    os.mkdir("{}".format(randomgen))
-    os.chdir("{}".format(randomgen))
-    archive = os.path.join("..", kwargs["archive"])
-
-    #Write the .ar file to text archive
-    ascii_archive = f"{kwargs['label']}_archive.txt"
-    prof_utils.subprocess_pdv(archive, ascii_archive)
-    I, Q, U, V, _ = prof_utils.get_stokes_from_ascii(ascii_archive)
-    os.remove(ascii_archive) #remove the archive file, we don't need it anymore
-
-    #find the phase range(s) to fit:
-    if not kwargs["phase_ranges"]:
-        kwargs["phase_ranges"] = find_on_pulse_ranges(I, cliptype=kwargs["cliptype"])
-        if kwargs["force_single"]:
-            logger.info("Forcing use of a single phase range")
-            kwargs["phase_ranges"], _ = find_best_range(I, Q, U, kwargs["phase_ranges"])
-    logger.info(f"Using phase ranges: {kwargs['phase_ranges']}")
-
-    #run rmfit with -w option
-    rm_dict = {}
-    for i, phase_min, phase_max in zip(range(len(kwargs["phase_ranges"])//2), kwargs["phase_ranges"][0::2], kwargs["phase_ranges"][1::2]):
-        logger.info(f"Performing RM synthesis on phase range: {phase_min} - {phase_max}")
-        rmfit_quad(archive, phase_min, phase_max)
-        #read the QUVflux.out file
-        QUVflux = "QUVflux.out"
-        rmfreq, rmI, rmI_e, rmQ, rmQ_e, rmU, rmU_e, = read_rmfit_QUVflux(QUVflux)
-
-        #make plot name if needed
-        if kwargs["plot"]:
-            plotname = f"{kwargs['label']}_"
-            if len(kwargs["phase_ranges"])>2:
-                plotname += f"{i}_"
-            plotname += "RMsynthesis.png"
-            kwargs["plotname"] = plotname
-        else:
-            plotname = None
-        kwargs["phase_range"] = (phase_min, phase_max)
-        kwargs["title"] = ""
-        if kwargs["label"]:
-            kwargs["title"] = f"{kwargs['label']} "
-        kwargs["title"] += "RM Synthesis"
-
-        #perform RM synthesis
-        rm, rm_e = IQU_rm_synth(rmfreq, rmI, rmQ, rmU, rmI_e, rmQ_e, rmU_e,
-                   phase_range=kwargs["phase_range"], force_single=kwargs["force_single"], title=kwargs["title"],
-                   plotname=kwargs["plotname"], phi_range=kwargs["phi_range"], phi_steps=kwargs["phi_steps"])
-        rm_dict[str(i)] = {}
-        rm_dict[str(i)]["rm"]           = rm
-        rm_dict[str(i)]["rm_e"]         = rm_e
-        rm_dict[str(i)]["phase_range"]  = kwargs["phase_range"]
-        rm_dict[str(i)]["plotname"]     = plotname
-        rm_dict[str(i)]["label"]        = kwargs["label"]
-
-        #move plot out of working dir
-        if plotname:
-            os.rename(plotname, f"../{plotname}")
-
-        #keep quvflux if needed
-        if kwargs["keep_QUV"]:
-            quvflux_name = label
-            if len(phase_ranges)>2:
-                quvflux_name += f"_{i}"
-            quvflux_name += "_QUVflux.out"
-            os.rename("QUVflux.out", f"../{quvflux_name}")
-
-    if kwargs["write"]:
-        filename = f"{kwargs['label']}_"
-        filename += "RMsynthesis.txt"
-        write_rm_to_file(filename, rm_dict)
-        os.rename(filename, f"../{filename}")
-    else:
-        filename = None
-
-    os.chdir("../")
-    allfiles = glob.glob(f"{randomgen}/*")
-    for afile in allfiles:
-        os.remove(afile)
-    os.rmdir(f"{randomgen}")
-
-    return rm_dict, filename
+    return rm_synth_pipes([kwargs], n_procs=kwargs.get("n_procs", 1))[0]
 
 
 def rm_synth_main(kwargs):
-    rm_dict, _ = rm_synth_pipe(kwargs)
-    for i in rm_dict.keys():
-        logger.info("For phase range: {0} - {1}".format(*rm_dict[i]["phase_range"]))
-        logger.info("RM: {0:7.3f} +/- {1:6.3f}".format(rm_dict[i]["rm"], rm_dict[i]["rm_e"]))
-
+    archives = kwargs["archive"]
+    kwargs_list = []
+    for archive in archives:
+        archive_kwargs = dict(kwargs, archive=archive)
+        if kwargs["label"] and len(archives) > 1:
+            archive_kwargs["label"] = "{0}_{1}".format(kwargs["label"], os.path.splitext(os.path.basename(archive))[0])
+        kwargs_list.append(archive_kwargs)
+
+    if kwargs["cube"]:
+        for archive_kwargs in kwargs_list:
+            cube_dict, filename = rm_synth_cube_pipe(archive_kwargs)
+            best = np.argmax(cube_dict["peak"])
+            logger.info("{0}: Brightest bin {1}: RM: {2:7.3f} +/- {3:6.3f}".format(archive_kwargs["archive"], cube_dict["bins"][best], cube_dict["rm"][best], cube_dict["rm_e"][best]))
+            if filename:
+                logger.info(f"Per-bin RMs written to {filename}")
+        return
+
+    for archive_kwargs, (rm_dict, _) in zip(kwargs_list, rm_synth_pipes(kwargs_list, n_procs=kwargs["n_procs"])):
+        logger.info(f"Archive: {archive_kwargs['archive']}")
+        for i in rm_dict.keys():
+            logger.info("For phase range: {0} - {1}".format(*rm_dict[i]["phase_range"]))
+            logger.info("RM: {0:7.3f} +/- {1:6.3f}".format(rm_dict[i]["rm"], rm_dict[i]["rm_e"]))
 
 if __name__ == '__main__':
 
@@ -423,26 +843,34 @@ if __name__ == '__main__':
                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     required = parser.add_argument_group("Required Inputs:")
-    required.add_argument("-f", "--archive", required=True, type=str, help="The name of the archive (.ar) file to work with")
+    required.add_argument("-f", "--archive", required=True, type=str, nargs="+", help="The name of the archive (.ar) file(s) to work with")
 
     fitting = parser.add_argument_group("Fitting Options:")
     fitting.add_argument("--phase_ranges", type=float, nargs="+", help="The phase range(s) to fit the RM to. If unsupplied, will find the on-pulse and fit that range.\
                          Supports multiple ranges. eg. 0.1 0.15 0.55 0.62 will fit from 0.1 to 0.15 and from 0.55 or 0.62.")
     fitting.add_argument("--phi_steps", type=int, default=10000, help="The number of rm steps to use for synthesis.")
     fitting.add_argument("--phi_range", type=float, default=(-300, 300), nargs="+", help="The range of RMs so synthsize. Giving a smaller window will speed up operations.")
+    fitting.add_argument("--coarse_to_fine", action="store_true", help="Use this tag to search the whole phi_range coarsely and only synthesise a window around the peak.\
+                         Allows much wider phi ranges, e.g. --phi_range -10000 10000")
+    fitting.add_argument("--phi_res", type=float, help="The RM step of the refined window with --coarse_to_fine. Default: 1/32 of the RMSF FWHM")
+    fitting.add_argument("--rmsf_cache", action="store_true", help="Use this tag to keep the RMSF in the on-disk cache (VCSTOOLS_CACHE_DIR) so archives with the same setup reuse it")
+    fitting.add_argument("--cube", action="store_true", help="Use this tag to perform RM synthesis on every phase bin instead of the on-pulse phase ranges")
+    fitting.add_argument("--cube_min_sn", type=float, help="Only synthesise the phase bins where Stokes I is above this S/N (with --cube)")
+    fitting.add_argument("--max_mem", type=float, default=256, help="The memory budget in MB for each chunk of the RM cube (with --cube)")
     fitting.add_argument("--force_single", action="store_true", help="use this tag to force using only a single phase range (if phase_ranges is unsupplied)")
 
     output = parser.add_argument_group("Output Options:")
     output.add_argument("--label", type=str, help="A label for the output.")
     output.add_argument("--write", action="store_true", help="Use this tag to write the results to a labelled file")
     output.add_argument("--plot", action="store_true", help="Use this tag to plot the result.")
-    output.add_argument("--keep_QUV", action="store_true", help="Use this tag to keep the QUVflux.out file from rmfit.")
+    output.add_argument("--keep_QUV", action="store_true", help="Use this tag to write the spectrum of each phase range to a QUVflux.out file like rmfit.")
 
     gfit = parser.add_argument_group("Gaussian Fit Options")
     gfit.add_argument("--cliptype", type=str, default="regular", help="Verbosity of clipping for gaussian fitting. Options - regular, noisy, verbose")
 
     optional = parser.add_argument_group("additional Inputs:")
-    optional.add_argument("-d", "--work_dir", type=str, default="./", help="The directory to work in")
+    optional.add_argument("-d", "--work_dir", type=str, default="./", help="The directory the archives are in and the outputs are written to")
+    optional.add_argument("--n_procs", type=int, default=1, help="The number of processes used to read the archives and synthesise the phase ranges")
     optional.add_argument("-L", "--loglvl", type=str, default="INFO", help="Logger verbosity level. Default: INFO", choices=loglevels.keys())
 
     args = parser.parse_args()
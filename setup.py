@@ -57,7 +57,7 @@ setup(name="mwa_vcstools",
                'scripts/reorder_chans.py', 'scripts/rts2ao.py', 'scripts/untar.sh',
                'scripts/cleanup.py', 'scripts/create_ics_psrfits.py', 'scripts/rm_synthesis.py',
                'scripts/splice.sh', 'scripts/auto_plot.bash', 'scripts/splice_wrapper.py',
-               'scripts/RVM_fit.py',
+               'scripts/RVM_fit.py', 'scripts/prof_batch.py', 'scripts/pol_batch.py',
                'database/submit_to_database.py', 'database/database_vcs.py',
                'utils/zapchan.py', 'utils/calc_ephem.py', 'utils/check_disk_usage.sh',
                'utils/check_quota.sh', 'utils/mdir.py', 'utils/mwa_metadb_utils.py',
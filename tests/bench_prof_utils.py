@@ -0,0 +1,54 @@
+#! /usr/bin/env python3
+"""
+Benchmarks the clipping and component finding functions of prof_utils.py for a range of profile lengths.
+Not run as part of the tests. Usage: python bench_prof_utils.py [--nbins 64 1024 65536] [--repeats 20]
+"""
+import argparse
+import timeit
+import numpy as np
+
+import prof_utils
+
+
+def make_profile(nbins, seed=0):
+    """
+    Makes a noisy two component profile with nbins bins
+    """
+    rng = np.random.RandomState(seed)
+    x = np.arange(nbins)
+    prof = np.exp(-(x - 0.3*nbins)**2 / (2*(0.01*nbins)**2)) + 0.5*np.exp(-(x - 0.35*nbins)**2 / (2*(0.02*nbins)**2))
+    return prof + rng.normal(0, 0.03, nbins)
+
+
+def bench(nbins, repeats):
+    """
+    Times each function on a profile of length nbins. Returns the mean time of each function in ms
+    """
+    prof = make_profile(nbins)
+    _, clipped = prof_utils.sigmaClip(prof, alpha=3.)
+    on_pulse = np.where(np.isnan(clipped), prof, 0.)
+    zeroed = np.where(np.isnan(clipped), 0., clipped)
+    search_scope = max(1, nbins//100)
+    min_comp_len = max(5, nbins//100)
+
+    funcs = {"sigmaClip":           lambda: prof_utils.sigmaClip(prof, alpha=3.),
+             "check_clip":          lambda: prof_utils.check_clip(clipped),
+             "fill_clipped_prof":   lambda: prof_utils.fill_clipped_prof(np.copy(zeroed), search_scope=search_scope),
+             "find_components":     lambda: prof_utils.find_components(on_pulse, min_comp_len=min_comp_len),
+             "find_minima_maxima":  lambda: prof_utils.find_minima_maxima(on_pulse, min_comp_len=min_comp_len)}
+    return {name: timeit.timeit(func, number=repeats)/repeats*1e3 for name, func in funcs.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the prof_utils clipping and component finding functions")
+    parser.add_argument("--nbins", type=int, nargs="+", default=[64, 256, 1024, 4096, 16384, 65536], help="The profile lengths")
+    parser.add_argument("--repeats", type=int, default=20, help="The number of times to run each function")
+    args = parser.parse_args()
+
+    names = None
+    for nbins in args.nbins:
+        times = bench(nbins, args.repeats)
+        if names is None:
+            names = list(times.keys())
+            print("{:>8} ".format("nbins") + " ".join("{:>19}".format(name) for name in names) + "   (ms)")
+        print("{:>8} ".format(nbins) + " ".join("{:>19.3f}".format(times[name]) for name in names))
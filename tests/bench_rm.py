@@ -0,0 +1,41 @@
+#! /usr/bin/env python3
+"""
+Benchmarks RM synthesis and RM-CLEAN in rm.py on synthetic multi-component Faraday spectra and checks that the clean
+components match the reference Hogbom clean. Not run as part of the tests.
+Usage: python bench_rm.py [--nchan 3072] [--phi_steps 10000] [--niter 1000]
+"""
+import argparse
+import time
+import numpy as np
+
+from test_rm import synthetic_obs, rmclean_reference
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the rm.py RM synthesis and RM-CLEAN")
+    parser.add_argument("--nchan", type=int, default=3072, help="The number of frequency channels")
+    parser.add_argument("--phi_steps", type=int, default=10000, help="The number of Faraday depths")
+    parser.add_argument("--niter", type=int, default=1000, help="The maximum number of clean iterations")
+    args = parser.parse_args()
+
+    spectra = {"single":    ((40., 1., 0.3),),
+               "blended":   ((40., 1., 0.3), (43., 0.6, 1.2), (-120., 0.4, 2.)),
+               "scattered": ((5., 1., 0.), (200., 0.9, 1.), (-60., 0.3, 0.5), (-62., 0.3, 2.5), (150., 0.2, 1.))}
+    print("{:>10} {:>10} {:>12} {:>14} {:>14} {:>9}".format("spectrum", "synth (s)", "iterations", "clean (it/s)",
+                                                             "ref (it/s)", "same"))
+    for name, rms in spectra.items():
+        p = synthetic_obs(rms=rms, nchan=args.nchan, noise=0.02)
+        start = time.time()
+        p.rmsynthesis(np.linspace(-300, 300, args.phi_steps), verbose=False)
+        synth = time.time() - start
+
+        # very low cutoff so that the clean runs to niter
+        start = time.time()
+        p.rmclean(niter=args.niter, cutoff=-10., verbose=False)
+        clean = time.time() - start
+        start = time.time()
+        modcomp, _, num = rmclean_reference(p, niter=args.niter, cutoff=-10.)
+        ref = time.time() - start
+        same = num == p.niters and np.allclose(p.rm_comps, modcomp, rtol=0, atol=1e-10)
+        print("{:>10} {:>10.3f} {:>12d} {:>14.0f} {:>14.0f} {:>9}".format(name, synth, p.niters, p.niters/clean,
+                                                                          num/ref, str(same)))
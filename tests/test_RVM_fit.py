@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+"""
+Tests the RVM_fit.py script
+"""
+import numpy as np
+from numpy.testing import assert_allclose
+
+import RVM_fit
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def synthetic_pa(alpha, beta, psi_0, phi_0, width=40., npoints=120, pa_e=2., seed=0):
+    """
+    Makes noisy RVM position angles (wrapped to +/- 90 degrees) within width degrees of phi_0. Angles are in degrees, the outputs in radians
+    """
+    rng = np.random.RandomState(seed)
+    x = np.deg2rad(np.linspace(phi_0 - width, phi_0 + width, npoints))
+    PA_e = np.full(npoints, np.deg2rad(pa_e))
+    PA = RVM_fit.wrap_pa(RVM_fit.analytic_pa(x, *np.deg2rad([alpha, beta, psi_0, phi_0])) + rng.normal(0, PA_e))
+    return x, PA, PA_e
+
+
+def test_rvm_grid_fit():
+    """
+    Tests that the global RVM fit reaches the chi-squared of the true parameters, which a single fit from (0, 0, 0, 0) doesn't
+    """
+    print("rvm_grid_fit")
+    for truth in ((40., -8., 20., 180.), (120., 5., -60., 150.), (70., -20., 45., 200.)):
+        x, PA, PA_e = synthetic_pa(*truth)
+        rvm_dict = RVM_fit.rvm_grid_fit(x, PA, PA_e, n_procs=2)
+        if rvm_dict["chi2_grid"].shape != (91, 91) or len(rvm_dict["popt"]) != 4:
+            raise AssertionError()
+        true_chi2 = np.sum((RVM_fit.wrap_pa(PA - RVM_fit.analytic_pa(x, *np.deg2rad(truth)))/PA_e)**2)
+        if rvm_dict["chi2"] > true_chi2 + 1. or not 0.7 < rvm_dict["redchisq"] < 1.3:
+            raise AssertionError()
+        #the surface minimum is near the polished fit
+        i, j = np.unravel_index(np.argmin(rvm_dict["chi2_grid"]), rvm_dict["chi2_grid"].shape)
+        if rvm_dict["chi2_grid"][i, j] > 2*true_chi2:
+            raise AssertionError()
+
+    #well constrained fits recover the parameters
+    assert_allclose(np.rad2deg(rvm_dict["popt"]), (70., -20., 45., -160.), atol=3.)
+    x, PA, PA_e = synthetic_pa(120., 5., -60., 150.)
+    popt, _ = RVM_fit._fit({"X_PA":x, "PA":PA, "PA_e":PA_e, "outfile":None})
+    assert_allclose(np.rad2deg(popt), (120., 5., -60., 150.), atol=2.)
+
+
+def test_rvm_chi2_grid():
+    """
+    Tests that the profiled chi-squared matches the chi-squared of the profiled psi_0 and phi_0
+    """
+    print("rvm_chi2_grid")
+    x, PA, PA_e = synthetic_pa(120., 5., -60., 150.)
+    alphas, betas = np.deg2rad([60., 120.]), np.deg2rad([-30., 5., 40.])
+    phi0s = np.deg2rad(np.arange(-180, 180, 5.))
+    chi2, psi0, phi0 = RVM_fit.rvm_chi2_grid(x, PA, PA_e, alphas, betas, phi0s)
+    for i, alpha in enumerate(alphas):
+        for j, beta in enumerate(betas):
+            residual = RVM_fit.wrap_pa(PA - RVM_fit.analytic_pa(x, alpha, beta, psi0[i, j], phi0[i, j]))
+            assert_allclose(chi2[i, j], np.sum(np.sin(residual)**2/PA_e**2), rtol=1e-8)
+            #no other psi_0 or phi_0 on the grid does better
+            for phi_0 in phi0s:
+                for psi_0 in np.deg2rad(np.arange(-90, 90, 2.)):
+                    residual = RVM_fit.wrap_pa(PA - RVM_fit.analytic_pa(x, alpha, beta, psi_0, phi_0))
+                    if np.sum(np.sin(residual)**2/PA_e**2) < chi2[i, j] - 1e-6:
+                        raise AssertionError()
+    assert_allclose(np.rad2deg(phi0[1, 1]), 150., atol=2.5)
+    assert_allclose(np.rad2deg(psi0[1, 1]), -60., atol=2.)
+
+
+if __name__ == "__main__":
+    """
+    Tests the relevant functions in RVM_fit.py
+    """
+
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+"""
+Tests the pol_batch.py script
+"""
+import os
+import csv
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import assert_allclose
+
+import pol_batch
+import RVM_fit
+from test_prof_utils import write_archive, synthetic_profile
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def rvm_stokes(rm_val, rvm_params, freqs, nbin=256, centre=128, seed=0):
+    """
+    Makes channelised Stokes profiles of a wide, fully linearly polarised gaussian pulse whose position angle follows the RVM
+    (rvm_params in degrees, with phi_0 at the pulse centre) and is Faraday rotated by rm_val
+    """
+    rng = np.random.RandomState(seed)
+    I = synthetic_profile([(1, centre, 14)], nbins=nbin, noise=0.)
+    x = 2*np.pi*np.arange(nbin)/nbin
+    pa = RVM_fit.analytic_pa(x, *np.deg2rad(rvm_params))
+    l2 = (2.998e8/(freqs*1e6))**2
+    angle = 2*(pa[None, :] + rm_val*l2[:, None])
+    stokes = np.array([np.tile(I, (len(freqs), 1)), I*np.cos(angle), I*np.sin(angle), np.zeros((len(freqs), nbin))])
+    return stokes + rng.normal(0, 0.01, stokes.shape)
+
+
+def test_pol_batch():
+    """
+    Tests that the RM and RVM of each archive are recorded and that an unreadable archive doesn't stop the batch
+    """
+    print("pol_batch")
+    freqs = np.linspace(140., 170., 64)
+    l2 = (2.998e8/(freqs*1e6))**2
+    truth = (60., 10., 30., 180.)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rms = {"a.ar":12., "b.ar":-25.}
+        for name, rm_val in rms.items():
+            write_archive(os.path.join(tmp_dir, name), rvm_stokes(rm_val, truth, freqs), freqs, nsub=1)
+        with open(os.path.join(tmp_dir, "c.ar"), "w") as f:
+            f.write("not an archive")
+        archives = [os.path.join(tmp_dir, name) for name in ("a.ar", "b.ar", "c.ar")]
+        outfile = os.path.join(tmp_dir, "pol_batch.csv")
+
+        counts = pol_batch.pol_batch(archives, outfile, n_procs=2, phase_ranges=[0.4, 0.6], phi_range=(-100, 100), phi_steps=2001,\
+                                     n_alpha=46, n_beta=46, n_phi0=36)
+        if counts != {"ok":2, "failed":1, "timeout":0}:
+            raise AssertionError()
+        with open(outfile, newline="") as f:
+            table = {os.path.basename(row["file"]): row for row in csv.DictReader(f)}
+        if table["c.ar"]["status"] != "failed" or not table["c.ar"]["error"]:
+            raise AssertionError()
+        for name, rm_val in rms.items():
+            row = table[name]
+            if row["status"] != "ok" or row["phase_ranges"] != "0.4 0.6" or int(row["n_pa"]) < 20:
+                raise AssertionError()
+            assert_allclose(float(row["rm"]), rm_val, atol=0.1)
+            #the fitted position angles match the truth across the pulse after the channels are derotated,
+            #apart from the offset the error in the RM gives when extrapolated to infinite frequency
+            x = 2*np.pi*np.linspace(0.45, 0.55, 50)
+            fit = [float(row[key]) for key in ("alpha", "beta", "psi_0", "phi_0")]
+            residuals = RVM_fit.wrap_pa(RVM_fit.analytic_pa(x, *np.deg2rad(fit)) - RVM_fit.analytic_pa(x, *np.deg2rad(truth)))
+            offset = (rm_val - float(row["rm"]))*np.mean(l2)
+            if np.max(np.abs(np.rad2deg(residuals - offset))) > 3. or float(row["rvm_redchisq"]) > 2.:
+                raise AssertionError()
+
+        #only the failed archive is retried
+        counts = pol_batch.pol_batch(archives, outfile, phase_ranges=[0.4, 0.6], rvm=False)
+        if counts != {"ok":0, "failed":1, "timeout":0}:
+            raise AssertionError()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    """
+    Tests the relevant functions in pol_batch.py
+    """
+
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
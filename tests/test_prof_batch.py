@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+"""
+Tests the prof_batch.py script
+"""
+import os
+import csv
+import signal
+import shutil
+import tempfile
+
+import prof_batch
+
+import logging
+logger = logging.getLogger(__name__)
+
+bestprofs = ["tests/test_files/1225462936_J0152-1637.bestprof", "tests/test_files/1226062160_J2330-2005.bestprof"]
+
+
+def read_table(outfile):
+    """
+    Reads a profile batch table into a dictionary of rows keyed by file name
+    """
+    with open(outfile, newline="") as f:
+        return {os.path.basename(row["file"]): row for row in csv.DictReader(f)}
+
+
+def test_prof_batch_resume():
+    """
+    Tests that a batch writes a row for every profile, records timeouts and only reruns the unfinished profiles
+    """
+    print("prof_batch_resume")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for bestprof in bestprofs:
+            shutil.copy(bestprof, tmp_dir)
+        profiles = prof_batch.find_profiles([tmp_dir], pattern="*.bestprof")
+        if len(profiles) != 2:
+            raise AssertionError()
+        outfile = os.path.join(tmp_dir, "prof_batch.csv")
+
+        #far too short to fit anything
+        counts = prof_batch.prof_batch(profiles, outfile, timeout=1e-4, use_cache=False)
+        if counts != {"ok":0, "failed":0, "timeout":2}:
+            raise AssertionError()
+
+        #the timed out profiles are retried, one at a time and then all together
+        counts = prof_batch.prof_batch(profiles[:1], outfile, method="analyse")
+        if counts["ok"] != 1:
+            raise AssertionError()
+        counts = prof_batch.prof_batch(profiles, outfile, n_procs=2, method="analyse")
+        if counts != {"ok":1, "failed":0, "timeout":0}:
+            raise AssertionError()
+        table = read_table(outfile)
+        if sorted(table.keys()) != sorted(os.path.basename(f) for f in bestprofs):
+            raise AssertionError()
+        for row in table.values():
+            if row["status"] != "ok" or row["pulsar"] not in ("J0152-1637", "J2330-2005") or float(row["Weq"]) <= 0:
+                raise AssertionError()
+
+        #nothing left to do
+        counts = prof_batch.prof_batch(profiles, outfile, method="analyse")
+        if sum(counts.values()) != 0 or len(read_table(outfile)) != 2:
+            raise AssertionError()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_prof_batch_boxcar():
+    """
+    Tests triaging profiles with the matched filter S/N
+    """
+    print("prof_batch_boxcar")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        outfile = os.path.join(tmp_dir, "prof_batch.csv")
+        counts = prof_batch.prof_batch(bestprofs, outfile, method="boxcar")
+        if counts != {"ok":2, "failed":0, "timeout":0}:
+            raise AssertionError()
+        for row in read_table(outfile).values():
+            if row["method"] != "boxcar" or float(row["sn"]) < 5 or int(row["boxcar_width"]) < 1 or row["Weq"] or row["gaussian_params"]:
+                raise AssertionError()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def crash_on_junk(path, **kwargs):
+    """
+    Analyses a profile with prof_batch.analyse_profile(), except for files named junk* which kill their process
+    """
+    if os.path.basename(path).startswith("junk"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    return prof_batch.analyse_profile(path, **kwargs)
+
+
+def test_run_batch_worker_dies():
+    """
+    Tests that a batch finishes and records the file as failed when its worker process dies
+    """
+    print("run_batch_worker_dies")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        outfile = os.path.join(tmp_dir, "prof_batch.csv")
+        files = bestprofs + [os.path.join(tmp_dir, "junk.bestprof")]
+        counts = prof_batch.run_batch(crash_on_junk, files, outfile, prof_batch.PROF_BATCH_COLUMNS, n_procs=2, method="boxcar")
+        if counts != {"ok":2, "failed":1, "timeout":0}:
+            raise AssertionError()
+        table = read_table(outfile)
+        if len(table) != 3 or table["junk.bestprof"]["status"] != "failed" or "died" not in table["junk.bestprof"]["error"]:
+            raise AssertionError()
+
+        #the same rows when the pool is replaced after every task
+        tasks = [(crash_on_junk, prof_batch.PROF_BATCH_COLUMNS, path, None, {"method":"boxcar"}) for path in map(os.path.abspath, files)]
+        rows = list(prof_batch._pool_results(tasks, 2, tasks_per_pool=1))
+        if sorted(row[:2] for row in rows) != sorted([row["file"], row["status"]] for row in table.values()):
+            raise AssertionError()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    """
+    Tests the relevant functions in prof_batch.py
+    """
+
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
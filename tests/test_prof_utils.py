@@ -0,0 +1,421 @@
+#! /usr/bin/env python3
+"""
+Tests the prof_utils.py script
+"""
+import os
+import tempfile
+from unittest import mock
+import numpy as np
+from numpy.testing import assert_almost_equal, assert_approx_equal, assert_allclose
+
+import prof_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def synthetic_profile(components, nbins=1024, noise=0.03, seed=0):
+    """
+    Makes a noisy profile from a list of (amp, centre, width) gaussian components
+    """
+    rng = np.random.RandomState(seed)
+    x = np.arange(nbins)
+    prof = np.zeros(nbins)
+    for amp, ctr, wid in components:
+        prof += amp * np.exp(-(x - ctr)**2 / (2 * wid**2))
+    return prof + rng.normal(0, noise, nbins)
+
+#A small corpus of real and synthetic profiles
+corpus_profiles = {}
+corpus_profiles["J0152-1637"] = prof_utils.get_from_bestprof("tests/test_files/1225462936_J0152-1637.bestprof")[7]
+corpus_profiles["J2330-2005"] = prof_utils.get_from_bestprof("tests/test_files/1226062160_J2330-2005.bestprof")[7]
+corpus_profiles["double"] = synthetic_profile([(1, 300, 8), (0.5, 340, 15)])
+
+
+def test_auto_gfit_search_options():
+    """
+    Tests that the coarse to fine alpha search, warm starts and incremental gaussian fits agree with the full alpha sweep
+    """
+    print("auto_gfit_search_options")
+    for name, profile in corpus_profiles.items():
+        print(name)
+        exp_dict = prof_utils.auto_gfit(profile, use_cache=False)
+        for kwargs in ({"coarse_to_fine":True}, {"warm_start":True}, {"coarse_to_fine":True, "warm_start":True}, {"incremental":True}):
+            fit_dict = prof_utils.auto_gfit(profile, use_cache=False, **kwargs)
+            if fit_dict["num_gauss"] != exp_dict["num_gauss"]:
+                raise AssertionError()
+            #the widths should agree to a small fraction of a bin
+            assert_almost_equal(fit_dict["W50"], exp_dict["W50"], decimal=1)
+            assert_almost_equal(fit_dict["W10"], exp_dict["W10"], decimal=1)
+
+    #in series, each alpha of a warm started sweep starts from the previous successful alpha's fit
+    calls = []
+    prof_eval_gfit = prof_utils.prof_eval_gfit
+    def record_eval(*args, **kwargs):
+        fit_dict = None
+        try:
+            fit_dict = prof_eval_gfit(*args, **kwargs)
+        finally:
+            calls.append((kwargs["init_params"], fit_dict))
+        return fit_dict
+    with mock.patch.object(prof_utils, "prof_eval_gfit", side_effect=record_eval):
+        prof_utils.auto_gfit(corpus_profiles["double"], use_cache=False, warm_start=True)
+    if len(calls) != 9 or calls[0][0] is not None or calls[-1][0] is None:
+        raise AssertionError()
+    previous = None
+    for init_params, fit_dict in calls:
+        if init_params is not previous:
+            raise AssertionError()
+        if fit_dict is not None:
+            previous = fit_dict["fit_params"]
+
+
+def test_auto_gfit_cache():
+    """
+    Tests that auto_gfit only refits a profile when the profile or the options change and that the cache size is bounded
+    """
+    print("auto_gfit_cache")
+    profile = corpus_profiles["double"]
+    with tempfile.TemporaryDirectory() as tmp_dir,\
+         mock.patch.dict(os.environ, {"VCSTOOLS_CACHE_DIR":tmp_dir}),\
+         mock.patch.object(prof_utils, "_auto_gfit_search", wraps=prof_utils._auto_gfit_search) as search_mock:
+        fit_1 = prof_utils.auto_gfit(profile, coarse_to_fine=True)
+        fit_2 = prof_utils.auto_gfit(list(profile), coarse_to_fine=True)
+        if search_mock.call_count != 1:
+            raise AssertionError()
+        assert_almost_equal(fit_1["W50"], fit_2["W50"])
+        assert_almost_equal(fit_1["gaussian_params"], fit_2["gaussian_params"])
+
+        #different options, a different profile or opting out all refit
+        prof_utils.auto_gfit(profile, coarse_to_fine=True, max_N=4)
+        prof_utils.auto_gfit(profile * 2, coarse_to_fine=True)
+        prof_utils.auto_gfit(profile, coarse_to_fine=True, use_cache=False)
+        prof_utils.auto_gfit(profile, coarse_to_fine=True, incremental=True, min_delta_bic=10.)
+        if search_mock.call_count != 5 or search_mock.call_args[0][2]["min_delta_bic"] != 10.:
+            raise AssertionError()
+        cache_dir = os.path.join(tmp_dir, "prof_fits")
+        if len(os.listdir(cache_dir)) != 4:
+            raise AssertionError()
+
+        #a cache that is smaller than a single fit is emptied
+        with mock.patch.object(prof_utils, "PROF_CACHE_MAX_BYTES", 1):
+            prof_utils.auto_gfit(profile, coarse_to_fine=True, max_N=3)
+        if len([f for f in os.listdir(cache_dir) if f.endswith(".pkl")]) != 0:
+            raise AssertionError()
+
+
+def test_auto_gfit_multires():
+    """
+    Tests that fitting a high resolution profile from a downsampled fit agrees with the full resolution fit
+    """
+    print("auto_gfit_multires")
+    assert_almost_equal(prof_utils.downsample_profile([1, 2, 3, 4, 5, 6, 7], 3), [2, 5, 7])
+    profile = synthetic_profile([(1, 1200, 30), (0.5, 1360, 60)], nbins=4096)
+    if prof_utils._multires_factor(profile, 256) != 8:
+        raise AssertionError()
+    exp_dict = prof_utils.auto_gfit(profile, use_cache=False)
+    with mock.patch.object(prof_utils, "_auto_gfit_search", wraps=prof_utils._auto_gfit_search) as search_mock:
+        fit_dict = prof_utils.auto_gfit(profile, use_cache=False, coarse_nbins=256)
+        #only the downsampled profile is searched
+        if search_mock.call_count != 1 or len(search_mock.call_args[0][0]) != 512:
+            raise AssertionError()
+    if fit_dict["num_gauss"] != exp_dict["num_gauss"] or len(fit_dict["profile"]) != 4096:
+        raise AssertionError()
+    assert_approx_equal(fit_dict["W50"], exp_dict["W50"], significant=3)
+    assert_approx_equal(fit_dict["W10"], exp_dict["W10"], significant=3)
+
+    #a narrow profile isn't downsampled
+    if prof_utils._multires_factor(synthetic_profile([(1, 2000, 3)], nbins=4096), 256) != 1:
+        raise AssertionError()
+
+
+def test_fit_gaussian_early_stop():
+    """
+    Tests that incremental gaussian fits stop early for a simple profile and find the same best fit
+    """
+    print("fit_gaussian_early_stop")
+    profile = synthetic_profile([(1, 500, 10)])
+    exp_fit = prof_utils.fit_gaussian(profile, min_comp_len=12)
+    inc_fit = prof_utils.fit_gaussian(profile, min_comp_len=12, incremental=True)
+    if len(exp_fit[7]) != 5 or len(inc_fit[7]) != 2:
+        raise AssertionError()
+    assert_almost_equal(inc_fit[3], exp_fit[3], decimal=3)
+    assert_almost_equal(inc_fit[2], exp_fit[2], decimal=2)
+
+
+def test_multi_gauss_jacobian():
+    """
+    Tests the analytic Jacobian of multi_gauss against the single component partial derivatives and finite differences
+    """
+    print("multi_gauss_jacobian")
+    x = np.linspace(0, 99, 100)
+    params = [1., 30., 5., 0.4, 60., 12.]
+    J = prof_utils.multi_gauss_jacobian(x, *params)
+    if J.shape != (100, 6):
+        raise AssertionError()
+    for i in range(0, len(params), 3):
+        assert_almost_equal(J[:, i], prof_utils.partial_gauss_dda(x, *params[i:i+3]))
+        assert_almost_equal(J[:, i+1], prof_utils.partial_gauss_ddb(x, *params[i:i+3]))
+        assert_almost_equal(J[:, i+2], prof_utils.partial_gauss_ddc(x, *params[i:i+3]))
+    eps = 1e-6
+    for i, _ in enumerate(params):
+        step = np.zeros(len(params))
+        step[i] = eps
+        diff = (prof_utils.multi_gauss(x, *(params + step)) - prof_utils.multi_gauss(x, *(params - step)))/(2*eps)
+        assert_almost_equal(J[:, i], diff, decimal=6)
+
+
+def write_archive(path, stokes, freqs, period=0.5, dm=2., dedispersed=False, nsub=2, weights=None, rm=0., rm_corrected=True):
+    """
+    Writes a minimal folded PSRFITS archive with coherence products (AABBCRCI) made from the Stokes profiles, which are
+    either shared by every channel (4, nbin) or per channel (4, nchan, nbin).
+    Each channel is dispersed unless dedispersed is True and the channels with a weight of 0 are filled with junk.
+    rm and rm_corrected only set the header and history, the Stokes profiles are written as given
+    """
+    from astropy.io import fits
+    nbin = stokes.shape[-1]
+    nchan = len(freqs)
+    if stokes.ndim == 2:
+        stokes = np.repeat(stokes[:, None, :], nchan, axis=1)
+    if weights is None:
+        weights = np.ones(nchan)
+    I, Q, U, V = stokes
+    coh = np.array([(I + Q)/2, (I - Q)/2, U/2, V/2])
+    shifts = np.zeros(nchan)
+    if not dedispersed:
+        shifts = 4.148808e3 * dm * (freqs**-2 - np.mean(freqs)**-2) / period * nbin
+    chans = prof_utils.rotate_profiles(coh, shifts[None, :])
+    chans[:, weights == 0] = 100.
+    #quantise each channel to int16 like the PSRFITS DATA column
+    offs = chans.min(axis=-1)
+    scl = (chans.max(axis=-1) - offs) / 60000.
+    scl[scl == 0] = 1.
+    data = np.round((chans - offs[..., None]) / scl[..., None] - 30000).astype(np.int16)
+    offs = offs + 30000 * scl
+
+    cols = [fits.Column(name="PERIOD", format="D", array=np.full(nsub, period)),
+            fits.Column(name="DAT_FREQ", format="{}D".format(nchan), array=np.tile(freqs, (nsub, 1))),
+            fits.Column(name="DAT_WTS", format="{}E".format(nchan), array=np.tile(weights, (nsub, 1))),
+            fits.Column(name="DAT_OFFS", format="{}E".format(4*nchan), array=np.tile(offs.ravel(), (nsub, 1))),
+            fits.Column(name="DAT_SCL", format="{}E".format(4*nchan), array=np.tile(scl.ravel(), (nsub, 1))),
+            fits.Column(name="DATA", format="{}I".format(4*nchan*nbin), dim="({},{},4)".format(nbin, nchan),
+                        array=np.repeat(data[None], nsub, axis=0))]
+    subint = fits.BinTableHDU.from_columns(cols, name="SUBINT")
+    subint.header["NBIN"] = nbin
+    subint.header["NCHAN"] = nchan
+    subint.header["NPOL"] = 4
+    subint.header["POL_TYPE"] = "AABBCRCI"
+    subint.header["DM"] = dm
+    subint.header["RM"] = rm
+    history = fits.BinTableHDU.from_columns([fits.Column(name="DEDISP", format="I", array=[int(dedispersed)]),
+                                             fits.Column(name="RM_CORR", format="I", array=[int(rm_corrected)])], name="HISTORY")
+    primary = fits.PrimaryHDU()
+    primary.header["OBSFREQ"] = np.mean(freqs)
+    fits.HDUList([primary, history, subint]).writeto(path, overwrite=True)
+
+
+def test_read_archive():
+    """
+    Tests reading, dedispersing and scrunching a PSRFITS archive
+    """
+    print("read_archive")
+    x = np.arange(256)
+    I = synthetic_profile([(1, 100, 5)], nbins=256, noise=0.)
+    stokes = np.array([I, 0.5*I*np.cos(np.deg2rad(2*(x - 100))), 0.5*I*np.sin(np.deg2rad(2*(x - 100))), 0.1*I])
+    freqs = np.linspace(140., 170., 8)
+    weights = np.ones(8)
+    weights[3] = 0.
+    fd, archive = tempfile.mkstemp(suffix=".ar")
+    os.close(fd)
+    try:
+        write_archive(archive, stokes, freqs, weights=weights)
+        ar_dict = prof_utils.read_archive(archive)
+        if ar_dict["pol_type"] != "IQUV" or ar_dict["nbin"] != 256:
+            raise AssertionError()
+        assert_almost_equal(ar_dict["period"], 500.)
+        for k, name in enumerate("IQUV"):
+            assert_almost_equal(ar_dict[name], stokes[k], decimal=4)
+
+        ar_dict = prof_utils.read_archive(archive, fscrunch=False, tscrunch=False, pscrunch=True)
+        if ar_dict["data"].shape != (2, 1, 8, 256) or ar_dict["I"].shape != (2, 8, 256):
+            raise AssertionError()
+        assert_almost_equal(ar_dict["freqs"], freqs)
+        assert_almost_equal(ar_dict["weights"], np.tile(weights, (2, 1)))
+        #the channels aren't dedispersed unless they are frequency scrunched
+        if np.argmax(ar_dict["I"][0, 0]) <= np.argmax(ar_dict["I"][0, -1]):
+            raise AssertionError()
+        ar_dict = prof_utils.read_archive(archive, fscrunch=False, dedisperse_chans=True)
+        if ar_dict["Q"].shape != (8, 256):
+            raise AssertionError()
+        assert_almost_equal(ar_dict["Q"][weights > 0], np.tile(stokes[1], (7, 1)), decimal=3)
+
+        profile, nbins = prof_utils.get_from_archive(archive)
+        assert_almost_equal(profile, I, decimal=4)
+        I_ar, Q_ar, U_ar, _, nbins = prof_utils.get_stokes_from_archive(archive)
+        if nbins != 256:
+            raise AssertionError()
+        _, PA, PA_e = prof_utils.calc_pa(I_ar, Q_ar, U_ar, sigma=0.01)
+        on = PA != 0
+        if not on[100] or on[0] or np.any(PA_e[on] <= 0):
+            raise AssertionError()
+        assert_almost_equal(PA[on], (x[on] - 100), decimal=2)
+    finally:
+        os.remove(archive)
+
+
+def test_read_archive_rm():
+    """
+    Tests that the channels of an archive whose RM hasn't been corrected are Faraday rotated to the reference frequency before
+    they are frequency scrunched
+    """
+    print("read_archive_rm")
+    x = np.arange(256)
+    I = synthetic_profile([(1, 100, 5)], nbins=256, noise=0.)
+    freqs = np.linspace(140., 170., 16)
+    dl2 = (2.998e8/(freqs*1e6))**2 - (2.998e8/(np.mean(freqs)*1e6))**2
+    rm_val = 30.
+    pa = np.deg2rad(x - 100)[None, :] + rm_val*dl2[:, None]
+    stokes = np.array([np.tile(I, (16, 1)), 0.5*I*np.cos(2*pa), 0.5*I*np.sin(2*pa), np.tile(0.1*I, (16, 1))])
+    fd, archive = tempfile.mkstemp(suffix=".ar")
+    os.close(fd)
+    try:
+        write_archive(archive, stokes, freqs, dedispersed=True, nsub=1, rm=rm_val, rm_corrected=False)
+        ar_dict = prof_utils.read_archive(archive)
+        assert_almost_equal(ar_dict["rm"], rm_val)
+        assert_almost_equal(ar_dict["Q"], 0.5*I*np.cos(np.deg2rad(2*(x - 100))), decimal=3)
+        assert_almost_equal(ar_dict["U"], 0.5*I*np.sin(np.deg2rad(2*(x - 100))), decimal=3)
+        #the channels themselves are left as they are
+        ar_dict = prof_utils.read_archive(archive, fscrunch=False)
+        assert_almost_equal(ar_dict["Q"], stokes[1], decimal=3)
+        #an archive that has already been corrected, or not correcting it, averages the rotated channels
+        for rm_corrected, defaraday in ((True, True), (False, False)):
+            write_archive(archive, stokes, freqs, dedispersed=True, nsub=1, rm=rm_val, rm_corrected=rm_corrected)
+            ar_dict = prof_utils.read_archive(archive, defaraday=defaraday)
+            assert_almost_equal(ar_dict["Q"], np.mean(stokes[1], axis=0), decimal=3)
+            if np.max(np.hypot(ar_dict["Q"], ar_dict["U"])) > 0.45:
+                raise AssertionError()
+    finally:
+        os.remove(archive)
+
+
+def test_calc_pa_baseline():
+    """
+    Tests that calc_pa() removes the off-pulse baselines of Q and U and de-biases L
+    """
+    print("calc_pa_baseline")
+    x = np.arange(1024)
+    I = synthetic_profile([(1, 500, 20)], nbins=1024, noise=0.01)
+    pa = np.deg2rad(0.2*(x - 500))
+    rng = np.random.RandomState(1)
+    Q = 0.6*I*np.cos(2*pa) + 0.05 + rng.normal(0, 0.01, 1024)
+    U = 0.6*I*np.sin(2*pa) - 0.03 + rng.normal(0, 0.01, 1024)
+    L, PA, PA_e = prof_utils.calc_pa(I, Q, U)
+    on = PA != 0
+    #the baseline is 5 sigma so it would pass the threshold everywhere if it weren't removed.
+    #Only the odd noise spike gets through once it is
+    off = np.concatenate([on[:400], on[-400:]])
+    if np.mean(off) > 0.02 or not np.all(on[480:521]):
+        raise AssertionError()
+    assert_allclose(PA[470:531], np.rad2deg(pa[470:531]), atol=2.)
+    if np.any(PA_e[on] <= 0) or np.any(PA_e[~on] != 0):
+        raise AssertionError()
+    #the de-biased off-pulse L averages to less than sigma rather than sigma*sqrt(pi/2)
+    if np.mean(L[:400]) > 0.01 or abs(np.mean(L[480:521]/I[480:521]) - 0.6) > 0.02:
+        raise AssertionError()
+
+
+def test_stack_profiles():
+    """
+    Tests aligning and stacking profiles of different resolutions, shifts and noise levels
+    """
+    print("stack_profiles")
+    #a band limited profile resamples exactly
+    components = [(1, 0.4, 0.02), (0.5, 0.45, 0.01)]
+    fine = synthetic_profile([(a, c*1024, w*1024) for a, c, w in components], nbins=1024, noise=0.)
+    coarse = synthetic_profile([(a, c*256, w*256) for a, c, w in components], nbins=256, noise=0.)
+    assert_almost_equal(prof_utils.resample_profiles(fine, 256), coarse, decimal=6)
+    assert_almost_equal(prof_utils.resample_profiles(coarse[None, :], 1024)[0], fine, decimal=6)
+
+    rng = np.random.RandomState(0)
+    nprof = 300
+    nbins = rng.choice([256, 500, 1024], nprof)
+    #synthetic_profile() doesn't wrap, so keep the pulse away from the edges
+    phases = rng.uniform(-0.3, 0.3, nprof)
+    noises = rng.uniform(0.02, 0.1, nprof)
+    profiles = [synthetic_profile([(a, (c + p)*n, w*n) for a, c, w in components], nbins=n, noise=s, seed=i)\
+                for i, (n, p, s) in enumerate(zip(nbins, phases, noises))]
+    stack_dict = prof_utils.stack_profiles(profiles)
+    if stack_dict["nbin"] != 1024 or len(stack_dict["shifts"]) != nprof:
+        raise AssertionError()
+    #the shifts are relative to the first template, so only their differences are known
+    offsets = stack_dict["shifts"] - phases
+    offsets = (offsets - offsets[0] + 0.5) % 1 - 0.5
+    if np.max(np.abs(offsets))*1024 > 3 or np.std(offsets)*1024 > 1:
+        raise AssertionError()
+    #the S/N of each profile is measured at its own resolution and the stack adds them in quadrature
+    true_sn = np.sqrt(np.sum(fine**2)*nbins/1024)/noises
+    if np.max(np.abs(stack_dict["sn"]/true_sn - 1)) > 0.2 or np.corrcoef(stack_dict["weights"], true_sn)[0, 1] < 0.99:
+        raise AssertionError()
+    assert_approx_equal(stack_dict["sn_stack"], np.sqrt(np.sum(true_sn**2)), significant=2)
+    aligned = prof_utils.rotate_profiles(fine, (phases[0] - stack_dict["shifts"][0])*1024)
+    if np.corrcoef(stack_dict["stack"], aligned)[0, 1] < 0.999:
+        raise AssertionError()
+
+    #aligning to a given template
+    stack_dict = prof_utils.stack_profiles(profiles[:20], nbin=512, template=coarse)
+    offsets = (stack_dict["shifts"] - phases[:20] + 0.5) % 1 - 0.5
+    if stack_dict["stack"].shape != (512,) or np.max(np.abs(offsets))*1024 > 3:
+        raise AssertionError()
+
+
+def test_matched_filter_sn():
+    """
+    Tests the boxcar and gaussian matched filter S/N of a stack of profiles, including pulses that wrap around
+    """
+    print("matched_filter_sn")
+    rng = np.random.RandomState(0)
+    nprof, nbin = 200, 128
+    widths = rng.randint(1, 30, nprof)
+    starts = rng.randint(0, nbin, nprof)
+    amps = rng.uniform(2, 4, nprof)
+    profiles = rng.normal(0, 1, (nprof, nbin)) + 5
+    for i in range(nprof):
+        profiles[i, (starts[i] + np.arange(widths[i])) % nbin] += amps[i]
+    sn_dict = prof_utils.matched_filter_sn(profiles)
+    #a top hat of width W and amplitude A in unit noise has an S/N of A*sqrt(W)
+    ratio = sn_dict["sn"]/(amps*np.sqrt(widths))
+    if not 0.95 < np.median(ratio) < 1.1 or np.median(np.abs(sn_dict["width"]/widths - 1)) > 0.2:
+        raise AssertionError()
+    phase_err = ((sn_dict["phase"] - (starts + (widths - 1)/2)/nbin + 0.5) % 1 - 0.5)*nbin
+    if np.median(np.abs(phase_err)) > 1:
+        raise AssertionError()
+    assert_almost_equal(np.median(sn_dict["baseline"]), 5, decimal=1)
+    assert_almost_equal(np.median(sn_dict["sigma"]), 1, decimal=1)
+    #every width gives the same result
+    all_dict = prof_utils.matched_filter_sn(profiles[:5], widths=np.arange(1, nbin//2))
+    if np.any(all_dict["sn"] < sn_dict["sn"][:5]) or np.any(all_dict["sn"] > 1.1*sn_dict["sn"][:5]):
+        raise AssertionError()
+
+    #pure noise stays low
+    if np.max(prof_utils.matched_filter_sn(rng.normal(0, 1, (nprof, nbin)))["sn"]) > 7:
+        raise AssertionError()
+
+    #gaussian filters on a single gaussian profile
+    profile = synthetic_profile([(1, 300, 8)], noise=0.05)
+    sn_dict = prof_utils.matched_filter_sn(profile, template="gaussian")
+    exp_sn = np.sqrt(np.sum(synthetic_profile([(1, 300, 8)], noise=0.)**2))/0.05
+    assert_approx_equal(sn_dict["sn"], exp_sn, significant=1)
+    if abs(sn_dict["phase"]*1024 - 300) > 1 or abs(sn_dict["width"] - 8*2.355) > 5:
+        raise AssertionError()
+
+
+if __name__ == "__main__":
+    """
+    Tests the relevant functions in prof_utils.py
+    """
+
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+"""
+Tests the rm.py script
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import assert_allclose
+from unittest import mock
+
+import rm
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def synthetic_obs(rms=((40., 1., 0.3), (43., 0.6, 1.2), (-120., 0.4, 2.)), nchan=1024, noise=0.05, seed=0):
+    """
+    Makes a PolObservation of a Faraday spectrum with thin components at the given (RM, amplitude, PA) values
+    """
+    rng = np.random.RandomState(seed)
+    freq = np.linspace(140e6, 170e6, nchan)
+    l2 = (2.998e8/freq)**2
+    qu = sum(amp*np.exp(2j*(pa + rm_val*l2)) for rm_val, amp, pa in rms)
+    q = np.real(qu) + rng.normal(0, noise, nchan)
+    u = np.imag(qu) + rng.normal(0, noise, nchan)
+    i = np.full(nchan, 5.)
+    err = np.full(nchan, noise)
+    return rm.PolObservation(freq, (i, q, u), IQUerr=(err, err, err), verbose=False)
+
+
+def rmclean_reference(p, niter=1000, gain=0.1, cutoff=2., mask=False):
+    """
+    The straightforward Hogbom RM-CLEAN, rolling the RMSF to each peak. Returns the clean components and residuals
+    """
+    noise = np.std(np.real(p.fdf))
+    cleanlim = cutoff*noise + np.median(np.abs(p.fdf))
+    res = p.fdf.copy()
+    modcomp = np.zeros(res.shape, dtype=complex)
+    resp = np.abs(res)
+    mr = range(len(resp))
+    num = 0
+    while max(resp[mr]) > cleanlim and num < niter:
+        maxloc = np.argmax(resp[mr]) + mr[0]
+        if num == 0 and mask:
+            mr = range(max(maxloc - p.rmsf_fwhm_pix//2, 0), min(maxloc + p.rmsf_fwhm_pix//2 + 1, p.nphi))
+        num += 1
+        srmsf = np.roll(p.rmsf, maxloc - p.nphi)
+        modcomp[maxloc] += res[maxloc]*gain
+        res -= res[maxloc]*gain*srmsf[:p.nphi]
+        resp = np.abs(res)
+    return modcomp, res, num
+
+
+def test_faraday_transform():
+    """
+    Tests the chunked and factorised Faraday transforms against a direct sum over channels
+    """
+    print("faraday_transform")
+    rng = np.random.RandomState(2)
+    freq = np.linspace(140e6, 170e6, 300)
+    l2 = (2.998e8/freq)**2
+    dl2 = l2 - np.mean(l2)
+    vals = rng.normal(size=(300, 3)) + 1j*rng.normal(size=(300, 3))
+    regular = np.linspace(-300, 300, 1001)
+    irregular = np.sort(rng.uniform(-300, 300, 257))
+
+    def direct(phi, v):
+        return np.exp(-2j*np.outer(phi, dl2)).dot(v)
+
+    for phi in (regular, irregular, regular[:1], regular[:2]):
+        expected = direct(phi, vals)
+        #the default budget (the factorised kernel for regular phi), a budget that only fits a few rows of the kernel at a time
+        #and one too small for the kernel so the phases are computed a few phi at a time
+        for max_mem in (2**26, 2**20, 2**14):
+            assert_allclose(rm.faraday_transform(phi, dl2, vals[:, 0], max_mem=max_mem), expected[:, 0], rtol=0, atol=1e-9)
+            assert_allclose(rm.faraday_transform(phi, dl2, vals, max_mem=max_mem), expected, rtol=0, atol=1e-9)
+
+    if rm.faraday_transform([], dl2, vals).shape != (0, 3) or rm.faraday_transform(regular, [], []).shape != (1001,):
+        raise AssertionError()
+
+
+def test_rmsynthesis():
+    """
+    Tests the RMSF and FDF against a direct sum over channels
+    """
+    print("rmsynthesis")
+    p = synthetic_obs()
+    phi = np.linspace(-300, 300, 1001)
+    p.rmsynthesis(phi, weightmode="varwt", verbose=False)
+    l2 = (2.998e8/p.freq)**2 - p.l20
+    qu = (p.q + 1j*p.u)*p.weights
+    fdf = np.array([p.K*np.sum(qu*np.exp(-2j*val*l2)) for val in phi])
+    rmsf = np.array([p.K*np.sum(p.weights*np.exp(-2j*val*l2)) for val in p.rmsf_phi])
+    assert_allclose(p.fdf, fdf, rtol=0, atol=1e-12)
+    assert_allclose(p.rmsf, rmsf, rtol=0, atol=1e-12)
+    assert_allclose(p.rmsf[p.nphi], 1.)
+    if abs(phi[np.argmax(np.abs(p.fdf))] - 40.) > 1.:
+        raise AssertionError()
+
+    #irregular phi and a memory budget of only a few phi values at a time
+    irregular = np.sort(np.random.RandomState(1).uniform(-300, 300, 101))
+    fdf = np.array([np.sum(qu*np.exp(-2j*val*l2)) for val in irregular])
+    assert_allclose(rm.faraday_transform(irregular, l2, qu, max_mem=2**16), fdf, rtol=0, atol=1e-9)
+
+
+def test_rmsf_cache():
+    """
+    Tests that the RMSF is reused from memory and from the on-disk cache for the same channels, weights and phi
+    """
+    print("rmsf_cache")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with mock.patch.dict(os.environ, {"VCSTOOLS_CACHE_DIR":tmp_dir}):
+            rm.clear_caches()
+            phi = np.linspace(-100, 100, 401)
+            p = synthetic_obs()
+            p.rmsynthesis(phi, verbose=False, rmsf_disk_cache=True)
+            rmsf = np.array(p.rmsf)
+            if len(os.listdir(os.path.join(tmp_dir, "rmsf"))) != 1:
+                raise AssertionError()
+
+            #a different phase range of the same observation doesn't recompute the RMSF
+            q = synthetic_obs(seed=1)
+            with mock.patch.object(rm, "get_rmsf", wraps=rm.get_rmsf) as get_rmsf, \
+                 mock.patch.object(rm, "faraday_transform", wraps=rm.faraday_transform) as transform:
+                q.rmsynthesis(phi, verbose=False)
+                if get_rmsf.call_count != 1 or transform.call_count != 1 or q.rmsf is not p.rmsf:
+                    raise AssertionError()
+
+            #nor does a new process with the on-disk cache
+            rm.clear_caches()
+            with mock.patch.object(rm, "faraday_transform", wraps=rm.faraday_transform) as transform:
+                q.rmsynthesis(phi, verbose=False, rmsf_disk_cache=True)
+                if transform.call_count != 1:
+                    raise AssertionError()
+            assert_allclose(q.rmsf, rmsf, rtol=0, atol=0)
+
+            #different weights give a different RMSF
+            q.rmsynthesis(phi, verbose=False, weightmode="varwt")
+            q.ierr = q.ierr*np.linspace(1, 2, len(q.ierr))
+            q.rmsynthesis(phi, verbose=False, weightmode="varwt")
+            if np.allclose(q.rmsf, rmsf):
+                raise AssertionError()
+            rm.clear_caches()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_rmclean():
+    """
+    Tests that RM-CLEAN finds the same clean components as the reference Hogbom clean
+    """
+    print("rmclean")
+    for rms, mask in ((((40., 1., 0.3), (43., 0.6, 1.2), (-120., 0.4, 2.)), False),
+                      (((40., 1., 0.3), (43., 0.6, 1.2), (-120., 0.4, 2.)), True),
+                      (((5., 1., 0.), (200., 0.9, 1.), (-60., 0.3, 0.5), (-62., 0.3, 2.5)), False)):
+        p = synthetic_obs(rms=rms)
+        p.rmsynthesis(np.linspace(-300, 300, 2001), verbose=False)
+        p.rmclean(niter=500, mask=mask, verbose=False)
+        modcomp, res, num = rmclean_reference(p, niter=500, mask=mask)
+        if p.niters != num or not np.array_equal(np.flatnonzero(p.rm_comps), np.flatnonzero(modcomp)):
+            raise AssertionError()
+        assert_allclose(p.rm_comps, modcomp, rtol=0, atol=1e-10)
+        assert_allclose(p.rm_resid, res, rtol=0, atol=1e-10)
+        if mask and np.ptp(np.flatnonzero(p.rm_comps)) > p.rmsf_fwhm_pix:
+            raise AssertionError()
+
+    #restoration matches a direct convolution with the clean beam
+    kernel = np.exp(-(p.phi - np.mean(p.phi))**2/(2.*(p.rmsf_fwhm/2.355)**2))
+    if 10*p.rmsf_fwhm_pix <= len(p.phi):
+        kernel = np.exp(-np.arange(-p.rmsf_fwhm*5., p.rmsf_fwhm*5., p.dphi)**2/(2.*(p.rmsf_fwhm/2.355)**2))
+    assert_allclose(p.rm_model, np.convolve(p.rm_comps, kernel, mode="same"), rtol=0, atol=1e-10)
+
+
+if __name__ == "__main__":
+    """
+    Tests the relevant functions in rm.py
+    """
+
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
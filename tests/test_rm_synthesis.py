@@ -0,0 +1,188 @@
+#! /usr/bin/env python3
+"""
+Tests the rm_synthesis.py script
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import assert_allclose
+
+import rm
+import rm_synthesis
+from test_prof_utils import write_archive, synthetic_profile
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def test_rm_synth_cube():
+    """
+    Tests that the per-bin Faraday depth cube matches RM synthesis of each bin and recovers the RM of each bin
+    """
+    print("rm_synth_cube")
+    rng = np.random.RandomState(0)
+    nchan, nbin = 256, 64
+    freq_hz = np.linspace(140e6, 170e6, nchan)
+    l2 = (2.998e8/freq_hz)**2
+    bin_rms = np.linspace(-50., 50., nbin)
+    amp = np.exp(-0.5*((np.arange(nbin) - 32)/8.)**2)
+    qu = amp[None, :]*np.exp(2j*(0.4 + bin_rms[None, :]*l2[:, None]))
+    Q = np.real(qu) + rng.normal(0, 0.01, qu.shape)
+    U = np.imag(qu) + rng.normal(0, 0.01, qu.shape)
+    weights = np.ones(nchan)
+    weights[10:20] = 0.
+    phi_axis = np.linspace(-100, 100, 801)
+
+    cube_dict = rm_synthesis.rm_synth_cube(freq_hz, Q, U, phi_axis, weights=weights)
+    #a budget of a few bins at a time gives the same result
+    chunked = rm_synthesis.rm_synth_cube(freq_hz, Q, U, phi_axis, weights=weights, bins=np.arange(16, 48), max_mem=2**16, keep_cube=False)
+    if cube_dict["fdf"].shape != (nbin, len(phi_axis)) or chunked["fdf"] is not None:
+        raise AssertionError()
+    for key in ("rm", "rm_e", "peak", "pa"):
+        assert_allclose(chunked[key], cube_dict[key][16:48], rtol=1e-9, atol=1e-9)
+
+    good = weights > 0
+    for b in (20, 32, 40):
+        p = rm.PolObservation(freq_hz[good], (np.ones(good.sum()), Q[good, b], U[good, b]), verbose=False)
+        p.rmsynthesis(phi_axis, verbose=False)
+        p.get_fdf_peak(verbose=False)
+        assert_allclose(cube_dict["fdf"][b], p.fdf, rtol=0, atol=1e-10)
+        assert_allclose(cube_dict["rm"][b], p.fdf_peak_rm, rtol=0, atol=1e-8)
+        assert_allclose(cube_dict["rm_e"][b], p.fdf_peak_rm_err, rtol=1e-8)
+        assert_allclose(cube_dict["peak"][b], p.fdf_peak, rtol=1e-8)
+    on = amp > 0.3
+    assert_allclose(cube_dict["rm"][on], bin_rms[on], atol=0.5)
+    assert_allclose(cube_dict["pa"][on], np.rad2deg(0.4), atol=5.)
+
+
+def rotated_stokes(rm_val, freqs, nbin=256, centre=100, seed=0):
+    """
+    Makes channelised Stokes profiles of a gaussian pulse with 50% linear polarisation Faraday rotated by rm_val
+    """
+    rng = np.random.RandomState(seed)
+    I = synthetic_profile([(1, centre, 6)], nbins=nbin, noise=0.)
+    l2 = (2.998e8/(freqs*1e6))**2
+    angle = 2*(0.3 + rm_val*l2)[:, None]
+    stokes = np.array([np.tile(I, (len(freqs), 1)), 0.5*I*np.cos(angle), 0.5*I*np.sin(angle), np.tile(0.1*I, (len(freqs), 1))])
+    return stokes + rng.normal(0, 0.005, stokes.shape)
+
+
+def test_rm_synth_pipe():
+    """
+    Tests RM synthesis of the phase ranges of many archives at once without changing directory
+    """
+    print("rm_synth_pipe")
+    freqs = np.linspace(140., 170., 64)
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        rms = {"a.ar":12., "b.ar":-25.}
+        for name, rm_val in rms.items():
+            write_archive(os.path.join(tmp_dir, name), rotated_stokes(rm_val, freqs), freqs, nsub=1)
+        kwargs = {"work_dir":tmp_dir, "label":None, "phase_ranges":[0.35, 0.43, 0.37, 0.41], "force_single":False,
+                  "cliptype":"regular", "plot":False, "write":True, "keep_QUV":True, "phi_range":(-100, 100), "phi_steps":2001}
+        results = rm_synthesis.rm_synth_pipes([dict(kwargs, archive=name) for name in rms], n_procs=2)
+        if os.getcwd() != cwd:
+            raise AssertionError()
+        for name, (rm_dict, filename) in zip(rms, results):
+            label = name[:-3]
+            if sorted(rm_dict.keys()) != ["0", "1"] or rm_dict["1"]["phase_range"] != (0.37, 0.41):
+                raise AssertionError()
+            for i in rm_dict.keys():
+                assert_allclose(rm_dict[i]["rm"], rms[name], atol=0.1)
+            if filename != os.path.join(tmp_dir, f"{label}_RMsynthesis.txt"):
+                raise AssertionError()
+            read_dict = rm_synthesis.read_rmsynth_out(filename)
+            assert_allclose(read_dict["0"]["rm"], rm_dict["0"]["rm"])
+            freq_hz, I, _, Q, _, U, _ = rm_synthesis.read_rmfit_QUVflux(os.path.join(tmp_dir, f"{label}_1_QUVflux.out"))
+            assert_allclose(freq_hz, freqs*1e6)
+            if np.min(I) <= 0 or np.any(np.hypot(Q, U) > I):
+                raise AssertionError()
+
+        #a single archive through rm_synth_pipe gives the same result
+        rm_dict, _ = rm_synthesis.rm_synth_pipe(dict(kwargs, archive="a.ar", write=False, keep_QUV=False))
+        assert_allclose(rm_dict["0"]["rm"], results[0][0]["0"]["rm"])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+
+def test_rm_synth_cube_pipe():
+    """
+    Tests that the per-bin RM synthesis of an archive removes the baseline of each channel before the S/N cut and the synthesis
+    """
+    print("rm_synth_cube_pipe")
+    freqs = np.linspace(140., 170., 64)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        stokes = rotated_stokes(12., freqs)
+        #offsets in I, Q and U that differ between channels
+        stokes[0] += 10.
+        stokes[1] += np.linspace(0.2, -0.2, len(freqs))[:, None]
+        stokes[2] += 0.1
+        write_archive(os.path.join(tmp_dir, "a.ar"), stokes, freqs, nsub=1)
+        write_archive(os.path.join(tmp_dir, "b.ar"), rotated_stokes(12., freqs), freqs, nsub=1)
+        write_archive(os.path.join(tmp_dir, "c.ar"), stokes, freqs, nsub=1, weights=np.zeros(len(freqs)))
+        kwargs = {"work_dir":tmp_dir, "cube_min_sn":5, "phi_range":(-100, 100), "phi_steps":2001}
+
+        cube_dict, _ = rm_synthesis.rm_synth_cube_pipe(dict(kwargs, archive="a.ar"))
+        exp_dict, _ = rm_synthesis.rm_synth_cube_pipe(dict(kwargs, archive="b.ar"))
+        #only the pulse is above the cut, the same bins as without the baseline
+        if not 0 < len(cube_dict["bins"]) < 64 or list(cube_dict["bins"]) != list(exp_dict["bins"]):
+            raise AssertionError()
+        if 100 not in cube_dict["bins"]:
+            raise AssertionError()
+        #the baseline doesn't contribute to the Faraday spectrum of the bright bins
+        bright = np.abs(cube_dict["bins"] - 100) <= 10
+        assert_allclose(cube_dict["rm"][bright], 12., atol=0.5)
+        assert_allclose(cube_dict["rm"][bright], exp_dict["rm"][bright], atol=0.1)
+
+        #an archive with all of its channels zero weighted falls back to uniform weights
+        cube_dict, _ = rm_synthesis.rm_synth_cube_pipe(dict(kwargs, archive="c.ar", cube_min_sn=None))
+        if len(cube_dict["bins"]) != 256:
+            raise AssertionError()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_coarse_to_fine_phi():
+    """
+    Tests that the coarse-to-fine search finds the peak RM to a fraction of the step of the full search, including very large RMs
+    """
+    print("coarse_to_fine_phi")
+    noise = 0.05
+    for rm_val, nchan, phi_range in ((37.3, 1024, (-300, 300)), (-123.45, 3072, (-300, 300)),
+                                     (-2345.6, 3072, (-1e4, 1e4)), (8765.4, 3072, (-1e4, 1e4))):
+        rng = np.random.RandomState(1)
+        freq_hz = np.linspace(140e6, 170e6, nchan)
+        l2 = (2.998e8/freq_hz)**2
+        qu = np.exp(2j*(0.3 + rm_val*l2))
+        Q = np.real(qu) + rng.normal(0, noise, nchan)
+        U = np.imag(qu) + rng.normal(0, noise, nchan)
+        err = np.full(nchan, noise)
+
+        phi_axis, fdf_noise = rm_synthesis.coarse_to_fine_phi(freq_hz, Q, U, phi_range=phi_range)
+        fwhm = 2.*np.sqrt(3.)/(np.max(l2) - np.min(l2))
+        assert_allclose(np.diff(phi_axis), fwhm/32.)
+        if abs(np.mean(phi_axis) - rm_val) > fwhm/32. or len(phi_axis) > 400:
+            raise AssertionError()
+        #the noise of the FDF is the channel noise over sqrt(nchan)
+        assert_allclose(fdf_noise, noise/np.sqrt(nchan), rtol=0.2)
+
+        rm, rm_e = rm_synthesis.IQU_rm_synth(freq_hz, np.ones(nchan), Q, U, err, err, err, phi_range=phi_range, coarse_to_fine=True)
+        if abs(rm - rm_val) > 5*rm_e or abs(rm - rm_val) > 0.01:
+            raise AssertionError()
+        assert_allclose(rm_e, fwhm/(2.355/(noise/np.sqrt(nchan))), rtol=0.3)
+
+
+if __name__ == "__main__":
+    """
+    Tests the relevant functions in rm_synthesis.py
+    """
+
+    # introspect and run all the functions starting with 'test'
+    for f in dir():
+        if f.startswith('test'):
+            print(f)
+            globals()[f]()
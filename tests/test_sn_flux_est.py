@@ -3,13 +3,20 @@
 Tests the sn_flux_est.py script
 """
 import os
+import csv
+import tempfile
+from unittest import mock
 from numpy.testing import assert_almost_equal
 import mwa_metadb_utils
 import psrqpy
+import numpy as np
+import pandas as pd
+from astropy.table import Table
 
 from vcstools import data_load
 
 import sn_flux_est as snfe
+import submit_to_database
 
 import logging
 logger = logging.getLogger(__name__)
@@ -174,6 +181,203 @@ def test_est_pulsar_sn():
         assert_almost_equal(exp_sn_err, sn_err, decimal=2)
 
 
+def test_multi_psr_snfe():
+    """
+    Tests that multi_psr_snfe, which shares an ObservationContext between pulsars,
+    gives the same results as estimating each pulsar on its own
+    """
+    print("multi_psr_snfe")
+    obsid = 1225713560
+    pulsar_list = ["J2241-5236"]
+    md = md_dict[str(obsid)][0]
+    full_md = md_dict[str(obsid)][1]
+
+    obs_context = snfe.ObservationContext(obsid, obs_metadata=md, full_meta=full_md)
+    sn_dict = snfe.multi_psr_snfe(pulsar_list, obsid, obs_context=obs_context)
+    for psr in pulsar_list:
+        exp_sn, exp_sn_err = snfe.est_pulsar_sn(psr, obsid, beg=obs_context.beg, end=obs_context.end,\
+                                                obs_metadata=md, full_meta=full_md)
+        assert_almost_equal(exp_sn, sn_dict[psr][0], decimal=4)
+        assert_almost_equal(exp_sn_err, sn_dict[psr][1], decimal=4)
+    #the sky temperature should only have been calculated once for the centre frequency
+    if len(obs_context.t_sky) != 1:
+        raise AssertionError()
+
+
+def test_tsky_cache_key():
+    """
+    Tests that tsky_cache_key bins LSTs within the tolerance and wraps at 24 hours
+    """
+    print("tsky_cache_key")
+    delays = [[0]*16, [0]*16]
+    key_1 = snfe.tsky_cache_key(delays, 154.24, "analytic", 10.02, lst_tol=0.1)
+    key_2 = snfe.tsky_cache_key(delays, 154.24, "analytic", 9.98, lst_tol=0.1)
+    key_3 = snfe.tsky_cache_key(delays, 154.24, "analytic", 10.2, lst_tol=0.1)
+    key_4 = snfe.tsky_cache_key(delays, 154.24, "analytic", 23.99, lst_tol=0.1)
+    key_5 = snfe.tsky_cache_key(delays, 154.24, "analytic", 0.01, lst_tol=0.1)
+    if key_1 != key_2 or key_1 == key_3 or key_4 != key_5:
+        raise AssertionError()
+
+
+def test_est_pulsar_sn_beam_track_once():
+    """
+    Tests that the beam track, beam power and zenith angle of a pulsar are only computed once per S/N estimate
+    """
+    print("est_pulsar_sn_beam_track_once")
+    obsid = 1222697776
+    pulsar = "J2330-2005"
+    md = md_dict[str(obsid)][0]
+    full_md = md_dict[str(obsid)][1]
+    obs_context = snfe.ObservationContext(obsid, obs_metadata=md, full_meta=full_md)
+
+    with mock.patch.object(snfe.fpio, "find_sources_in_obs", wraps=snfe.fpio.find_sources_in_obs) as track_mock,\
+         mock.patch.object(snfe.fpio, "get_beam_power_over_time", wraps=snfe.fpio.get_beam_power_over_time) as power_mock,\
+         mock.patch.object(snfe.mwa_metadb_utils, "mwa_alt_az_za", wraps=snfe.mwa_metadb_utils.mwa_alt_az_za) as za_mock:
+        exp_sn, exp_sn_err = snfe.est_pulsar_sn(pulsar, obsid, obs_context=obs_context)
+        #find_sources_in_obs calls get_beam_power_over_time once for the track,
+        #so the beam power over the pulsar's time in the beam is the only other call
+        if track_mock.call_count != 1 or power_mock.call_count != 2 or za_mock.call_count != 1:
+            raise AssertionError()
+        #a second estimate with the same context should reuse the track, beam power and zenith angle
+        sn, sn_err = snfe.est_pulsar_sn(pulsar, obsid, obs_context=obs_context)
+        if track_mock.call_count != 1 or power_mock.call_count != 2 or za_mock.call_count != 1:
+            raise AssertionError()
+        #a different time range is a different coverage
+        enter, leave, _ = snfe.find_times(obsid, pulsar, obs_context=obs_context)
+        snfe.find_t_sys_gain(pulsar, obsid, beg=enter, end=enter + (leave - enter)/2, obs_context=obs_context)
+        if power_mock.call_count != 3 or za_mock.call_count != 2:
+            raise AssertionError()
+    assert_almost_equal(exp_sn, sn, decimal=6)
+    assert_almost_equal(exp_sn_err, sn_err, decimal=6)
+
+
+def test_trec():
+    """
+    Tests that the vectorised trec agrees with get_Trec for every coarse channel
+    """
+    print("trec")
+    tab = Table.read(data_load.TRCVR_FILE, format="csv")
+    freqs = np.arange(1, 256) * 1.28
+    t_recs = submit_to_database.trec(freqs)
+    for freq, t_rec in zip(freqs, t_recs):
+        assert_almost_equal(t_rec, submit_to_database.get_Trec(tab, freq), decimal=6)
+    #outside the table
+    if submit_to_database.trec(1000.) != 0.:
+        raise AssertionError()
+
+
+def test_est_pulsar_flux_array():
+    """
+    Tests that the array flux and W50 estimates match the single pulsar functions
+    """
+    print("est_pulsar_flux_array")
+    query = {"PSRJ":["J0000+0001", "J0000+0002", "J0000+0003", "J0000+0004"],
+             "P0":[0.5, 0.003, 1.2, 0.8],
+             "W50":[20., np.nan, 35., np.nan],
+             "W50_ERR":[1., np.nan, np.nan, np.nan],
+             "SPINDX":[np.nan]*4, "SPINDX_ERR":[np.nan]*4}
+    for flux_query in snfe.ATNF_FLUX_QUERIES:
+        query[flux_query] = [np.nan]*4
+        query[flux_query+"_ERR"] = [np.nan]*4
+    #a power law with errors, a power law without errors, a single flux and no fluxes
+    query["S150"] = [100., 40., np.nan, np.nan]
+    query["S150_ERR"] = [10., np.nan, np.nan, np.nan]
+    query["S400"] = [30., 10., 5., np.nan]
+    query["S400_ERR"] = [3., 0., np.nan, np.nan]
+    query["S1400"] = [2., 1.5, np.nan, np.nan]
+    query["S1400_ERR"] = [0.4, np.nan, np.nan, np.nan]
+    query = pd.DataFrame(query)
+    metadata = [None, None, None, None, None, 154.24, None]
+
+    flux, flux_err, _, _ = snfe.est_pulsar_flux_array(query, 154.24e6)
+    w50, w50_err = snfe.find_pulsar_w50_array(query)
+    for i, pulsar in enumerate(query["PSRJ"]):
+        psr_query = {key:[query[key][i]] for key in query.keys()}
+        exp_flux, exp_flux_err = snfe.est_pulsar_flux(pulsar, None, metadata=metadata, query=psr_query)
+        if exp_flux is None:
+            if not np.isnan(flux[i]):
+                raise AssertionError()
+        else:
+            assert_almost_equal(flux[i], exp_flux, decimal=6)
+            assert_almost_equal(flux_err[i], exp_flux_err, decimal=6)
+        exp_w50, exp_w50_err = snfe.find_pulsar_w50(pulsar, query=psr_query)
+        assert_almost_equal(w50[i], exp_w50, decimal=8)
+        assert_almost_equal(w50_err[i], exp_w50_err, decimal=8)
+
+
+def test_sn_grid_resume():
+    """
+    Tests that sn_grid skips the completed observations and drops the rows of interrupted ones
+    """
+    print("sn_grid_resume")
+    def fake_sn_grid_obs(obsid):
+        return obsid, [[obsid, "J0000+0000", 0., 1., 100., 0.1, 0.01, 0.01, 0.001, 10., 1.]]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        outfile = os.path.join(tmp_dir, "sn_grid.csv")
+        #an interrupted run: 1 finished and 2 was half written
+        with open(outfile, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(snfe.SN_GRID_COLUMNS)
+            writer.writerow([1, "J0000+0000", 0., 1., 100., 0.1, 0.01, 0.01, 0.001, 10., 1.])
+            writer.writerow([2, "J0000+0000", 0., 1., 100., 0.1, 0.01, 0.01, 0.001, 10., 1.])
+        with open(outfile + ".done", "w") as f:
+            f.write("1\n")
+
+        with mock.patch.object(snfe, "_sn_grid_obs", side_effect=fake_sn_grid_obs) as obs_mock:
+            failed = snfe.sn_grid([1, 2, 3], outfile, query={"PSRJ":["J0000+0000"]})
+        if failed or obs_mock.call_count != 2:
+            raise AssertionError()
+        if snfe.read_sn_grid_checkpoint(outfile) != {1, 2, 3}:
+            raise AssertionError()
+        with open(outfile) as f:
+            obsids = [int(row[0]) for row in list(csv.reader(f))[1:]]
+        if sorted(obsids) != [1, 2, 3]:
+            raise AssertionError()
+
+
+def test_spectral_model_cache():
+    """
+    Tests that a pulsar's spectral model is fit once per catalogue version and that the cache is only loaded once per version
+    """
+    print("spectral_model_cache")
+    query = {"PSRJ":["J0000+0010"], "SPINDX":[np.nan], "SPINDX_ERR":[np.nan]}
+    for flux_query in snfe.ATNF_FLUX_QUERIES:
+        query[flux_query] = [np.nan]
+        query[flux_query+"_ERR"] = [np.nan]
+    query["S150"] = [100.]
+    query["S400"] = [30.]
+    metadata = [None, None, None, None, None, 154.24, None]
+
+    with tempfile.TemporaryDirectory() as tmp_dir,\
+         mock.patch.dict(os.environ, {"VCSTOOLS_CACHE_DIR":tmp_dir}),\
+         mock.patch.object(snfe, "_spectral_model_cache", None),\
+         mock.patch.object(snfe, "catalogue_version", return_value="version_1"),\
+         mock.patch.object(snfe, "fit_spectral_model", wraps=snfe.fit_spectral_model) as fit_mock,\
+         mock.patch.object(snfe, "_load_spectral_model_cache", wraps=snfe._load_spectral_model_cache) as load_mock,\
+         mock.patch.object(snfe.psrqpy, "QueryATNF") as query_mock:
+        flux_1 = snfe.est_pulsar_flux("J0000+0010", None, metadata=metadata, query=query, save_cache=False)
+        #the cached model is used as is, without querying the catalogue
+        flux_2 = snfe.est_pulsar_flux("J0000+0010", None, metadata=metadata)
+        if fit_mock.call_count != 1 or load_mock.call_count != 1 or query_mock.call_count != 0:
+            raise AssertionError()
+        assert_almost_equal(flux_1, flux_2)
+        if os.path.exists(snfe._spectral_model_cache_file("version_1")):
+            raise AssertionError()
+        snfe.save_spectral_model_cache()
+        if not os.path.exists(snfe._spectral_model_cache_file("version_1")):
+            raise AssertionError()
+
+        #a new catalogue version refits
+        query["S400"] = [20.]
+        snfe.catalogue_version.return_value = "version_2"
+        snfe.est_pulsar_flux("J0000+0010", None, metadata=metadata, query=query)
+        if fit_mock.call_count != 2 or load_mock.call_count != 2:
+            raise AssertionError()
+        if os.path.exists(snfe._spectral_model_cache_file("version_1")):
+            raise AssertionError()
+
+
 if __name__ == "__main__":
     """
     Tests the relevant functions in sn_flux_est.py
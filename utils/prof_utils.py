@@ -6,7 +6,10 @@ import sys
 import os
 import subprocess
 import logging
+import multiprocessing
 import argparse
+import hashlib
+import json
 from scipy.interpolate import UnivariateSpline
 import matplotlib
 matplotlib.use('Agg')
@@ -14,8 +17,15 @@ import matplotlib.pyplot as plt
 from astropy.time import Time
 from scipy.optimize import curve_fit
 
+from vcstools import cache_utils
+
 logger = logging.getLogger(__name__)
 
+#Increase this whenever a change to the fitting code changes the results of auto_gfit() so old cached fits aren't used
+PROF_CACHE_VERSION = 1
+#The maximum size of the auto_gfit() cache in bytes
+PROF_CACHE_MAX_BYTES = 200 * 1024**2
+
 #---------------------------------------------------------------
 class LittleClipError(Exception):
     """Raise when not enough data is clipped"""
@@ -197,6 +207,285 @@ def get_stokes_from_ascii(file_loc):
 
     return [I, Q, U, V, len(I)]
 
+#---------------------------------------------------------------
+def _archive_period(hdulist, subint):
+    """
+    Finds the folding period of a PSRFITS archive in ms from the SUBINT PERIOD column or the POLYCO table. None if unavailable
+    """
+    if "PERIOD" in subint.columns.names:
+        return float(subint.data["PERIOD"][0]) * 1e3
+    if "POLYCO" in hdulist and len(hdulist["POLYCO"].data) > 0:
+        return 1e3 / float(hdulist["POLYCO"].data["REF_F0"][-1])
+    return None
+
+def _archive_dedispersed(hdulist):
+    """
+    Checks the HISTORY table of a PSRFITS archive to see if it has been dedispersed. Assumes it has if there is no history
+    """
+    if "HISTORY" in hdulist and len(hdulist["HISTORY"].data) > 0 and "DEDISP" in hdulist["HISTORY"].columns.names:
+        return bool(hdulist["HISTORY"].data["DEDISP"][-1])
+    return True
+
+def _archive_rm_corrected(hdulist):
+    """
+    Checks the HISTORY table of a PSRFITS archive to see if its Faraday rotation has been corrected. Assumes it has if there is no history
+    """
+    if "HISTORY" in hdulist and len(hdulist["HISTORY"].data) > 0 and "RM_CORR" in hdulist["HISTORY"].columns.names:
+        return bool(hdulist["HISTORY"].data["RM_CORR"][-1])
+    return True
+
+def rotate_profiles(data, shifts):
+    """
+    Rotates profiles by a (fractional) number of bins using a Fourier shift
+
+    Parameters:
+    -----------
+    data: numpy.array
+        The profiles. The last axis is the phase bins
+    shifts: numpy.array
+        The number of bins to rotate each profile by. Must broadcast against data[..., 0]
+
+    Returns:
+    --------
+    data: numpy.array
+        The rotated profiles
+    """
+    nbin = data.shape[-1]
+    harmonics = np.fft.rfftfreq(nbin) * nbin
+    phasors = np.exp(-2j * np.pi * np.asarray(shifts)[..., None] * harmonics / nbin)
+    return np.fft.irfft(np.fft.rfft(data, axis=-1) * phasors, n=nbin, axis=-1)
+
+def read_archive(archive, fscrunch=True, tscrunch=True, pscrunch=False, stokes=True, dedisperse=True, dedisperse_chans=False,\
+                 defaraday=True):
+    """
+    Reads a folded PSRFITS archive without PSRCHIVE. The DATA column is memory mapped and each sub-integration
+    is scaled by DAT_SCL and DAT_OFFS one at a time. Scrunching is a weighted mean using DAT_WTS, like pam/pdv -F, -T and -p.
+    Like PSRCHIVE, the channels are dedispersed and Faraday rotated to the reference frequency before they are frequency scrunched
+    if the archive hasn't already been corrected.
+
+    Parameters:
+    -----------
+    archive: string
+        The path of the PSRFITS archive
+    fscrunch: boolean
+        OPTIONAL - Average over the frequency channels (pdv -F). Default: True
+    tscrunch: boolean
+        OPTIONAL - Average over the sub-integrations (pdv -T). Default: True
+    pscrunch: boolean
+        OPTIONAL - Only keep the total intensity (pdv -p). Default: False
+    stokes: boolean
+        OPTIONAL - Convert coherence products (AABBCRCI) to Stokes parameters (IQUV). Default: True
+    dedisperse: boolean
+        OPTIONAL - If the archive isn't dedispersed, rotate the channels to the centre frequency before frequency scrunching. Default: True
+    dedisperse_chans: boolean
+        OPTIONAL - If the archive isn't dedispersed, also rotate the channels when they aren't frequency scrunched. Default: False
+    defaraday: boolean
+        OPTIONAL - If the archive's RM hasn't been corrected (HISTORY RM_CORR), rotate the Stokes Q and U of each channel
+        to the reference frequency before frequency scrunching. Default: True
+
+    Returns:
+    --------
+    ar_dict: dictionary
+        contains keys:
+        data: numpy.array
+            The profiles with shape (nsub, npol, nchan, nbin). Scrunched axes have length 1
+        weights: numpy.array
+            The summed weights with shape (nsub, nchan)
+        freqs: numpy.array
+            The centre frequency of each channel in MHz with shape (nchan,)
+        pol_type: string
+            The polarisation state of data, e.g. 'IQUV', 'AABBCRCI' or 'INTEN'
+        I, Q, U, V: numpy.array
+            data[:, k] for each Stokes parameter, squeezed of scrunched axes. Only the ones available are included
+        period: float
+            The folding period in ms. None if unavailable
+        dm: float
+            The dispersion measure
+        rm: float
+            The rotation measure in rad/m^2 from the SUBINT header
+        nbin: int
+            The number of bins in the profile
+    """
+    from astropy.io import fits
+
+    with fits.open(archive, memmap=True) as hdulist:
+        subint = hdulist["SUBINT"]
+        header = subint.header
+        nbin = header["NBIN"]
+        nchan = header["NCHAN"]
+        npol = header["NPOL"]
+        pol_type = header["POL_TYPE"].strip()
+        dm = header.get("DM", hdulist[0].header.get("CHAN_DM", 0.))
+        rm = header.get("RM", 0.)
+        period = _archive_period(hdulist, subint)
+
+        raw = subint.data.field("DATA")
+        nsub = raw.shape[0]
+        raw = raw.reshape(nsub, npol, nchan, nbin)
+        scl = np.asarray(subint.data.field("DAT_SCL"), dtype=np.float64).reshape(nsub, -1, nchan)[:, :npol]
+        offs = np.asarray(subint.data.field("DAT_OFFS"), dtype=np.float64).reshape(nsub, -1, nchan)[:, :npol]
+        wts = np.asarray(subint.data.field("DAT_WTS"), dtype=np.float64).reshape(nsub, nchan)
+        freqs = np.asarray(subint.data.field("DAT_FREQ"), dtype=np.float64).reshape(nsub, nchan)[0]
+
+        shifts = None
+        if (fscrunch and dedisperse or not fscrunch and dedisperse_chans) and nchan > 1 and not _archive_dedispersed(hdulist):
+            if period is None:
+                logger.warning("No period found in {}. Not dedispersing the channels".format(archive))
+            else:
+                ref_freq = hdulist[0].header.get("OBSFREQ", np.mean(freqs))
+                delays = 4.148808e3 * dm * (freqs**-2 - ref_freq**-2) #s
+                shifts = -delays / (period / 1e3) * nbin
+
+        coherence = pol_type.startswith("AABB")
+        convert = (stokes or pscrunch) and coherence
+        faraday = None
+        if fscrunch and defaraday and rm and nchan > 1 and npol == 4 and not pscrunch and not _archive_rm_corrected(hdulist):
+            if coherence and not convert:
+                logger.warning("Can't correct the Faraday rotation of the coherence products in {}".format(archive))
+            else:
+                ref_freq = hdulist[0].header.get("OBSFREQ", np.mean(freqs))
+                dl2 = (2.998e8/(freqs*1e6))**2 - (2.998e8/(ref_freq*1e6))**2
+                faraday = np.exp(-2j * rm * dl2)
+        out_pol = 1 if pscrunch else npol
+        out_nsub = 1 if tscrunch else nsub
+        out_nchan = 1 if fscrunch else nchan
+        data = np.zeros((out_nsub, out_pol, out_nchan, nbin))
+        weights = np.zeros((out_nsub, out_nchan))
+        for isub in range(nsub):
+            prof = raw[isub] * scl[isub, :, :, None] + offs[isub, :, :, None]
+            if convert:
+                #AA, BB, Re(AB*), Im(AB*) -> I, Q, U, V
+                stokes_prof = [prof[0] + prof[1], prof[0] - prof[1]]
+                if npol == 4:
+                    stokes_prof += [2*prof[2], 2*prof[3]]
+                prof = np.array(stokes_prof)
+            if pscrunch:
+                prof = prof[:1]
+            if shifts is not None:
+                prof = rotate_profiles(prof, shifts)
+            if faraday is not None:
+                #Q + iU of each channel
+                lin = (prof[1] + 1j*prof[2]) * faraday[:, None]
+                prof[1], prof[2] = np.real(lin), np.imag(lin)
+            w = wts[isub]
+            osub = 0 if tscrunch else isub
+            if fscrunch:
+                data[osub, :, 0] += np.sum(prof * w[None, :, None], axis=1)
+                weights[osub, 0] += np.sum(w)
+            else:
+                data[osub] += prof * w[None, :, None]
+                weights[osub] += w
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data = np.where(weights[:, None, :, None] > 0, data / weights[:, None, :, None], 0.)
+
+    if fscrunch:
+        chan_wts = np.sum(wts, axis=0)
+        freqs = np.array([np.average(freqs, weights=chan_wts) if np.sum(chan_wts) > 0 else np.mean(freqs)])
+    if pscrunch:
+        pol_type = "INTEN"
+    elif convert:
+        pol_type = "IQUV" if npol == 4 else "IQ"
+    ar_dict = {"data":data, "weights":weights, "freqs":freqs, "pol_type":pol_type, "period":period, "dm":dm, "rm":rm, "nbin":nbin}
+    if pol_type in ("IQUV", "IQ", "INTEN"):
+        squeeze_axes = tuple(axis for axis, scrunched in ((0, tscrunch), (1, fscrunch)) if scrunched)
+        for k, name in enumerate(pol_type[:data.shape[1]] if pol_type != "INTEN" else "I"):
+            ar_dict[name] = np.squeeze(data[:, k], axis=squeeze_axes)
+    return ar_dict
+
+def get_from_archive(archive):
+    """
+    Retrieves the frequency and time scrunched total intensity profile from a PSRFITS archive.
+    The equivalent of running subprocess_pdv() and get_from_ascii()
+
+    Parameters:
+    -----------
+    archive: string
+        The path of the PSRFITS archive
+
+    Returns:
+    --------
+    [profile, len(profile)]: list
+        profile: numpy.array
+            The profile data
+        len(profile): int
+            The number of bins in the profile
+    """
+    profile = read_archive(archive, pscrunch=True)["I"]
+    return [profile, len(profile)]
+
+def get_stokes_from_archive(archive):
+    """
+    Retrieves all of the frequency and time scrunched Stokes profiles from a PSRFITS archive.
+    The equivalent of running subprocess_pdv() and get_stokes_from_ascii()
+
+    Parameters:
+    -----------
+    archive: string
+        The path of the PSRFITS archive
+
+    Returns:
+    --------
+    [I, Q, U, V, len(profile)]: list
+        I: numpy.array
+            Stokes I
+        Q: numpy.array
+            Stokes Q
+        U: numpy.array
+            Stokes U
+        V: numpy.array
+            Stokes V
+        len(profile): int
+            The number of bins in the profile
+    """
+    ar_dict = read_archive(archive)
+    if ar_dict["pol_type"] != "IQUV":
+        raise ValueError("Archive {0} does not contain full polarisation data. Polarisation type: {1}".format(archive, ar_dict["pol_type"]))
+    return [ar_dict["I"], ar_dict["Q"], ar_dict["U"], ar_dict["V"], ar_dict["nbin"]]
+
+def calc_pa(I, Q, U, sigma=None, min_sn=3.):
+    """
+    Calculates the linear polarisation and position angle of each bin like pdv -lZ.
+    The off-pulse means of Q and U are subtracted first and L is de-biased (Wardle & Kronberg 1974) before the threshold
+
+    Parameters:
+    -----------
+    I: numpy.array
+        Stokes I
+    Q: numpy.array
+        Stokes Q
+    U: numpy.array
+        Stokes U
+    sigma: float
+        OPTIONAL - The off-pulse noise of Stokes I. If None, will use sigmaClip(). Default: None
+    min_sn: float
+        OPTIONAL - Bins with a linear polarisation below min_sn*sigma have a position angle and error of 0. Default: 3
+
+    Returns:
+    --------
+    L: numpy.array
+        The de-biased linear polarisation
+    PA: numpy.array
+        The position angle in degrees
+    PA_e: numpy.array
+        The uncertainty in the position angle in degrees
+    """
+    I, Q, U = np.asarray(I, dtype=float), np.asarray(Q, dtype=float), np.asarray(U, dtype=float)
+    clip_sigma, clipped = sigmaClip(I)
+    if sigma is None:
+        sigma = clip_sigma
+    #remove the baselines of Q and U using the bins sigmaClip() keeps as noise
+    off_pulse = ~np.isnan(clipped)
+    if np.sum(off_pulse) > 1:
+        Q = Q - np.mean(Q[off_pulse])
+        U = U - np.mean(U[off_pulse])
+    L = np.hypot(Q, U)
+    L = np.sqrt(np.clip(L**2 - sigma**2, 0., None))
+    sig = L > min_sn * sigma
+    PA = np.where(sig, np.rad2deg(0.5 * np.arctan2(U, Q)), 0.)
+    with np.errstate(divide="ignore"):
+        PA_e = np.where(sig, np.rad2deg(0.5 * sigma / L), 0.)
+    return L, PA, PA_e
+
 #---------------------------------------------------------------
 def sigmaClip(data, alpha=3., tol=0.1, ntrials=10):
     """
@@ -224,33 +513,199 @@ def sigmaClip(data, alpha=3., tol=0.1, ntrials=10):
     x: list
         The data list that contains only noise, with nans in place of 'real' data
     """
-    x = np.copy(data)
-    oldstd = np.nanstd(x)
-    #When the x[x<lolim] and x[x>hilim] commands encounter a nan it produces a
-    #warning. This is expected because it is ignoring flagged data from a
-    #previous trial so the warning is supressed.
-    old_settings = np.seterr(all='ignore')
-    for trial in range(ntrials):
-        median = np.nanmedian(x)
-        lolim = median - alpha * oldstd
-        hilim = median + alpha * oldstd
-        x[x<lolim] = np.nan
-        x[x>hilim] = np.nan
-
-        newstd = np.nanstd(x)
-        tollvl = (oldstd - newstd) / newstd
-
-        if tollvl <= tol:
-            logger.debug("Took {0} trials to reach tolerance".format(trial+1))
-            np.seterr(**old_settings)
-            return oldstd, x
-
-        if trial + 1 == ntrials:
-            logger.info("Reached number of trials without reaching tolerance level")
-            np.seterr(**old_settings)
-            return oldstd, x
-
-        oldstd = newstd
+    x = np.array(data, dtype=float)
+    #Work on the unclipped values only. keep flags which of the original values these are
+    keep = ~np.isnan(x)
+    noise = x[keep]
+    #The std of an empty array is a nan. This is handled by the tolerance check so the warnings are supressed.
+    with np.errstate(all='ignore'):
+        oldstd = np.std(noise)
+        for trial in range(ntrials):
+            median = np.median(noise)
+            lolim = median - alpha * oldstd
+            hilim = median + alpha * oldstd
+            in_lims = (noise >= lolim) & (noise <= hilim)
+            keep[keep] = in_lims
+            noise = noise[in_lims]
+
+            newstd = np.std(noise)
+            tollvl = (oldstd - newstd) / newstd
+
+            if tollvl <= tol:
+                logger.debug("Took {0} trials to reach tolerance".format(trial+1))
+                break
+
+            if trial + 1 == ntrials:
+                logger.info("Reached number of trials without reaching tolerance level")
+                break
+
+            oldstd = newstd
+
+    x[~keep] = np.nan
+    return oldstd, x
+
+#---------------------------------------------------------------
+def resample_profiles(profiles, nbin):
+    """
+    Resamples profiles to a different number of bins in the Fourier domain by truncating or zero padding their harmonics.
+    The mean of each profile is kept
+
+    Parameters:
+    -----------
+    profiles: numpy.array
+        The profiles. The last axis is the phase bins
+    nbin: int
+        The number of bins to resample to
+
+    Returns:
+    --------
+    resampled: numpy.array
+        The resampled profiles with nbin bins
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    nbin_in = profiles.shape[-1]
+    if nbin_in == nbin:
+        return profiles.copy()
+    spectra = np.fft.rfft(profiles, axis=-1)
+    nharm = min(spectra.shape[-1], nbin//2 + 1)
+    resampled = np.zeros(profiles.shape[:-1] + (nbin//2 + 1,), dtype=complex)
+    resampled[..., :nharm] = spectra[..., :nharm]
+    if nbin > nbin_in and nbin_in % 2 == 0:
+        #the Nyquist harmonic of the input is shared between the positive and negative frequencies
+        resampled[..., nbin_in//2] *= 0.5
+    return np.fft.irfft(resampled, n=nbin, axis=-1) * nbin / nbin_in
+
+def fourier_shifts(profiles, template, n_newton=5):
+    """
+    Measures the shift of each profile relative to a template in bins. The cross-correlation is found with an FFT
+    and its peak is refined to a fraction of a bin from the Fourier phase gradient of the cross spectrum (Taylor 1992)
+
+    Parameters:
+    -----------
+    profiles: numpy.array
+        The profiles with shape (nprof, nbin)
+    template: numpy.array
+        The template with nbin bins
+    n_newton: int
+        OPTIONAL - The number of Newton iterations used to refine the shifts. Default: 5
+
+    Returns:
+    --------
+    shifts: numpy.array
+        The shift of each profile in bins, between -nbin/2 and nbin/2. rotate_profiles(profiles, -shifts) aligns the profiles to the template
+    """
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    nbin = profiles.shape[-1]
+    cross = np.fft.rfft(profiles, axis=-1) * np.conj(np.fft.rfft(template))[None, :]
+    shifts = np.argmax(np.fft.irfft(cross, n=nbin, axis=-1), axis=-1).astype(float)
+
+    #maximise sum_k Re(X_k exp(2 pi i k shift/nbin)) over the harmonics k >= 1 (and below Nyquist)
+    nharm = (nbin + 1)//2
+    cross = cross[:, 1:nharm]
+    omega = 2*np.pi*np.arange(1, nharm)/nbin
+    start = shifts.copy()
+    for _ in range(n_newton):
+        phasors = cross * np.exp(1j*omega[None, :]*shifts[:, None])
+        grad = -np.sum(omega * np.imag(phasors), axis=-1)
+        curv = -np.sum(omega**2 * np.real(phasors), axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.where(curv < 0, -grad/curv, 0.)
+        #stay on the peak found by the cross-correlation
+        shifts = np.clip(shifts + step, start - 1, start + 1)
+    return (shifts + nbin/2) % nbin - nbin/2
+
+def stack_profiles(profiles, nbin=None, template=None, n_iter=2):
+    """
+    Aligns and stacks many profiles of a pulsar, e.g. from different observations, which can have different numbers of bins.
+    The profiles are resampled to nbin bins in the Fourier domain, aligned to the template with fourier_shifts() and normalised
+    by their off-pulse noise. The stack is the sum of the profiles weighted by their matched filter S/N, which maximises its S/N.
+    Without a template, the profile with the highest S/N is used and the profiles are then realigned to the stack n_iter times
+
+    Parameters:
+    -----------
+    profiles: list
+        The profiles. Either a list of profiles or an array with shape (nprof, nbin)
+    nbin: int
+        OPTIONAL - The number of bins of the stack. Default: None (the largest number of bins of the profiles)
+    template: list
+        OPTIONAL - The profile to align to. It's resampled to nbin bins. Default: None
+    n_iter: int
+        OPTIONAL - The number of times to realign the profiles to the stack when there is no template. Default: 2
+
+    Returns:
+    --------
+    stack_dict: dictionary
+        contains keys:
+        stack: numpy.array
+            The stacked profile, normalised so the off-pulse noise of nbin bins is 1. Its bins are in units of S/N
+        shifts: numpy.array
+            The shift of each profile relative to the template (and so the stack) in turns of phase
+        sn: numpy.array
+            The matched filter S/N of each profile
+        weights: numpy.array
+            The normalised weight of each profile in the stack
+        sn_stack: float
+            The matched filter S/N of the stack
+        nbin: int
+            The number of bins of the stack
+    """
+    if isinstance(profiles, np.ndarray) and profiles.ndim == 2:
+        groups = {profiles.shape[-1]:np.arange(len(profiles))}
+        profiles = [profiles[i] for i in range(len(profiles))]
+    else:
+        groups = {}
+        for i, prof in enumerate(profiles):
+            groups.setdefault(len(prof), []).append(i)
+    if nbin is None:
+        nbin = max(groups.keys())
+    data = np.zeros((len(profiles), nbin))
+    #upsampled profiles have no noise above their own Nyquist frequency, so their noise per bin is scaled to what it
+    #would be at nbin bins (noise per bin goes as sqrt(nbin)) to keep the matched filter S/N and weights unbiased
+    noise_scale = np.ones(len(profiles))
+    for length, idx in groups.items():
+        idx = np.asarray(idx)
+        data[idx] = resample_profiles(np.array([profiles[i] for i in idx], dtype=float), nbin)
+        noise_scale[idx] = np.sqrt(max(nbin/length, 1.))
+
+    #a robust first guess of the S/N of each profile to pick the template
+    median = np.median(data, axis=-1)
+    mad = 1.4826*np.median(np.abs(data - median[:, None]), axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        peak_sn = np.nan_to_num((np.max(data, axis=-1) - median)/mad)
+    if template is None:
+        template = data[np.argmax(peak_sn)]
+        n_iter = max(n_iter, 1)
+    else:
+        template = resample_profiles(template, nbin)
+        n_iter = 0
+
+    for _ in range(n_iter + 1):
+        shifts = fourier_shifts(data, template)
+        aligned = rotate_profiles(data, -shifts)
+
+        #the off-pulse bins of the template are the off-pulse bins of every aligned profile
+        _, clipped = sigmaClip(template)
+        off = ~np.isnan(clipped)
+        if np.sum(off) < nbin//8:
+            off = template <= np.median(template)
+        base = np.mean(aligned[:, off], axis=-1)
+        sigma = np.std(aligned[:, off], axis=-1) * noise_scale
+        sigma[sigma <= 0] = np.inf
+        aligned = (aligned - base[:, None])/sigma[:, None]
+
+        #matched filter S/N of each unit noise profile against the template
+        shape = np.where(off, 0., template - np.mean(template[off]))
+        norm = np.sqrt(np.sum(shape**2))
+        sn = aligned @ shape / norm if norm > 0 else np.zeros(len(data))
+        weights = np.clip(sn, 0, None)
+        if np.sum(weights) <= 0:
+            weights = np.ones(len(data))
+        stack = weights @ aligned / np.sqrt(np.sum(weights**2))
+        template = stack
+
+    weights = weights / np.sum(weights)
+    sn_stack = stack @ shape / norm if norm > 0 else 0.
+    return {"stack":stack, "shifts":shifts/nbin, "sn":sn, "weights":weights, "sn_stack":sn_stack, "nbin":nbin}
 
 #---------------------------------------------------------------
 def check_clip(clipped_prof, toomuch=0.8, toolittle_frac=0., toolittle_absolute=4):
@@ -269,10 +724,7 @@ def check_clip(clipped_prof, toomuch=0.8, toolittle_frac=0., toolittle_absolute=
     toolittle_absolute: int
         OPTIONAL - If a profile has this many or less on-pulse bins, it is deemed not sufficient. Default: 4
     """
-    num_nans = 0
-    for i in clipped_prof:
-        if np.isnan(i):
-            num_nans += 1
+    num_nans = np.count_nonzero(np.isnan(clipped_prof))
     if num_nans <= toolittle_frac*len(clipped_prof) or num_nans <= toolittle_absolute:
         raise LittleClipError("Not enough data has been clipped. Condsier trying a smaller alpha value when clipping.")
     elif num_nans >= toomuch*len(clipped_prof):
@@ -301,18 +753,32 @@ def fill_clipped_prof(clipped_prof, search_scope=None, nan_type=0.):
     if search_scope is None:
         #Search 5% ahead for non-nans
         search_scope = round(length*0.05)
-    search_scope = np.linspace(1, search_scope, search_scope, dtype=int)
-
-    #loop over all values in clipped profile
-    for i, val in enumerate(clipped_prof):
-        if val==nan_type and not (i+max(search_scope)) >= length:
-            #look 'search_scope' indices ahead for non-nans
-            for j in sorted(search_scope, reverse=True):
-                #fill in nans
-                if clipped_prof[i+j]==nan_type:
-                    for k in range(j):
-                        clipped_prof[i+k]=nan_type
-                    break
+    search_scope = int(search_scope)
+
+    #Each gap (run of non-nans) is filled if a nan within search_scope bins before it
+    #can see the nan after it without looking past the end of the profile
+    is_nan = np.asarray(clipped_prof) == nan_type
+    edges = np.diff(np.concatenate(([0], (~is_nan).astype(np.int8), [0])))
+    gap_starts = np.flatnonzero(edges == 1)
+    gap_ends = np.flatnonzero(edges == -1) - 1
+    fill = np.zeros(length, dtype=bool)
+    run_start = 0 #the start of the run of nans before the current gap, including any gaps filled before it
+    for start, end in zip(gap_starts, gap_ends):
+        if start == 0 or end == length-1 or search_scope < 1:
+            #there is no nan before or after this gap
+            run_start = end + 1
+            continue
+        if max(run_start, end + 1 - search_scope) <= min(start - 1, length - 1 - search_scope):
+            fill[start:end+1] = True
+        else:
+            run_start = end + 1
+
+    #fill in nans
+    if isinstance(clipped_prof, np.ndarray):
+        clipped_prof[fill] = nan_type
+    else:
+        for i in np.flatnonzero(fill):
+            clipped_prof[i] = nan_type
 
     return clipped_prof
 
@@ -337,16 +803,15 @@ def find_components(profile, min_comp_len=5):
     """
     component_dict={}
     component_idx={}
-    num_components=0
-    for i, val in enumerate(profile):
-        if val!=0.:
-            if profile[i-1]==0 or i==0:
-                num_components+=1
-                comp_key = "component_{}".format(num_components)
-                component_dict[comp_key]=[]
-                component_idx[comp_key]=[]
-            component_dict[comp_key].append(val)
-            component_idx[comp_key].append(i)
+    #find the start and end of each run of non-zero values
+    on = (np.asarray(profile) != 0.).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], on, [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    for num_components, (start, end) in enumerate(zip(starts, ends)):
+        comp_key = "component_{}".format(num_components+1)
+        component_dict[comp_key] = list(profile[start:end])
+        component_idx[comp_key] = list(range(start, end))
 
     del_comps = []
     for comp_key in component_dict.keys():
@@ -410,8 +875,9 @@ def find_minima_maxima(profile, ignore_threshold=0, min_comp_len=0):
             maxima.append(abs_root)
 
     ignore_idx = []
+    prof_max = max(profile)
     for i, mx in enumerate(maxima):
-        if max(profile[int(mx-1):int(mx+1)]) < ignore_threshold*max(profile):
+        if max(profile[int(mx-1):int(mx+1)]) < ignore_threshold*prof_max:
             ignore_idx.append(i)
     for i in sorted(ignore_idx, reverse=True):
         del maxima[i]
@@ -653,6 +1119,116 @@ def est_sn_from_prof(prof_data, period, alpha=3.):
 
     return [sn, sn_e, scattered]
 
+#---------------------------------------------------------------
+def _sn_widths(nbin, max_width=None):
+    """
+    The default widths for matched_filter_sn(): 1 bin and then steps of about sqrt(2) up to max_width, which loses
+    at most a few percent of the S/N of a pulse that falls between two widths
+    """
+    if max_width is None:
+        max_width = nbin//2
+    max_width = max(1, min(max_width, nbin - 1))
+    widths = np.unique(np.round(np.sqrt(2)**np.arange(2*np.log2(max_width) + 1)).astype(int))
+    return widths[widths <= max_width]
+
+def _filter_responses(data, widths, template):
+    """
+    Yields the response of each baseline subtracted profile in data to the unit norm filter of each width, for every phase offset.
+    Boxcars use a circular cumulative sum and are indexed by their first bin. Gaussians (widths are FWHMs) use an FFT and are indexed by their centre
+    """
+    nprof, nbin = data.shape
+    if template == "boxcar":
+        wrapped = np.concatenate([data, data[:, :max(widths)]], axis=-1)
+        csum = np.concatenate([np.zeros((nprof, 1)), np.cumsum(wrapped, axis=-1)], axis=-1)
+        for width in widths:
+            yield (csum[:, width:width + nbin] - csum[:, :nbin]) / np.sqrt(width)
+    elif template == "gaussian":
+        spectra = np.fft.rfft(data, axis=-1)
+        x = (np.arange(nbin) + nbin//2) % nbin - nbin//2
+        for width in widths:
+            kernel = np.exp(-4*np.log(2)*x**2/width**2)
+            kernel /= np.sqrt(np.sum(kernel**2))
+            yield np.fft.irfft(spectra * np.conj(np.fft.rfft(kernel))[None, :], n=nbin, axis=-1)
+    else:
+        raise ValueError("template not recognised. Options are: 'boxcar' or 'gaussian'")
+
+def matched_filter_sn(profiles, widths=None, template="boxcar", n_iter=2):
+    """
+    Finds the S/N of profiles by matching them to a filter at every width and phase offset and keeping the best.
+    The noise is first estimated from the median absolute deviation, then from the bins away from the best filter n_iter times.
+    With the default widths, each profile takes O(nbin log nbin) operations and a stack of profiles is handled at once,
+    so it's suitable for triaging many profiles before fitting them
+
+    Parameters:
+    -----------
+    profiles: numpy.array
+        A profile or a stack of profiles with the same number of bins, with shape (nprof, nbin)
+    widths: list
+        OPTIONAL - The filter widths in bins. Default: None (1 bin and then steps of about sqrt(2) up to nbin/2)
+    template: str
+        OPTIONAL - 'boxcar' for top hat filters from cumulative sums or 'gaussian' for gaussian filters (widths are FWHMs) from FFTs. Default: 'boxcar'
+    n_iter: int
+        OPTIONAL - The number of times to re-estimate the noise away from the best filter. Default: 2
+
+    Returns:
+    --------
+    sn_dict: dictionary
+        contains keys:
+        sn: float or numpy.array
+            The S/N of the best filter
+        width: int or numpy.array
+            The width of the best filter in bins
+        phase: float or numpy.array
+            The phase of the centre of the best filter, between 0 and 1
+        baseline: float or numpy.array
+            The mean of the off-pulse bins
+        sigma: float or numpy.array
+            The standard deviation of the off-pulse bins
+        Each is a float for a single profile or an array with one value per profile for a stack
+    """
+    data = np.asarray(profiles, dtype=float)
+    single = data.ndim == 1
+    data = np.atleast_2d(data)
+    nprof, nbin = data.shape
+    widths = _sn_widths(nbin) if widths is None else np.asarray(widths, dtype=int)
+    rows = np.arange(nprof)
+    bins = np.arange(nbin)
+
+    baseline = np.median(data, axis=-1)
+    sigma = 1.4826*np.median(np.abs(data - baseline[:, None]), axis=-1)
+    for i in range(n_iter + 1):
+        sigma[sigma <= 0] = np.inf
+        sn = np.full(nprof, -np.inf)
+        best_width = np.zeros(nprof, dtype=int)
+        best_bin = np.zeros(nprof, dtype=int)
+        for width, response in zip(widths, _filter_responses(data - baseline[:, None], widths, template)):
+            peak = np.argmax(response, axis=-1)
+            width_sn = response[rows, peak] / sigma
+            better = width_sn > sn
+            sn[better] = width_sn[better]
+            best_width[better] = width
+            best_bin[better] = peak[better]
+        if template == "boxcar":
+            start = best_bin
+            centre = best_bin + (best_width - 1)/2
+        else:
+            start = best_bin - best_width//2
+            centre = best_bin
+        if i == n_iter:
+            break
+
+        #use the bins more than a filter width from the best filter as the off-pulse
+        pad = np.minimum(best_width, (nbin//2 - best_width)//2).clip(0)
+        on = (bins[None, :] - (start - pad)[:, None]) % nbin < (best_width + 2*pad)[:, None]
+        off_data = np.where(on, np.nan, data)
+        baseline = np.nanmean(off_data, axis=-1)
+        sigma = np.nanstd(off_data, axis=-1)
+
+    sn_dict = {"sn":sn, "width":best_width, "phase":(centre % nbin)/nbin, "baseline":baseline, "sigma":sigma}
+    if single:
+        sn_dict = {key:val[0] for key, val in sn_dict.items()}
+    return sn_dict
+
 #---------------------------------------------------------------
 def analyse_pulse_prof(prof_data, period, alpha=3):
     """
@@ -888,13 +1464,35 @@ def integral_multi_gauss(*params):
     return y
 
 def multi_gauss(x, *params):
-    y = np.zeros_like(x)
-    for i in range(0, len(params), 3):
-        a = params[i]
-        b = params[i+1]
-        c = params[i+2]
-        y = y +  a * np.exp( -(((x-b)**2) / (2*c**2)) )
-    return y
+    #evaluates all of the components at once. params is [amp, centre, width] for each component
+    a, b, c = np.reshape(params, (-1, 3)).T
+    x = np.asarray(x)[..., np.newaxis]
+    return np.sum(a * np.exp( -(((x-b)**2) / (2*c**2)) ), axis=-1)
+
+def multi_gauss_jacobian(x, *params):
+    """
+    The analytic Jacobian of multi_gauss() with respect to its parameters. Used by curve_fit() in fit_gaussian()
+
+    Parameters:
+    -----------
+    x: numpy.array
+        The points to evaluate
+    *params: list
+        A list containing three parameters per gaussian component in the order: Amp, Mean, Width
+
+    Returns:
+    --------
+    J: numpy.array
+        The Jacobian with shape (len(x), len(params)). Each row is [d/da, d/db, d/dc] for each component
+    """
+    a, b, c = np.reshape(params, (-1, 3)).T
+    x = np.asarray(x)[..., np.newaxis]
+    gauss = np.exp( -(((x-b)**2) / (2*c**2)) )
+    J = np.empty(x.shape[:-1] + (len(a), 3))
+    J[..., 0] = gauss                       #partial_gauss_dda()
+    J[..., 1] = a*(x - b)*gauss/c**2        #partial_gauss_ddb()
+    J[..., 2] = a*(x - b)**2*gauss/c**3     #partial_gauss_ddc()
+    return J.reshape(x.shape[:-1] + (3*len(a),))
 
 def multi_gauss_ddx(x, *params):
     #derivative of gaussian
@@ -985,7 +1583,26 @@ def plot_fit(plot_name, y, fit, popt, maxima=None, maxima_e=None):
     plt.close()
 
 #---------------------------------------------------------------
-def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3.):
+def _residual_gauss_guess(x, residual):
+    """
+    Guesses the [amp, centre, width] of a gaussian at the largest point of a fit's residual. Used by fit_gaussian()
+    """
+    peak = int(np.argmax(residual))
+    amp = residual[peak]
+    if amp <= 0:
+        return [0., x[peak], 1.]
+    #the width of the run of residuals above half the peak, converted from a FWHM
+    above = residual >= amp/2
+    lo = peak
+    while lo > 0 and above[lo-1]:
+        lo -= 1
+    hi = peak
+    while hi < len(residual)-1 and above[hi+1]:
+        hi += 1
+    return [amp, x[peak], max(hi - lo + 1, 1)/2.3548]
+
+def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3., init_params=None, incremental=False, patience=1,\
+                 min_delta_bic=6.):
     """
     Fits multiple gaussian components to a pulse profile and finds the best number to use for a fit.
     Will always fit at least one gaussian per profile component.
@@ -1004,10 +1621,22 @@ def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3.):
         OPTIONAL - If not none, will make a plot of the best fit with this name. Default: None
     alpha: float
         OPTIONAL - The alpha value to be used in sigmaClip(). Default: 3
+    init_params: dictionary
+        OPTIONAL - Initial parameters to try as well as the usual guesses, keeping the better fit. init_params[N] is a list of 3*N parameters
+        used for the N gaussian fit, e.g. the fit_params of a previous fit. Default: None
+    incremental: boolean
+        OPTIONAL - If True, each fit is also started from the previous fit plus a gaussian at the largest residual, keeping the better fit,
+        and the fits stop once the BIC hasn't improved for patience fits in a row. Default: False
+    patience: int
+        OPTIONAL - The number of fits without a better BIC allowed before stopping when incremental is True. Default: 1
+    min_delta_bic: float
+        OPTIONAL - When incremental is True, a fit with more components is only better if it lowers the BIC by more than this.
+        The default is 'strong' evidence for the extra components (Kass & Raftery 1995) and stops the seeded fits
+        from adding degenerate components. Default: 6
 
     Returns:
     --------
-    [fit, redchisq, best_bic, popt, pcov]: list
+    [fit, redchisq, best_bic, popt, pcov, comp_dict, comp_idx, fit_params]: list
         fit: list
             The data containing the multi-component gaussian fit to the input profile
         redchisq: float
@@ -1018,13 +1647,16 @@ def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3.):
             A list of floats where each 3 numbers describes a single gaussain and are 'ctr', 'amp' and 'wid' respectively
         pcov: numpy matrix
             The covariance matrix generated by the curve_fit function
+        comp_dict: dictionary
+            dict["component_x"] contains an array of the component x
+        comp_idx: dictionary
+            dict["component_x"] contains an array of indexes of the original profile corresponding to component x
+        fit_params: dictionary
+            fit_params[N] contains the fit parameters of the N gaussian fit. Can be used as init_params for a similar profile
     """
     #chi sqaured evaluation
     def chsq(observed_values, expected_values, err):
-        test_statistic=0
-        for observed, expected in zip(observed_values, expected_values):
-            test_statistic+=((float(observed)-float(expected))/float(err))**2
-        return test_statistic
+        return np.sum(((np.asarray(observed_values, dtype=float) - expected_values)/err)**2)
 
     #Take noise mean and normalize the profile and check the clipped profile
     _, clipped = sigmaClip(profile, alpha=alpha)
@@ -1066,6 +1698,10 @@ def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3.):
     bounds_arr=[[],[]]
     guess = []
     fit_dict = {}
+    fit_params = {}
+    best_bic = np.inf
+    best_fit = None
+    since_best = 0
 
     for num in range(1, max_N):
         guess += [next(max_guess), next(centre_guess), next(width_guess)]
@@ -1076,9 +1712,24 @@ def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3.):
         bounds_arr[1].append(len(y))
         bounds_arr[1].append(len(y))
         bounds_tuple=(tuple(bounds_arr[0]), tuple(bounds_arr[1]))
-        popt, pcov = curve_fit(multi_gauss, x, y, bounds=bounds_tuple, p0=guess, maxfev=100000)
-        fit = multi_gauss(x, *popt)
-        chisq = chsq(y, fit, noise_std)
+        p0s = [guess]
+        if init_params and num in init_params:
+            #make sure the initial parameters are within this fit's bounds. A seed from a different alpha can lead
+            #to a worse minimum than the usual guess, so the better of the two fits is kept
+            p0s.insert(0, np.clip(init_params[num], bounds_arr[0], bounds_arr[1]))
+        if incremental and num > 1:
+            #also start from the previous solution plus a component where it fits worst.
+            #On its own this can get stuck in a worse minimum so the better of the two fits is kept
+            seed = list(fit_params[num-1]) + _residual_gauss_guess(x, y - fit)
+            p0s.append(np.clip(seed, bounds_arr[0], bounds_arr[1]))
+        best_chisq = np.inf
+        for p0 in p0s:
+            p0_popt, p0_pcov = curve_fit(multi_gauss, x, y, bounds=bounds_tuple, p0=p0, maxfev=100000, jac=multi_gauss_jacobian)
+            p0_fit = multi_gauss(x, *p0_popt)
+            p0_chisq = chsq(y, p0_fit, noise_std)
+            if p0_chisq < best_chisq:
+                popt, pcov, fit, best_chisq = p0_popt, p0_pcov, p0_fit, p0_chisq
+        chisq = best_chisq
         #Bayesian information criterion for gaussian noise
         k = 3*(num+1)
         bic = chisq + k*np.log(len(y))
@@ -1088,26 +1739,31 @@ def fit_gaussian(profile, max_N=6, min_comp_len=0, plot_name=None, alpha=3.):
         fit_dict[str(num+1)]["fit"] = fit
         fit_dict[str(num+1)]["redchisq"] = chisq/(len(y)-1)
         fit_dict[str(num+1)]["bic"] = bic
+        fit_params[num] = popt
         logger.debug("Reduced chi squared for               {0} components: {1}".format(num+1, fit_dict[str(num+1)]["redchisq"]))
         logger.debug("Bayesian Information Criterion for    {0} components: {1}".format(num+1, fit_dict[str(num+1)]["bic"]))
+        #extra components only count as an improvement if there is strong evidence for them
+        if bic < best_bic - (min_delta_bic if incremental else 0):
+            best_bic = bic
+            best_fit = str(num+1)
+            since_best = 0
+        else:
+            since_best += 1
+        if incremental and since_best >= patience:
+            logger.debug("BIC hasn't improved for {0} fits. Stopping at {1} components".format(patience, num+1))
+            break
 
-    #Find the best fit according to the BIC
-    best_bic = np.inf
-    best_fit = None
-    for n_components in fit_dict.keys():
-        if fit_dict[n_components]["bic"] < best_bic:
-            best_bic = fit_dict[n_components]["bic"]
-            best_fit = n_components
     logger.info("Fit {0} gaussians for a reduced chi sqaured of {1}".format(best_fit, fit_dict[best_fit]["redchisq"]))
     popt = fit_dict[best_fit]["popt"]
     pcov = fit_dict[best_fit]["pcov"]
     fit = fit_dict[best_fit]["fit"]
     redchisq = fit_dict[best_fit]["redchisq"]
 
-    return [fit, redchisq, best_bic, popt, pcov, comp_dict, comp_idx]
+    return [fit, redchisq, best_bic, popt, pcov, comp_dict, comp_idx, fit_params]
 
 #---------------------------------------------------------------
-def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, plot_name=None, alpha=3., period=None):
+def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, plot_name=None, alpha=3., period=None, init_params=None,\
+                   incremental=False, patience=1, min_delta_bic=6.):
     """
     Fits multiple gaussians to a profile and subsequently finds W10, W50, Weq and maxima
 
@@ -1127,6 +1783,14 @@ def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, p
         OPTIONAL - The alpha value passed to the sigmaClip() function. Default: 3
     period: float
         OPTIONAL - The puslar's period in ms. If not none, will attempt a S/N calculation. Default: None
+    init_params: dictionary
+        OPTIONAL - Initial parameters for the gaussian fits. See fit_gaussian(). Default: None
+    incremental: boolean
+        OPTIONAL - Seed each gaussian fit from the previous one and stop early. See fit_gaussian(). Default: False
+    patience: int
+        OPTIONAL - The number of fits without a better BIC allowed before stopping. See fit_gaussian(). Default: 1
+    min_delta_bic: float
+        OPTIONAL - The decrease in BIC an extra component needs when incremental is True. See fit_gaussian(). Default: 6
 
     Returns:
     --------
@@ -1178,6 +1842,8 @@ def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, p
             The uncertainty in sn. Will be None is period unsupplied
         scattered: boolean
             True is the profile is scattered. Will be None is period unsupplied
+        fit_params: dictionary
+            The fit parameters for every number of gaussians that was fit. See fit_gaussian()
     """
     #initialize minimum component length and ignore threshold
     if min_comp_len is None:
@@ -1199,7 +1865,10 @@ def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, p
     y = y/max(y)
 
     #fit gaussians
-    fit, chisq, bic, popt, pcov, comp_dict, comp_idx = fit_gaussian(y, max_N=max_N, min_comp_len=min_comp_len, alpha=alpha)
+    fit, chisq, bic, popt, pcov, comp_dict, comp_idx, fit_params = fit_gaussian(y, max_N=max_N, min_comp_len=min_comp_len,\
+                                                                              alpha=alpha, init_params=init_params,\
+                                                                              incremental=incremental, patience=patience,\
+                                                                              min_delta_bic=min_delta_bic)
     fit = np.array(fit)
     n_rows, _ = np.shape(pcov)
     num_gauss = n_rows/3
@@ -1234,7 +1903,8 @@ def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, p
     fit_dict = {"W10":W10, "W10_e":W10_e, "W50":W50, "W50_e":W50_e, "Wscat":Wscat, "Wscat_e":Wscat_e,\
                 "Weq":Weq, "Weq_e":Weq_e, "maxima":maxima, "maxima_e":maxima_e, "redchisq":chisq,\
                 "num_gauss":num_gauss, "bic":bic, "gaussian_params":popt, "cov_mat":pcov, "comp_dict":comp_dict,\
-                "comp_idx":comp_idx, "alpha":alpha, "profile":y, "fit":fit, "sn":sn, "sn_e":sn_e, "scattered":scattered}
+                "comp_idx":comp_idx, "alpha":alpha, "profile":y, "fit":fit, "sn":sn, "sn_e":sn_e, "scattered":scattered,\
+                "fit_params":fit_params}
 
     logger.info("W10:                   {0} +/- {1}".format(W10, W10_e))
     logger.info("W50:                   {0} +/- {1}".format(W50, W50_e))
@@ -1247,7 +1917,229 @@ def prof_eval_gfit(profile, max_N=6, ignore_threshold=None, min_comp_len=None, p
 
     return fit_dict
 
-def auto_gfit(profile, max_N=6, plot_name=None, ignore_threshold=None, min_comp_len=None, period=None, cliptype="regular"):
+def _prof_eval_gfit_alpha(task):
+    """
+    Runs prof_eval_gfit() for a single alpha. Used by auto_gfit()
+
+    Parameters:
+    -----------
+    task: tuple
+        (profile, alpha, kwargs) where kwargs are the keyword arguments for prof_eval_gfit()
+
+    Returns:
+    --------
+    alpha: float
+        The alpha value
+    fit_dict: dictionary
+        The output of prof_eval_gfit(). None if the alpha value was unsuitable
+    """
+    profile, alpha, kwargs = task
+    loglvl = logger.level
+    logger.setLevel(logging.WARNING) #squelch logging for the fit
+    try:
+        fit_dict = prof_eval_gfit(profile, alpha=alpha, **kwargs)
+    except(LittleClipError, LargeClipError, NoComponentsError, ProfileLengthError) as e:
+        fit_dict = None
+    finally:
+        logger.setLevel(loglvl)
+    if fit_dict is None:
+        logger.info("Skipping alpha value: {}".format(alpha))
+    return alpha, fit_dict
+
+def _best_alpha(attempts_dict):
+    """
+    Finds the alpha whose fit has the reduced chi-squared closest to one. Returns None if there are no fits
+    """
+    best_alpha = None
+    best_chi = np.inf
+    for alpha_key in sorted(attempts_dict.keys()):
+        chi_diff = abs(1 - attempts_dict[alpha_key]["redchisq"])
+        if chi_diff < best_chi:
+            best_chi = chi_diff
+            best_alpha = alpha_key
+    return best_alpha
+
+#---------------------------------------------------------------
+def _gfit_cache_key(profile, params):
+    """
+    Makes the auto_gfit() cache key from the profile samples, the analysis parameters and PROF_CACHE_VERSION
+    """
+    key = hashlib.sha256()
+    key.update(np.ascontiguousarray(profile, dtype=np.float64).tobytes())
+    params = dict(params, version=PROF_CACHE_VERSION)
+    key.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    return key.hexdigest()
+
+def _gfit_cache_file(key):
+    return os.path.join(cache_utils.get_cache_dir("prof_fits"), "{}.pkl".format(key))
+
+def load_gfit_cache(key):
+    """
+    Loads a cached auto_gfit() result
+
+    Parameters:
+    -----------
+    key: str
+        The cache key. See _gfit_cache_key()
+
+    Returns:
+    --------
+    hit: boolean
+        Whether the result was in the cache
+    fit_dict: dictionary
+        The cached fit dictionary. None if there isn't one or if no fit could be found
+    """
+    cache_file = _gfit_cache_file(key)
+    cached = cache_utils.load_pickle(cache_file)
+    if cached is None:
+        return False, None
+    try:
+        #mark as recently used so it is pruned last
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return True, cached["fit_dict"]
+
+def save_gfit_cache(key, fit_dict):
+    """
+    Saves an auto_gfit() result to the cache and removes the least recently used results if the cache is larger than PROF_CACHE_MAX_BYTES
+
+    Parameters:
+    -----------
+    key: str
+        The cache key. See _gfit_cache_key()
+    fit_dict: dictionary
+        The fit dictionary from auto_gfit(). None if no fit could be found
+    """
+    try:
+        cache_utils.dump_pickle(_gfit_cache_file(key), {"fit_dict":fit_dict})
+        cache_utils.prune_cache_dir(cache_utils.get_cache_dir("prof_fits"), PROF_CACHE_MAX_BYTES)
+    except OSError as e:
+        logger.warning("Could not write to the profile fit cache: {}".format(e))
+
+def _auto_gfit_search(profile, alphas, eval_kwargs, n_procs=1, coarse_to_fine=False, warm_start=False):
+    """
+    Searches the alphas for the best gaussian fit. See auto_gfit() for the parameters. Returns None if no fit was found
+    """
+    attempts_dict = {}
+    pool = multiprocessing.Pool(n_procs) if n_procs > 1 else None
+
+    def evaluate(alpha_idxs, init_params=None):
+        #fits the alphas at these indexes of alphas and adds the successful fits to attempts_dict.
+        #In series, a warm start chains each alpha from the previous successful fit
+        if pool is not None:
+            tasks = [(profile, alphas[i], dict(eval_kwargs, init_params=init_params)) for i in alpha_idxs]
+            results = pool.map(_prof_eval_gfit_alpha, tasks)
+        else:
+            results = []
+            for i in alpha_idxs:
+                results.append(_prof_eval_gfit_alpha((profile, alphas[i], dict(eval_kwargs, init_params=init_params))))
+                if warm_start and results[-1][1] is not None:
+                    init_params = results[-1][1]["fit_params"]
+        for alpha, prof_dict in results:
+            if prof_dict is not None:
+                attempts_dict[alpha] = prof_dict
+
+    def seed():
+        #the fit parameters of the best alpha so far
+        best_alpha = _best_alpha(attempts_dict)
+        if warm_start and best_alpha is not None:
+            return attempts_dict[best_alpha]["fit_params"]
+        return None
+
+    try:
+        if coarse_to_fine:
+            step = max(1, (len(alphas) - 1)//4)
+            evaluated = set(range(0, len(alphas), step)) | {len(alphas) - 1}
+            evaluate(sorted(evaluated))
+            while step > 1:
+                step = step//2
+                best_alpha = _best_alpha(attempts_dict)
+                if best_alpha is None:
+                    break
+                best_idx = int(np.argmin(abs(alphas - best_alpha)))
+                refine = [i for i in (best_idx - step, best_idx + step) if 0 <= i < len(alphas) and i not in evaluated]
+                evaluated.update(refine)
+                evaluate(refine, init_params=seed())
+            if not attempts_dict:
+                #nothing worked in the coarse search so try everything else
+                evaluate([i for i in range(len(alphas)) if i not in evaluated])
+        else:
+            evaluate(range(len(alphas)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    #Evaluate the best profile based on reduced chi-squared.
+    best_alpha = _best_alpha(attempts_dict)
+    if best_alpha is None:
+        return None
+    return attempts_dict[best_alpha]
+
+def downsample_profile(profile, factor):
+    """
+    Downsamples a profile by averaging blocks of bins. A partial block at the end is averaged on its own
+
+    Parameters:
+    -----------
+    profile: list
+        The pulse profile
+    factor: int
+        The number of bins to average together
+
+    Returns:
+    --------
+    downsampled: numpy.array
+        The downsampled profile with ceil(len(profile)/factor) bins
+    """
+    profile = np.asarray(profile, dtype=float)
+    starts = np.arange(0, len(profile), factor)
+    return np.add.reduceat(profile, starts) / np.diff(np.append(starts, len(profile)))
+
+def _multires_factor(profile, coarse_nbins, bins_per_fwhm=8):
+    """
+    Finds how much a profile can be downsampled for _multires_gfit_search(). The factor is limited so the brightest peak keeps
+    at least bins_per_fwhm bins across its FWHM, otherwise narrow components are misfit at low resolution
+    """
+    y = np.asarray(profile, dtype=float)
+    y = y - np.median(y)
+    peak = int(np.argmax(y))
+    above = y >= y[peak]/2
+    lo = peak
+    while lo > 0 and above[lo-1]:
+        lo -= 1
+    hi = peak
+    while hi < len(y)-1 and above[hi+1]:
+        hi += 1
+    return max(1, min(len(y)//coarse_nbins, (hi - lo + 1)//bins_per_fwhm))
+
+def _multires_gfit_search(profile, alphas, eval_kwargs, factor, n_procs=1, coarse_to_fine=False, warm_start=False):
+    """
+    Finds the best gaussian fit of a downsampled profile and then refits the full profile with the same alpha,
+    starting from the downsampled fit. Falls back to _auto_gfit_search() on the full profile if the refit fails or if the
+    full resolution BIC chooses a different number of gaussians. See auto_gfit() for the parameters. Returns None if no fit was found
+    """
+    coarse_kwargs = dict(eval_kwargs, period=None)
+    if eval_kwargs["min_comp_len"] is not None:
+        coarse_kwargs["min_comp_len"] = int(np.ceil(eval_kwargs["min_comp_len"]/factor))
+    coarse_dict = _auto_gfit_search(downsample_profile(profile, factor), alphas, coarse_kwargs, n_procs=n_procs,\
+                                    coarse_to_fine=coarse_to_fine, warm_start=warm_start)
+    if coarse_dict is not None:
+        #convert the coarse parameters to full resolution bins
+        init_params = {}
+        for num, params in coarse_dict["fit_params"].items():
+            amp, centre, width = np.reshape(params, (-1, 3)).T
+            init_params[num] = np.ravel(np.column_stack((amp, centre*factor + (factor - 1)/2, width*factor)))
+        _, fit_dict = _prof_eval_gfit_alpha((profile, coarse_dict["alpha"], dict(eval_kwargs, init_params=init_params)))
+        if fit_dict is not None and fit_dict["num_gauss"] == coarse_dict["num_gauss"]:
+            return fit_dict
+    logger.info("The downsampled fit doesn't agree with the full resolution profile. Fitting the full resolution profile")
+    return _auto_gfit_search(profile, alphas, eval_kwargs, n_procs=n_procs, coarse_to_fine=coarse_to_fine, warm_start=warm_start)
+
+def auto_gfit(profile, max_N=6, plot_name=None, ignore_threshold=None, min_comp_len=None, period=None, cliptype="regular",\
+              n_procs=1, coarse_to_fine=False, warm_start=False, incremental=False, patience=1, min_delta_bic=6., use_cache=True,\
+              coarse_nbins=None):
     """
     runs the gaussian fit evaluation for a range of values of alpha. This is necessary as there is no way to know
     a priori which alpha to use beforehand. Alpha is the input for sigmaClip() and can be interpreted as the level
@@ -1265,6 +2157,31 @@ def auto_gfit(profile, max_N=6, plot_name=None, ignore_threshold=None, min_comp_
         OPTIONAL -  Maxima with values below this number will be ignored. If none, will use 3*noise. Default: None
     min_comp_len: float
         OPTIONAL - Minimum length of a component to be considered real. Measured in bins. If none, will use 1% of total profile lengths + 2, max 50. Default: None
+    cliptype: string
+        OPTIONAL - The range of alphas to try. 'regular', 'noisy' or 'verbose'. Default: 'regular'
+    n_procs: int
+        OPTIONAL - The number of processes used to evaluate the alphas. Default: 1
+    coarse_to_fine: boolean
+        OPTIONAL - If True, will first evaluate every few alphas and then only refine the alphas around the best one,
+        halving the spacing each time. This assumes the fit quality varies smoothly with alpha. Default: False
+    warm_start: boolean
+        OPTIONAL - If True, the fits start from the parameters of an alpha that has already been fit.
+        With n_procs=1 each alpha starts from the previous successful fit. With a pool the alphas of a stage are fit independently,
+        so the warm start only takes effect between the coarse_to_fine refinement stages (from the best alpha so far). Default: False
+    incremental: boolean
+        OPTIONAL - Seed each gaussian fit from the one with one less component and stop early. See fit_gaussian(). Default: False
+    patience: int
+        OPTIONAL - The number of fits without a better BIC allowed before stopping. See fit_gaussian(). Default: 1
+    min_delta_bic: float
+        OPTIONAL - The decrease in BIC an extra component needs when incremental is True. See fit_gaussian(). Default: 6
+    use_cache: boolean
+        OPTIONAL - Whether to use the on-disk cache of fits. The cache is keyed by the profile and all of the options that change the result,
+        so rerunning an unchanged analysis returns the previous result immediately. Default: True
+    coarse_nbins: int
+        OPTIONAL - If not None, the alphas are searched using the profile downsampled to about this many bins, or less downsampled
+        if the brightest peak would have fewer than 8 bins across its FWHM. Only the best alpha is then fit at full resolution,
+        starting from the downsampled fit. If the full resolution fit uses a different number of gaussians, the full search is done instead.
+        Profiles that can't be downsampled by at least 2 are fit normally. Default: None
 
     Returns:
     --------
@@ -1282,36 +2199,26 @@ def auto_gfit(profile, max_N=6, plot_name=None, ignore_threshold=None, min_comp_
         alphas = np.linspace(1, 5, 33)
     else:
         raise ValueError("cliptype not recognised. Options are: 'regular', 'noisy' or 'verbose'.")
-        
-    attempts_dict = {}
 
-    loglvl = logger.level
-    logger.setLevel(logging.WARNING) #squelch logging for the loop
-
-    #loop over the gaussian evaluation fucntion, excepting in-built errors
-    for alpha in alphas:
-        try:
-            prof_dict = prof_eval_gfit(profile, max_N=6, ignore_threshold=ignore_threshold, min_comp_len=min_comp_len, alpha=alpha, period=period)
-            attempts_dict[alpha] = prof_dict
-        except(LittleClipError, LargeClipError, NoComponentsError, ProfileLengthError) as e:
-            logger.setLevel(loglvl)
-            logger.info("Skipping alpha value: {}".format(alpha))
-            logger.setLevel(logging.WARNING) #squelch logging for the loop
-    logger.setLevel(loglvl)
-
-    #Evaluate the best profile based on reduced chi-squared.
-    chi_diff = []
-    alphas = []
-    for alpha_key in attempts_dict.keys():
-        chi_diff.append(abs(1 - attempts_dict[alpha_key]["redchisq"]))
-        alphas.append(alpha_key)
-
-    if not chi_diff: #sometimes things go wrong :/
+    eval_kwargs = {"max_N":max_N, "ignore_threshold":ignore_threshold, "min_comp_len":min_comp_len, "period":period,\
+                   "incremental":incremental, "patience":patience, "min_delta_bic":min_delta_bic}
+    hit = False
+    if use_cache:
+        cache_key = _gfit_cache_key(profile, dict(eval_kwargs, alphas=list(alphas), coarse_to_fine=coarse_to_fine, warm_start=warm_start,\
+                                                  coarse_nbins=coarse_nbins))
+        hit, fit_dict = load_gfit_cache(cache_key)
+    if hit:
+        logger.info("Using the cached fit of this profile")
+    elif coarse_nbins and _multires_factor(profile, coarse_nbins) > 1:
+        fit_dict = _multires_gfit_search(profile, alphas, eval_kwargs, _multires_factor(profile, coarse_nbins), n_procs=n_procs,\
+                                         coarse_to_fine=coarse_to_fine, warm_start=warm_start)
+    else:
+        fit_dict = _auto_gfit_search(profile, alphas, eval_kwargs, n_procs=n_procs, coarse_to_fine=coarse_to_fine, warm_start=warm_start)
+    if not hit and use_cache:
+        save_gfit_cache(cache_key, fit_dict)
+    if fit_dict is None: #sometimes things go wrong :/
         raise NoFitError("No suitable profile fit could be found!")
-
-    best_chi = min(chi_diff)
-    best_alpha = alphas[chi_diff.index(best_chi)]
-    fit_dict = attempts_dict[best_alpha]
+    best_alpha = fit_dict["alpha"]
 
     if plot_name:
         plot_fit(plot_name, fit_dict["profile"], fit_dict["fit"], fit_dict["gaussian_params"], maxima=fit_dict["maxima_e"], maxima_e=fit_dict["maxima"])
@@ -1356,9 +2263,12 @@ if __name__ == '__main__':
 
     g_inputs = parser.add_argument_group("Gaussian Inputs")
     g_inputs.add_argument("--max_N", type=int, default=6, help="The maximum number of gaussian components to attempt to fit")
+    g_inputs.add_argument("--coarse_nbins", type=int, default=None, help="Used with --auto. Search for the best fit after downsampling the profile\
+                          to about this many bins, then refine the fit at full resolution. If none, will fit at full resolution")
 
     other_inputs = parser.add_argument_group("Other Inputs")
     other_inputs.add_argument("--plot_name", type=str, help="The name of the output plot file. If none, will not plot anything")
+    other_inputs.add_argument("--no_cache", action="store_true", help="Use this tag to always fit the profile instead of using the cache of previous fits")
     other_inputs.add_argument("-L", "--loglvl", type=str, default="INFO", help="Logger verbostity level")
     args = parser.parse_args()
 
@@ -1375,17 +2285,17 @@ if __name__ == '__main__':
         profile = get_from_ascii(args.ascii)[0]
         period = args.period
     elif args.archive:
-        subprocess_pdv(args.archive, outfile="archive.txt")
-        profile = get_from_ascii("archive.txt")[0]
-        os.remove("archive.txt")
-        period = args.period
+        ar_dict = read_archive(args.archive, pscrunch=True)
+        profile = ar_dict["I"]
+        period = args.period if args.period else ar_dict["period"]
     else:
         logger.error("Please supply either an ascii or bestprof profile")
         sys.exit(1)
 
     if args.auto:
         auto_gfit(profile, max_N=args.max_N, ignore_threshold=args.ignore_threshold,\
-                        plot_name=args.plot_name, min_comp_len=args.min_comp_len, period=period)
+                        plot_name=args.plot_name, min_comp_len=args.min_comp_len, period=period, use_cache=not args.no_cache,\
+                        coarse_nbins=args.coarse_nbins)
     else :
         prof_eval_gfit(profile, max_N=args.max_N, ignore_threshold=args.ignore_threshold,\
                         plot_name=args.plot_name, min_comp_len=args.min_comp_len, alpha=args.alpha, period=period)
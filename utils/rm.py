@@ -27,9 +27,222 @@ SOFTWARE.
 # Written by George Heald
 # v1.0, 14 November 2017
 
+import os
+import builtins
+import hashlib
+import tempfile
+from collections import OrderedDict
 from numpy import *
 from pylab import *
 from scipy.optimize import curve_fit
+from scipy.signal import fftconvolve
+from vcstools import cache_utils
+
+# Size limits of the in-memory caches of phase kernels and RMSFs,
+# and of the optional on-disk RMSF store
+KERNEL_CACHE_MAX_BYTES = 2**27
+RMSF_CACHE_MAX_BYTES = 2**26
+RMSF_DISK_CACHE_MAX_BYTES = 100*1024**2
+RMSF_CACHE_VERSION = 1
+_kernel_cache = OrderedDict()
+_rmsf_cache = OrderedDict()
+
+def _array_key(*arrays):
+	"""Return a sha256 hex digest of the float64 bytes of the arrays."""
+	key = hashlib.sha256()
+	for arr in arrays:
+		arr = ascontiguousarray(arr,dtype=float64)
+		key.update(str(arr.shape).encode())
+		key.update(arr.tobytes())
+	return key.hexdigest()
+
+def _cache_get(cache,key):
+	"""Return a cached value (and mark it as recently used) or None."""
+	if key not in cache:
+		return None
+	cache.move_to_end(key)
+	return cache[key]
+
+def _cache_put(cache,key,value,max_bytes):
+	"""Add a tuple of arrays to an LRU cache of at most max_bytes."""
+	for arr in value:
+		arr.flags.writeable = False
+	cache[key] = value
+	cache.move_to_end(key)
+	nbytes = lambda v: builtins.sum(arr.nbytes for arr in v)
+	total = builtins.sum(nbytes(v) for v in cache.values())
+	while total > max_bytes and len(cache) > 1:
+		_, old = cache.popitem(last=False)
+		total -= nbytes(old)
+	return value
+
+def clear_caches():
+	"""Empty the in-memory phase kernel and RMSF caches."""
+	_kernel_cache.clear()
+	_rmsf_cache.clear()
+
+def _phase_powers(ang,n):
+	"""
+	Return the (n, len(ang)) array exp(1i*t*ang) for t = 0..n-1.
+
+	Rows are filled by repeated doubling, so only ~log2(n) rows of
+	complex exponentials are evaluated.
+	"""
+	out = empty((n,len(ang)),dtype=complex)
+	out[0] = 1.
+	filled = 1
+	while filled < n:
+		k = min(filled,n-filled)
+		out[filled:filled+k] = out[:k]*exp(1.j*filled*ang)
+		filled += k
+	return out
+
+def _phase_kernel(phi0,step,nphi,dl2):
+	"""
+	Return the phase kernel of a regular phi grid.
+
+	The phase matrix exp(-2i*phi[c*m+t]*dl2) is the product of the
+	chunk start phases starts[c] = exp(-2i*(phi0+c*m*step)*dl2) and
+	the offset phases offsets[t] = exp(-2i*t*step*dl2), with
+	m ~ sqrt(nphi). Kernels only depend on the grid and dl2, so they
+	are kept in an in-memory cache shared by all transforms.
+	"""
+	key = _array_key(dl2,[phi0,step,nphi])
+	kernel = _cache_get(_kernel_cache,key)
+	if kernel is None:
+		m = int(ceil(sqrt(nphi)))
+		nchunk = int(ceil(nphi/float(m)))
+		offsets = _phase_powers(-2.*step*dl2,m)
+		starts = _phase_powers(-2.*m*step*dl2,nchunk)*exp(-2.j*phi0*dl2)
+		kernel = _cache_put(_kernel_cache,key,(starts,offsets),KERNEL_CACHE_MAX_BYTES)
+	return kernel
+
+def faraday_transform(phi,dl2,vals,max_mem=2**26):
+	"""
+	Compute sum(vals*exp(-2i*phi*dl2)) over channels for every phi.
+
+	The transform is evaluated as matrix products over chunks of
+	phi, each sized so that its phase matrix fits in max_mem bytes.
+	If phi is regularly spaced the phase matrix is factorised as
+	exp(-2i*(phi_c+t*dphi)*dl2) = exp(-2i*phi_c*dl2)*exp(-2i*t*dphi*dl2)
+	(see _phase_kernel), so only ~2*sqrt(len(phi)) rows of phases
+	are needed. For a single spectrum the sum then reduces to a
+	single matrix product.
+
+	Parameters
+	----------
+	phi : array
+	   RM values to evaluate
+	dl2 : array
+	   Lambda-squared values relative to the reference lambda-squared
+	vals : array
+	   (Weighted) complex values per channel, either of shape
+	   (nchan,) or (nchan, nspec) to transform nspec spectra at once
+	max_mem : int, optional (default 2**26)
+	   Memory budget in bytes for the intermediate phase matrices
+
+	Returns
+	-------
+	out : array
+	   Complex transform of shape (len(phi),) or (len(phi), nspec)
+
+	"""
+	phi = asarray(phi,dtype=float)
+	dl2 = asarray(dl2,dtype=float)
+	vals = asarray(vals,dtype=complex)
+	nphi = len(phi)
+	nchan = len(dl2)
+	out = zeros((nphi,)+vals.shape[1:],dtype=complex)
+	if nphi == 0 or nchan == 0:
+		return out
+	# Number of phi values whose phase matrix fits in the memory budget
+	chunk = max(1,int(max_mem//(16*nchan)))
+
+	step = (phi[-1]-phi[0])/(nphi-1) if nphi > 1 else 0.
+	regular = nphi > 2 and step != 0. and allclose(diff(phi),step,rtol=1e-9,atol=0.)
+	# The kernel has ~2*sqrt(nphi) rows, use it if they fit in the budget
+	m = int(ceil(sqrt(nphi)))
+	if regular and (m+int(ceil(nphi/float(m)))) <= chunk:
+		starts,offsets = _phase_kernel(phi[0],step,nphi,dl2)
+		if vals.ndim == 1:
+			# phi[c*m+t] = phi[0]+(c*m+t)*step, so out[c*m+t] = sum(starts[c]*vals*offsets[t])
+			out[:] = dot(starts*vals,offsets.T).ravel()[:nphi]
+		else:
+			# Build each chunk of the phase matrix from its start phases and the offsets
+			rows = max(1,chunk//m)
+			for c0 in range(0,len(starts),rows):
+				phase = (starts[c0:c0+rows,None,:]*offsets[None,:,:]).reshape(-1,nchan)
+				j0 = c0*m
+				out[j0:j0+len(phase)] = dot(phase[:nphi-j0],vals)
+	else:
+		for j0 in range(0,nphi,chunk):
+			out[j0:j0+chunk] = dot(exp(-2.j*outer(phi[j0:j0+chunk],dl2)),vals)
+	return out
+
+def _rmsf_disk_file(key):
+	return os.path.join(cache_utils.get_cache_dir("rmsf"),"%s.npy"%(key))
+
+def get_rmsf(rmsf_phi,l2,weights,disk_cache=False,max_mem=2**26):
+	"""
+	Return the RMSF, reusing it if it has been computed before.
+
+	The RMSF only depends on the channel lambda-squared values, their
+	weights and rmsf_phi, so it is cached in memory keyed by a hash of
+	those. Observations with the same setup (e.g. phase ranges and
+	archives from one observation) then share a single RMSF.
+
+	Parameters
+	----------
+	rmsf_phi : array
+	   RM values of the RMSF, symmetric about zero
+	l2 : array
+	   Lambda-squared values of the channels to use
+	weights : array
+	   Weights of the channels to use
+	disk_cache : boolean, optional (default False)
+	   Also keep the RMSF in the on-disk vcstools cache (see
+	   vcstools.cache_utils), so other processes and later runs
+	   can reuse it
+	max_mem : int, optional (default 2**26)
+	   Memory budget in bytes for the phase matrices
+
+	Returns
+	-------
+	rmsf : array
+	   The (read-only) complex RMSF
+
+	"""
+	key = _array_key(l2,weights,rmsf_phi,[RMSF_CACHE_VERSION])
+	cached = _cache_get(_rmsf_cache,key)
+	if cached is not None:
+		return cached[0]
+	rmsf = None
+	if disk_cache:
+		rmsf_file = _rmsf_disk_file(key)
+		try:
+			rmsf = load(rmsf_file)
+			# Mark as recently used so it is pruned last
+			os.utime(rmsf_file)
+		except (OSError,ValueError):
+			rmsf = None
+	if rmsf is None:
+		l2 = asarray(l2,dtype=float)
+		weights = asarray(weights,dtype=float)
+		K = 1./sum(weights)
+		nrmsf = len(rmsf_phi)
+		# The weights are real and rmsf_phi is symmetric, so the RMSF is Hermitian
+		rmsf_pos = K*faraday_transform(rmsf_phi[nrmsf//2:],l2-mean(l2),weights,max_mem=max_mem)
+		rmsf = concatenate((conj(rmsf_pos[::-1][:nrmsf//2]),rmsf_pos))
+		if disk_cache:
+			try:
+				fd,tmp_file = tempfile.mkstemp(dir=os.path.dirname(rmsf_file),prefix='.tmp_',suffix='.npy')
+				with os.fdopen(fd,'wb') as f:
+					save(f,rmsf)
+				os.replace(tmp_file,rmsf_file)
+				cache_utils.prune_cache_dir(os.path.dirname(rmsf_file),RMSF_DISK_CACHE_MAX_BYTES,suffix='.npy')
+			except OSError as e:
+				print('Could not write to the RMSF cache: %s'%(e))
+	return _cache_put(_rmsf_cache,key,(asarray(rmsf,dtype=complex),),RMSF_CACHE_MAX_BYTES)[0]
 
 class PolObservation:
 	"""Class to describe an observation & perform polarimetry operations"""
@@ -80,7 +293,7 @@ class PolObservation:
 		self.rmsynth_done = False
 		self.rmclean_done = False
 
-	def rmsynthesis(self,phi,norm_mod=False,norm_vals=False,double=True,clip=None,pclip=None,weightmode='none',verbose=True):
+	def rmsynthesis(self,phi,norm_mod=False,norm_vals=False,double=True,clip=None,pclip=None,weightmode='none',verbose=True,max_mem=2**26,rmsf_disk_cache=False):
 		"""
 		Perform RM Synthesis.
 
@@ -114,6 +327,12 @@ class PolObservation:
 		   Further options may be added later.
 		verbose : boolean, optional (default True)
 		    Print some output?
+		max_mem : int, optional (default 2**26)
+		   Memory budget in bytes for the phase matrices used
+		   to compute the RMSF and FDF (see faraday_transform)
+		rmsf_disk_cache : boolean, optional (default False)
+		   Keep the RMSF in the on-disk cache as well as in
+		   memory (see get_rmsf)
 
 		"""
 
@@ -141,7 +360,7 @@ class PolObservation:
 			if verbose: print('Inverse variance weighting mode activated')
 			weights = 1./self.ierr**2
 		else:
-			print('Using uniform weights')
+			if verbose: print('Using uniform weights')
 			weights = ones(self.freq.shape)
 		K = 1./sum(weights[gp]) # Normalisation
 		if verbose: print('Normalisation value = %f'%(K))
@@ -174,16 +393,12 @@ class PolObservation:
 		else:
 			nrmsf = len(phi)
 		rmsf_phi = linspace(-float(nrmsf/2)*dphi,float(nrmsf/2)*dphi,nrmsf)
-		rmsf = zeros(rmsf_phi.shape,dtype=complex)
-		fdf = zeros(phi.shape,dtype=complex)
 
 		# Now do the work
 		if verbose: print('Calculating RMSF...')
-		for j,phival in enumerate(rmsf_phi):
-			rmsf[j]=K*sum(weights[gp]*exp(-2.*ci*phival*(l2[gp]-l20)))
+		rmsf = get_rmsf(rmsf_phi,l2[gp],weights[gp],disk_cache=rmsf_disk_cache,max_mem=max_mem)
 		if verbose: print('Calculating FDF...')
-		for j,phival in enumerate(phi):
-			fdf[j]=K*sum(quvec[gp]*weights[gp]*exp(-2.*ci*phival*(l2[gp]-l20)))
+		fdf = K*faraday_transform(phi,l2[gp]-l20,quvec[gp]*weights[gp],max_mem=max_mem)
 
 		# For later use
 		self.l20 = l20
@@ -360,34 +575,80 @@ class PolObservation:
 		zerolev = median(abs(self.fdf))
 		cleanlim = cutoff*noise+zerolev
 		if verbose: print('CLEAN will proceed down to %f'%(cleanlim))
+		nphi = self.nphi
+		# Shifted RMSF for a component at pixel l is rmsf[(nphi-l+i)%nrmsf], i = 0..nphi-1
+		def shifted_rmsf(l,pix):
+			return take(self.rmsf,nphi-l+pix,mode='wrap')
+		# tailmax[d] is the largest RMSF response d or more pixels from its peak, which
+		# bounds how much a component changes the pixels left out of a minor cycle
+		width = max(self.rmsf_fwhm_pix,1)
+		offs = arange(nphi)
+		tailmax = maximum(abs(shifted_rmsf(0,offs)),abs(shifted_rmsf(0,-offs)))
+		tailmax = append(maximum.accumulate(tailmax[::-1])[::-1],0.)
+
 		num = 0
 		res = self.fdf.copy()
 		modcomp = zeros(res.shape,dtype=complex)
-		resp = abs(res)
-		mr = range(len(resp))
-		while max(resp[mr]) > cleanlim and num < niter:
-			maxloc = where(resp[mr]==max(resp[mr]))[0]+mr[0]
-			if num==0 and verbose:
-				print('First component found at %f rad/m2'%(self.phi[maxloc]))
-			if num==0 and mask:
-				mr=range(maxloc-self.rmsf_fwhm_pix/2,maxloc+self.rmsf_fwhm_pix/2+1)
-				if verbose:
-					print('Masking: Clean components must fall within mask of %d/%d pixels'%(len(mr),len(resp)))
-					print('(i.e. within RM range %f - %f rad/m2)'%(self.phi[mr[0]],self.phi[mr[-1]]))
-			num += 1
-			if num % 10**int(log10(num)) == 0 and verbose:
-				print('Iteration %d: max residual = %f'%(num,max(resp)))
-			srmsf = roll(self.rmsf,maxloc-self.nphi)
-			modcomp[maxloc] += res[maxloc]*gain
-			subtr = res[maxloc]*gain*srmsf[:self.nphi]
-			res -= subtr
-			resp = abs(res)
+		lo, hi = 0, nphi
+		done = False
+		while not done and num < niter:
+			# Major cycle: find the pixels (and their RMSF main lobes) that could
+			# hold the peak, everything else is only updated at the next major cycle
+			resp = abs(res[lo:hi])
+			peak = max(resp)
+			if peak <= cleanlim:
+				break
+			cand = cumsum(concatenate(([0],resp > max(cleanlim,0.1*peak))))
+			near = cand[minimum(arange(1,hi-lo+1)+width,hi-lo)]-cand[maximum(arange(hi-lo)-width,0)] > 0
+			active = flatnonzero(near)+lo
+			inactive = flatnonzero(~near)+lo
+			if len(inactive):
+				other = max(resp[~near])
+				k = clip(searchsorted(inactive,active),1,len(inactive)-1)
+				dist = minimum(abs(active-inactive[k-1]),abs(inactive[k]-active)) if len(inactive) > 1 else abs(active-inactive[0])
+			else:
+				other = 0.
+				dist = full(len(active),nphi)
+			ares = res[active]
+			comps = {}
+			drift = 0.
+			while num < niter:
+				aresp = abs(ares)
+				j = argmax(aresp)
+				if aresp[j] <= other+drift:
+					# An inactive pixel may now be the peak
+					break
+				if aresp[j] <= cleanlim:
+					done = True
+					break
+				maxloc = active[j]
+				if num==0 and verbose:
+					print('First component found at %f rad/m2'%(self.phi[maxloc]))
+				num += 1
+				if num % 10**int(log10(num)) == 0 and verbose:
+					print('Iteration %d: max residual = %f'%(num,aresp[j]))
+				comp = ares[j]*gain
+				modcomp[maxloc] += comp
+				comps[maxloc] = comps.get(maxloc,0.)+comp
+				ares -= comp*shifted_rmsf(maxloc,active)
+				drift += abs(comp)*tailmax[dist[j]]
+				if num==1 and mask:
+					lo = max(maxloc-self.rmsf_fwhm_pix//2,0)
+					hi = min(maxloc+self.rmsf_fwhm_pix//2+1,nphi)
+					if verbose:
+						print('Masking: Clean components must fall within mask of %d/%d pixels'%(hi-lo,nphi))
+						print('(i.e. within RM range %f - %f rad/m2)'%(self.phi[lo],self.phi[hi-1]))
+					break
+			# Subtract this minor cycle's components from the full residual
+			pix = arange(nphi)
+			for l,comp in comps.items():
+				res -= comp*shifted_rmsf(l,pix)
 		if verbose: print('Convolving clean components...')
 		if 10*self.rmsf_fwhm_pix > len(self.phi):
 			kernel = exp(-(self.phi-mean(self.phi))**2/(2.*(self.rmsf_fwhm/2.355)**2))
 		else:
 			kernel = exp(-arange(-self.rmsf_fwhm*5.,self.rmsf_fwhm*5.,self.dphi)**2/(2.*(self.rmsf_fwhm/2.355)**2))
-		self.rm_model = convolve(modcomp,kernel,mode='same')
+		self.rm_model = fftconvolve(modcomp,kernel,mode='same')
 		if verbose: print('Restoring convolved clean components...')
 		self.rm_cleaned = self.rm_model + res
 		self.rm_comps = modcomp
@@ -5,6 +5,11 @@ import logging
 import argparse
 import os
 import sys
+import csv
+import glob
+import hashlib
+import functools
+import multiprocessing
 import numpy as np
 import psrqpy
 
@@ -13,11 +18,9 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-#Astropy
-from astropy.table import Table
-
 #vcstools and mwa_search
 from vcstools import data_load
+from vcstools import cache_utils
 
 from mwa_pb import primarybeammap_tant as pbtant
 import find_pulsar_in_obs as fpio
@@ -27,6 +30,154 @@ import process_vcs
 
 logger = logging.getLogger(__name__)
 
+#The LST tolerance (in hours) used to bin sky temperatures in the cache
+TSKY_LST_TOL = 0.1
+#Ratio of a sidereal day to a solar day
+SIDEREAL_FRAC = 0.9972695663
+#Sky temperatures that have been read from (or written to) the cache by this process
+_tsky_cache = None
+#Spectral models that have been read from (or written to) the cache by this process, see get_spectral_model()
+_spectral_model_cache = None
+_spectral_model_cache_version = None
+#The ATNF flux density parameters and their frequencies in MHz
+ATNF_FLUX_QUERIES = ["S40", "S50", "S60", "S80", "S100", "S150", "S200",\
+                     "S300", "S400", "S600", "S700", "S800", "S900",\
+                     "S1400", "S1600", "S2000", "S3000", "S4000", "S5000",\
+                     "S6000", "S8000"]
+
+
+#---------------------------------------------------------------
+class ObservationContext:
+    """
+    Holds the observation-level quantities that are needed to estimate the S/N of a pulsar.
+    These are the same for every pulsar in an observation so they are only calculated once
+    and shared between calls to est_pulsar_sn() and find_t_sys_gain().
+    The sky temperature is the expensive part and is only evaluated when first requested.
+
+    Parameters:
+    -----------
+    obsid: int
+        The observation ID
+    obs_metadata: list
+        OPTIONAL - the array generated from mwa_metadb_utils.get_common_obs_metadata(obsid). Default: None
+    full_meta: dict
+        OPTIONAL - the full metadata dictionary from mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True). Default: None
+    beg: int
+        OPTIONAL - The beginning of the processed observing time in gps time. If None, will use the beginning of the obs. Default: None
+    end: int
+        OPTIONAL - The end of the processed observing time in gps time. If None, will use the end of the obs. Default: None
+    beam_model: str
+        OPTIONAL - The primary beam model to use for the sky temperature. Default: 'analytic'
+    trcvr: str
+        OPTIONAL - The location of the MWA receiver temp csv file. Default = <vcstools_data_dir>MWA_Trcvr_tile_56.csv
+    lst_tol: float
+        OPTIONAL - The LST tolerance in hours used by the T_sky cache. Default: TSKY_LST_TOL
+    use_tsky_cache: boolean
+        OPTIONAL - Whether to use the on-disk T_sky cache. Default: True
+    """
+    def __init__(self, obsid, obs_metadata=None, full_meta=None, beg=None, end=None,
+                 beam_model="analytic", trcvr=data_load.TRCVR_FILE, lst_tol=TSKY_LST_TOL, use_tsky_cache=True):
+        self.obsid = int(obsid)
+        if not obs_metadata or not full_meta:
+            logger.debug("Obtaining obs metadata")
+            obs_metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(self.obsid, return_all=True)
+        self.obs_metadata = obs_metadata
+        self.full_meta = full_meta
+        _, self.obs_ra, self.obs_dec, self.duration, self.delays, self.centrefreq, self.channels = obs_metadata
+        self.beam_model = beam_model
+        self.trcvr = trcvr
+        self.lst_tol = lst_tol
+        self.use_tsky_cache = use_tsky_cache
+
+        #time ranges
+        self.obs_beg, self.obs_end = mwa_metadb_utils.obs_max_min(self.obsid, meta=full_meta)
+        self.beg = self.obs_beg if beg is None else beg
+        self.end = self.obs_end if end is None else end
+
+        #filled in when first requested
+        self.t_sky = {}
+        #beam enter and exit times of each pulsar, see find_beam_track()
+        self.beam_tracks = {}
+        #times in the beam, beam power and zenith angle of each pulsar, see pulsar_beam_power()
+        self.beam_powers = {}
+
+    def get_t_sky(self, freq=None):
+        """
+        The sky temperature convolved with the primary beam at a frequency
+
+        Parameters:
+        -----------
+        freq: float
+            OPTIONAL - The frequency in MHz. If None, will use the centre frequency of the observation. Default: None
+
+        Returns:
+        --------
+        t_sky: float
+            The average of the XX and YY sky temperatures
+        """
+        if freq is None:
+            freq = self.centrefreq
+        if freq not in self.t_sky:
+            self.t_sky[freq] = get_sky_temp(self.obsid, self.delays, freq, beam_model=self.beam_model,\
+                                            lst_tol=self.lst_tol, use_cache=self.use_tsky_cache)
+        return self.t_sky[freq]
+
+    def get_t_rec(self, freq=None):
+        """
+        The receiver temperature at one or many frequencies
+
+        Parameters:
+        -----------
+        freq: float or array_like
+            OPTIONAL - The frequencies in MHz. If None, will use the centre frequency of the observation. Default: None
+
+        Returns:
+        --------
+        t_rec: float or numpy.array
+            The receiver temperatures
+        """
+        if freq is None:
+            freq = self.centrefreq
+        return submit_to_database.trec(freq, trcvr=self.trcvr)
+
+    def get_t_sys(self, freq=None):
+        """
+        The system temperature at one or many frequencies. Other temperatures than T_sky and T_rec are assumed to be negligible
+
+        Parameters:
+        -----------
+        freq: float or array_like
+            OPTIONAL - The frequencies in MHz. If None, will use the centre frequency of the observation. Default: None
+
+        Returns:
+        --------
+        t_sys: float or numpy.array
+            The system temperatures
+        t_sys_err: float or numpy.array
+            The system temperatures' uncertainties
+        """
+        if freq is None:
+            freq = self.centrefreq
+        if np.ndim(freq) == 0:
+            t_sky = self.get_t_sky(freq=freq)
+        else:
+            t_sky = np.array([self.get_t_sky(freq=f) for f in np.asarray(freq, dtype=float)])
+        t_sys = t_sky + self.get_t_rec(freq=freq)
+        t_sys_err = t_sys*0.02 #TODO: figure out what t_sys error is
+        return t_sys, t_sys_err
+
+    def get_channel_t_sys(self):
+        """
+        The system temperature of each coarse channel of the observation
+
+        Returns:
+        --------
+        t_sys: numpy.array
+            The system temperature of each coarse channel
+        t_sys_err: numpy.array
+            The system temperatures' uncertainties
+        """
+        return self.get_t_sys(freq=np.array(self.channels)*1.28)
 
 #---------------------------------------------------------------
 def plot_flux_estimation(pulsar, nu_atnf, S_atnf, S_atnf_e, a,\
@@ -150,7 +301,259 @@ def plot_flux_estimation(pulsar, nu_atnf, S_atnf, S_atnf_e, a,\
     plt.close()
 
 #---------------------------------------------------------------
-def pulsar_beam_coverage(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None, ondisk=False, min_z_power=0.3, query=None):
+def lst_from_gps(gps):
+    """
+    Calculates the local sidereal time at the MWA
+
+    Parameters:
+    -----------
+    gps: float
+        The time in gps seconds
+
+    Returns:
+    --------
+    lst: float
+        The apparent local sidereal time in hours
+    """
+    from astropy.time import Time
+    from astropy.coordinates import EarthLocation
+    earth_location = EarthLocation.from_geodetic(lon="116:40:14.93", lat="-26:42:11.95", height=377.8)
+    return Time(float(gps), format='gps').sidereal_time('apparent', longitude=earth_location.lon).hour
+
+#---------------------------------------------------------------
+def tsky_cache_key(delays, freq, beam_model, lst, lst_tol=TSKY_LST_TOL):
+    """
+    Makes the key used to store a sky temperature in the T_sky cache
+
+    Parameters:
+    -----------
+    delays: list
+        The beamformer delays in the format [xdelays, ydelays]
+    freq: float
+        The frequency in MHz
+    beam_model: str
+        The primary beam model
+    lst: float
+        The local sidereal time in hours
+    lst_tol: float
+        OPTIONAL - The width of the LST bins in hours. Default: TSKY_LST_TOL
+
+    Returns:
+    --------
+    key: tuple
+        (delays, frequency, beam model, LST tolerance, LST bin)
+    """
+    n_bins = int(round(24./lst_tol))
+    lst_bin = int(round(lst/lst_tol)) % n_bins
+    delays = tuple(tuple(int(d) for d in pol_delays) for pol_delays in delays)
+    return (delays, round(float(freq), 3), beam_model, float(lst_tol), lst_bin)
+
+def _tsky_cache_file():
+    return os.path.join(cache_utils.get_cache_dir(), "tsky_cache.pkl")
+
+def save_tsky_cache():
+    """
+    Merges the sky temperatures calculated by this process into the on-disk T_sky cache
+    """
+    global _tsky_cache
+    if _tsky_cache:
+        _tsky_cache = cache_utils.update_pickle(_tsky_cache_file(), _tsky_cache)
+
+#---------------------------------------------------------------
+def get_sky_temp(gps, delays, freq, beam_model="analytic", lst_tol=TSKY_LST_TOL, use_cache=True, save=True):
+    """
+    Finds the sky temperature convolved with the primary beam.
+    The full sky integration is expensive and only depends on the pointing, frequency, beam model and LST,
+    so the result is stored in an on-disk cache that is shared between processes.
+
+    Parameters:
+    -----------
+    gps: int
+        The time in gps seconds (usually the obsid)
+    delays: list
+        The beamformer delays in the format [xdelays, ydelays]
+    freq: float
+        The frequency in MHz
+    beam_model: str
+        OPTIONAL - The primary beam model. Default: 'analytic'
+    lst_tol: float
+        OPTIONAL - The width of the LST bins in hours. Times within the same bin share a sky temperature. Default: TSKY_LST_TOL
+    use_cache: boolean
+        OPTIONAL - If False, will always calculate the sky temperature and not touch the cache. Default: True
+    save: boolean
+        OPTIONAL - If False, new values are only kept in memory until save_tsky_cache() is called. Default: True
+
+    Returns:
+    --------
+    t_sky: float
+        The average of the XX and YY sky temperatures
+    """
+    global _tsky_cache
+    if use_cache:
+        key = tsky_cache_key(delays, freq, beam_model, lst_from_gps(gps), lst_tol=lst_tol)
+        if _tsky_cache is None or (save and key not in _tsky_cache):
+            #another process may have calculated it since we last looked
+            _tsky_cache = cache_utils.load_pickle(_tsky_cache_file(), default={})
+        if key in _tsky_cache:
+            logger.debug("Using cached sky temperature for {}".format(key))
+            return _tsky_cache[key]
+
+    logger.debug("Calculating the sky temperature at gps {0}, {1} MHz".format(gps, freq))
+    # Usa a primary beam function to convolve the sky temperature with the primary beam
+    # (prints suppressed)
+    sys.stdout = open(os.devnull, 'w')
+    _, _, Tsky_XX, _, _, _, Tsky_YY, _ = pbtant.make_primarybeammap(int(gps), delays, freq*1e6,\
+                                                                    beam_model, plottype='None')
+    sys.stdout = sys.__stdout__
+    #TODO can be inaccurate for coherent but is too difficult to simulate
+    t_sky = np.mean((Tsky_XX + Tsky_YY) / 2.)
+
+    if use_cache:
+        _tsky_cache[key] = t_sky
+        if save:
+            save_tsky_cache()
+    return t_sky
+
+#---------------------------------------------------------------
+def prewarm_tsky_cache(freqs, sweet_spots=None, beam_model="analytic", lst_tol=TSKY_LST_TOL, ref_gps=1.2e9, save_every=50):
+    """
+    Fills the T_sky cache for the sweet spot pointings at every LST bin.
+    The sweet spots can be split between jobs which can all safely write to the same cache.
+
+    Parameters:
+    -----------
+    freqs: list
+        The frequencies in MHz
+    sweet_spots: list
+        OPTIONAL - The sweet spot grid numbers to calculate. If None, will use all of them. Default: None
+    beam_model: str
+        OPTIONAL - The primary beam model. Default: 'analytic'
+    lst_tol: float
+        OPTIONAL - The width of the LST bins in hours. Default: TSKY_LST_TOL
+    ref_gps: float
+        OPTIONAL - The gps time the LSTs are calculated from. Default: 1.2e9
+    save_every: int
+        OPTIONAL - The number of new sky temperatures to calculate between writes to the cache. Default: 50
+    """
+    from mwa_pb import mwa_sweet_spots
+
+    if sweet_spots is None:
+        sweet_spots = sorted(mwa_sweet_spots.all_grid_points.keys())
+    ref_lst = lst_from_gps(ref_gps)
+    n_bins = int(round(24./lst_tol))
+
+    n_new = 0
+    for spot in sweet_spots:
+        spot_delays = mwa_sweet_spots.all_grid_points[spot][4]
+        logger.info("Calculating sky temperatures for sweet spot {}".format(spot))
+        for lst_bin in range(n_bins):
+            #gps time when the LST is at the centre of this bin
+            gps = ref_gps + ((lst_bin*lst_tol - ref_lst) % 24.) * 3600. * SIDEREAL_FRAC
+            for freq in freqs:
+                get_sky_temp(gps, [spot_delays, spot_delays], freq, beam_model=beam_model,\
+                             lst_tol=lst_tol, save=False)
+                n_new += 1
+                if n_new % save_every == 0:
+                    save_tsky_cache()
+    save_tsky_cache()
+
+#---------------------------------------------------------------
+def find_beam_track(obsid, pulsar, min_z_power=0.3, beam_model="analytic", metadata=None, full_meta=None,\
+                    query=None, obs_context=None):
+    """
+    Finds the normalised times that a pulsar enters and exits the primary beam over the whole observation.
+    This requires the beam power to be calculated over the observation, so when an ObservationContext is
+    supplied the result is stored in it and is only calculated once per (obsid, pulsar, min_z_power, beam_model).
+
+    Parameters:
+    -----------
+    obsid: int
+        The observation ID
+    pulsar: string
+        The pulsar's J name
+    min_z_power: float
+        OPTIONAL - The minimum zenith normalised power for the pulsar to be considered in the beam. Default: 0.3
+    beam_model: str
+        OPTIONAL - The primary beam model. Default: 'analytic'
+    metadata: list
+        OPTIONAL - the array generated from mwa_metadb_utils.get_common_obs_metadata(obsid). Default: None
+    full_meta: dict
+        OPTIONAL - the full metadata dictionary for this obsid. Default: None
+    query: object
+        OPTIONAL - The return from psrqpy.QueryATNF for this pulsar. Default: None
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities where the result is memoised. Default: None
+
+    Returns:
+    --------
+    enter_obs_norm: float
+        A float between 0 and 1 that describes the normalised time of the observation that the pulsar enters the beam.
+        None if the pulsar is not in the beam
+    exit_obs_norm: float
+        A float between 0 and 1 that describes the normalised time of the observation that the pulsar exits the beam
+        None if the pulsar is not in the beam
+    """
+    key = (int(obsid), pulsar, min_z_power, beam_model)
+    if obs_context is not None:
+        if key in obs_context.beam_tracks:
+            return obs_context.beam_tracks[key]
+        metadata, full_meta = obs_context.obs_metadata, obs_context.full_meta
+    elif not metadata or not full_meta:
+        metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
+
+    names_ra_dec = fpio.grab_source_alog(pulsar_list=[pulsar], query=query)
+    beam_source_data, _ = fpio.find_sources_in_obs([obsid], names_ra_dec, min_power=min_z_power, beam=beam_model,\
+                                                   metadata_list=[[metadata, full_meta]])
+    if beam_source_data[obsid]:
+        track = (beam_source_data[obsid][0][1], beam_source_data[obsid][0][2])
+    else:
+        track = (None, None)
+
+    if obs_context is not None:
+        obs_context.beam_tracks[key] = track
+    return track
+
+#---------------------------------------------------------------
+def find_beam_tracks(obsid, query, min_z_power=0.3, beam_model="analytic", obs_context=None):
+    """
+    Finds the beam tracks (see find_beam_track()) of every pulsar in an ATNF query with a single beam power calculation.
+    The tracks are stored in obs_context so later calls to find_beam_track() don't recalculate them
+
+    Parameters:
+    -----------
+    obsid: int
+        The observation ID
+    query: object
+        The return from psrqpy.QueryATNF(...).pandas for any number of pulsars
+    min_z_power: float
+        OPTIONAL - The minimum zenith normalised power for the pulsar to be considered in the beam. Default: 0.3
+    beam_model: str
+        OPTIONAL - The primary beam model. Default: 'analytic'
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities where the results are memoised. If None, one will be made. Default: None
+
+    Returns:
+    --------
+    tracks: dictionary
+        tracks[pulsar] = (enter_obs_norm, exit_obs_norm). Both are None if the pulsar is not in the beam
+    """
+    if obs_context is None:
+        obs_context = ObservationContext(obsid, beam_model=beam_model)
+    pulsars = list(query["PSRJ"])
+    names_ra_dec = fpio.grab_source_alog(pulsar_list=pulsars, query=query)
+    beam_source_data, _ = fpio.find_sources_in_obs([obsid], names_ra_dec, min_power=min_z_power, beam=beam_model,\
+                                                   metadata_list=[[obs_context.obs_metadata, obs_context.full_meta]])
+
+    tracks = {pulsar:(None, None) for pulsar in pulsars}
+    for pulsar, enter, exit, _ in beam_source_data.get(obsid, []):
+        tracks[pulsar] = (enter, exit)
+    for pulsar, track in tracks.items():
+        obs_context.beam_tracks[(int(obsid), pulsar, min_z_power, beam_model)] = track
+    return tracks
+
+#---------------------------------------------------------------
+def pulsar_beam_coverage(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None, ondisk=False, min_z_power=0.3, query=None,
+                         obs_context=None, beam_model="analytic"):
     """
     Finds the normalised time that a pulsar is in the beam for a given obsid
     If pulsar is not in beam, returns None, None
@@ -171,6 +574,10 @@ def pulsar_beam_coverage(obsid, pulsar, beg=None, end=None, metadata=None, full_
         OPTIONAL - The end of the observation in gps time
     ondisk: boolean
         Whether to use files that are on-disk for beginning and end times. Default=False
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities. If supplied, the metadata and observation times are taken from it. Default: None
+    beam_model: str
+        OPTIONAL - The primary beam model. Default: 'analytic'
 
     Returns:
     --------
@@ -179,11 +586,14 @@ def pulsar_beam_coverage(obsid, pulsar, beg=None, end=None, metadata=None, full_
     exit_files: float
          a float between 0 and 1 that describes the normalised time that the pulsar exits the beam
     """
-    if not metadata or not full_meta:
-        metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
-
-    #Find the beginning and end of obs
-    obs_beg, obs_end = files_beg, files_end = mwa_metadb_utils.obs_max_min(obsid, meta=full_meta)
+    if obs_context is not None:
+        metadata, full_meta = obs_context.obs_metadata, obs_context.full_meta
+        obs_beg, obs_end = obs_context.obs_beg, obs_context.obs_end
+    else:
+        if not metadata or not full_meta:
+            metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
+        #Find the beginning and end of obs
+        obs_beg, obs_end = mwa_metadb_utils.obs_max_min(obsid, meta=full_meta)
     obs_dur = obs_end-obs_beg + 1
 
     #Logic loop:
@@ -201,12 +611,9 @@ def pulsar_beam_coverage(obsid, pulsar, beg=None, end=None, metadata=None, full_
         files_duration = files_end - files_beg + 1
 
     #find the enter and exit times of pulsar normalized with the observing time
-    names_ra_dec = fpio.grab_source_alog(pulsar_list=[pulsar], query=query)
-    beam_source_data, _ = fpio.find_sources_in_obs([obsid], names_ra_dec, min_power=min_z_power, metadata_list=[[metadata, full_meta]])
-    if beam_source_data[obsid]:
-        enter_obs_norm = beam_source_data[obsid][0][1]
-        exit_obs_norm = beam_source_data[obsid][0][2]
-    else:
+    enter_obs_norm, exit_obs_norm = find_beam_track(obsid, pulsar, min_z_power=min_z_power, beam_model=beam_model,\
+                                                    metadata=metadata, full_meta=full_meta, query=query, obs_context=obs_context)
+    if enter_obs_norm is None or exit_obs_norm is None:
         logger.warn("{} not in beam".format(pulsar))
         return None, None
 
@@ -427,15 +834,11 @@ def flux_from_atnf(pulsar, query=None):
     if query is None:
         query = psrqpy.QueryATNF(psrs=[pulsar], loadfromdb=data_load.ATNF_LOC).pandas
 
-    flux_queries = ["S40", "S50", "S60", "S80", "S100", "S150", "S200",\
-                    "S300", "S400", "S600", "S700", "S800", "S900",\
-                    "S1400", "S1600", "S2000", "S3000", "S4000", "S5000",\
-                    "S6000", "S8000"]
     freq_all=[]
     flux_all=[]
     flux_err_all=[]
     #Get all available data from dataframe and check for missing values
-    for flux_query in flux_queries:
+    for flux_query in ATNF_FLUX_QUERIES:
         flux = query[flux_query][0]
         if not np.isnan(flux):
             #sometimes error values don't exist, causing a key error in pandas
@@ -524,7 +927,148 @@ def find_spind(pulsar, freq_all, flux_all, flux_err_all):
     return spind, spind_err, K, covar_mat
 
 #---------------------------------------------------------------
-def est_pulsar_flux(pulsar, obsid, plot_flux=False, metadata=None, query=None):
+@functools.lru_cache(maxsize=None)
+def _hash_file(path, mtime_ns, size):
+    #mtime_ns and size are only here so that a changed file isn't served from the lru_cache
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def catalogue_version(atnf_loc=data_load.ATNF_LOC):
+    """
+    Identifies the version of the ATNF catalogue from a hash of psrcat.db. The file is only rehashed when it changes
+
+    Parameters:
+    -----------
+    atnf_loc: str
+        OPTIONAL - The location of the psrcat.db file. Default: data_load.ATNF_LOC
+
+    Returns:
+    --------
+    version: str
+        The hash of the catalogue. 'none' if the file doesn't exist
+    """
+    if not os.path.exists(atnf_loc):
+        return "none"
+    stat = os.stat(atnf_loc)
+    return _hash_file(atnf_loc, stat.st_mtime_ns, stat.st_size)
+
+def _spectral_model_cache_file(version):
+    return os.path.join(cache_utils.get_cache_dir(), "spectral_models_{}.pkl".format(version[:16]))
+
+def _load_spectral_model_cache():
+    """
+    Loads the spectral models of the current catalogue version and removes the cache files of old versions
+    """
+    global _spectral_model_cache, _spectral_model_cache_version
+    version = catalogue_version()
+    cache_file = _spectral_model_cache_file(version)
+    if version != _spectral_model_cache_version:
+        for old_file in glob.glob(os.path.join(os.path.dirname(cache_file), "spectral_models_*.pkl*")):
+            if old_file not in (cache_file, cache_file + ".lock"):
+                logger.info("psrcat.db has changed. Removing old spectral model cache {}".format(old_file))
+                try:
+                    os.remove(old_file)
+                except OSError:
+                    pass
+        _spectral_model_cache_version = version
+    _spectral_model_cache = cache_utils.load_pickle(cache_file, default={})
+
+def save_spectral_model_cache():
+    """
+    Merges the spectral models fit by this process into the on-disk spectral model cache
+    """
+    global _spectral_model_cache
+    if _spectral_model_cache:
+        _spectral_model_cache = cache_utils.update_pickle(_spectral_model_cache_file(_spectral_model_cache_version),\
+                                                          _spectral_model_cache)
+
+def fit_spectral_model(pulsar, query=None):
+    """
+    Fits a pulsar's spectrum from the ATNF flux densities. See find_spind()
+
+    Parameters:
+    -----------
+    pulsar: string
+        The J name of the pulsar
+    query: object
+        OPTIONAL - The return from psrqpy.QueryATNF for this pulsar. Default: None
+
+    Returns:
+    --------
+    model: dictionary
+        The keys are:
+        "method": 'plaw' for a power law fit, 'spind' for a spectral index from the first flux density or None if there are no flux densities
+        "spind", "spind_err", "K", "covar_mat": from find_spind()
+        "freq_all", "flux_all", "flux_err_all": the flux densities from flux_from_atnf()
+    """
+    freq_all, flux_all, flux_err_all, _, _ = flux_from_atnf(pulsar, query=query)
+    logger.debug("Freqs: {0}".format(freq_all))
+    logger.debug("Fluxes: {0}".format(flux_all))
+    logger.debug("Flux Errors: {0}".format(flux_err_all))
+    logger.info("{0} there are {1} flux values available on the ATNF database"\
+                .format(pulsar, len(flux_all)))
+
+    spind, spind_err, K, covar_mat = find_spind(pulsar, freq_all, flux_all, flux_err_all)
+    if K and covar_mat is not None and spind:
+        method = "plaw"
+    elif spind and spind_err:
+        method = "spind"
+    else:
+        method = None
+    return {"method":method, "spind":spind, "spind_err":spind_err, "K":K, "covar_mat":covar_mat,\
+            "freq_all":freq_all, "flux_all":flux_all, "flux_err_all":flux_err_all}
+
+def _spectral_models():
+    """
+    Returns the in-memory spectral models of the current catalogue version. They are only loaded from disk when the version changes
+    """
+    if _spectral_model_cache is None or catalogue_version() != _spectral_model_cache_version:
+        _load_spectral_model_cache()
+    return _spectral_model_cache
+
+def get_spectral_model(pulsar, query=None, use_cache=True, save=True):
+    """
+    Gets a pulsar's spectral model (see fit_spectral_model()). The fit only depends on the catalogue
+    so it is stored in an on-disk cache per catalogue version, which is loaded once and cleared when psrcat.db changes.
+    A cached model is used without querying the catalogue.
+
+    Parameters:
+    -----------
+    pulsar: string
+        The J name of the pulsar
+    query: object
+        OPTIONAL - The return from psrqpy.QueryATNF for this pulsar. Only used if the model has to be fit. Default: None
+    use_cache: boolean
+        OPTIONAL - If False, will always fit the model and not touch the cache. Default: True
+    save: boolean
+        OPTIONAL - If False, new models are only kept in memory until save_spectral_model_cache() is called.
+        Use this when getting the models of many pulsars and save once at the end. Default: True
+
+    Returns:
+    --------
+    model: dictionary
+        See fit_spectral_model()
+    """
+    if not use_cache:
+        return fit_spectral_model(pulsar, query=query)
+
+    models = _spectral_models()
+    model = models.get(pulsar)
+    if model is not None:
+        logger.debug("Using cached spectral model for {}".format(pulsar))
+        return model
+
+    model = fit_spectral_model(pulsar, query=query)
+    models[pulsar] = model
+    if save:
+        save_spectral_model_cache()
+    return model
+
+#---------------------------------------------------------------
+def est_pulsar_flux(pulsar, obsid, plot_flux=False, metadata=None, query=None, use_cache=True, save_cache=True):
     """
     Estimates a pulsar's flux from archival data by assuming a power law relation between flux and frequency
 
@@ -540,6 +1084,10 @@ def est_pulsar_flux(pulsar, obsid, plot_flux=False, metadata=None, query=None):
         OPTIONAL - The metadata call for this obsid
     query: object
         OPTIONAL - The return from psrqpy.QueryATNF for this pulsar
+    use_cache: boolean
+        OPTIONAL - Whether to use the on-disk spectral model cache. See get_spectral_model(). Default: True
+    save_cache: boolean
+        OPTIONAL - Whether to save a newly fit spectral model to disk straight away. See get_spectral_model(). Default: True
 
     Returns:
     -------
@@ -554,20 +1102,13 @@ def est_pulsar_flux(pulsar, obsid, plot_flux=False, metadata=None, query=None):
         metadata = mwa_metadb_utils.get_common_obs_metadata(obsid)
     f_mean = metadata[5]*1e6
 
-    freq_all, flux_all, flux_err_all, spind, spind_err = flux_from_atnf(pulsar, query=query)
-
-    logger.debug("Freqs: {0}".format(freq_all))
-    logger.debug("Fluxes: {0}".format(flux_all))
-    logger.debug("Flux Errors: {0}".format(flux_err_all))
-    logger.info("{0} there are {1} flux values available on the ATNF database"\
-                .format(pulsar, len(flux_all)))
-
-    if not spind or spind_err:
-        spind, spind_err, K, covar_mat = find_spind(pulsar, freq_all, flux_all, flux_err_all)
+    model = get_spectral_model(pulsar, query=query, use_cache=use_cache, save=save_cache)
+    spind, spind_err, K, covar_mat = model["spind"], model["spind_err"], model["K"], model["covar_mat"]
+    freq_all, flux_all, flux_err_all = model["freq_all"], model["flux_all"], model["flux_err_all"]
 
-    if K and covar_mat is not None and spind:
+    if model["method"] == "plaw":
         flux_est, flux_est_err = flux_from_plaw(f_mean, K, spind, covar_mat)
-    elif spind and spind_err:
+    elif model["method"] == "spind":
         flux_est, flux_est_err = flux_from_spind(f_mean, freq_all[0], flux_all[0], flux_err_all[0],\
                                                 spind, spind_err)
     else:
@@ -650,7 +1191,189 @@ def find_pulsar_w50(pulsar, query=None):
     return W_50, W_50_err
 
 #---------------------------------------------------------------
-def find_times(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None, min_z_power=0.3, query=None):
+def flux_from_atnf_df(query):
+    """
+    Array version of flux_from_atnf(). Reads the flux densities of every pulsar in an ATNF query at once.
+    Missing flux densities are masked. Missing or zero uncertainties are assumed to be 20% of the flux
+
+    Parameters:
+    -----------
+    query: object
+        The return from psrqpy.QueryATNF(...).pandas for any number of pulsars
+
+    Returns:
+    --------
+    freqs: numpy.array
+        The frequencies of the ATNF flux densities in Hz. Shape (n_freq,)
+    fluxes: numpy.ma.MaskedArray
+        The flux densities in Jy. Shape (n_psr, n_freq)
+    flux_errs: numpy.ma.MaskedArray
+        The uncertainties of the flux densities in Jy. Shape (n_psr, n_freq)
+    """
+    freqs = np.array([int(flux_query[1:])*1e6 for flux_query in ATNF_FLUX_QUERIES])
+    fluxes = np.array([np.asarray(query[flux_query], dtype=float) for flux_query in ATNF_FLUX_QUERIES]).T
+    flux_errs = []
+    for flux_query in ATNF_FLUX_QUERIES:
+        try:
+            flux_errs.append(np.asarray(query[flux_query+"_ERR"], dtype=float))
+        except KeyError:
+            flux_errs.append(np.full(fluxes.shape[0], np.nan))
+    flux_errs = np.array(flux_errs).T
+    flux_errs = np.where(np.isnan(flux_errs) | (flux_errs == 0.0), fluxes*0.2, flux_errs)
+
+    mask = np.isnan(fluxes)
+    fluxes = np.ma.masked_array(fluxes*1e-3, mask=mask) #convert to Jy
+    flux_errs = np.ma.masked_array(flux_errs*1e-3, mask=mask)
+    return freqs, fluxes, flux_errs
+
+#---------------------------------------------------------------
+def least_squares_fit_plaw_array(x_data, y_data, y_err):
+    """
+    Array version of least_squares_fit_plaw(). Fits a power law to every row of y_data at once.
+    Masked values are given zero weight
+
+    Parameters:
+    -----------
+    x_data: numpy.array
+        The frequencies in Hz. Shape (n_freq,)
+    y_data: numpy.ma.MaskedArray
+        The fluxes in Jy. Shape (n_psr, n_freq)
+    y_err: numpy.ma.MaskedArray
+        The uncertainties of the fluxes in Jy. Shape (n_psr, n_freq)
+
+    Returns:
+    --------
+    a: numpy.array
+        The fit spectral indexes. Shape (n_psr,)
+    K: numpy.array
+        The fit K values. Shape (n_psr,)
+    covar_mat: numpy.array
+        The covariance matrices of the fits. Shape (n_psr, 2, 2)
+    """
+    valid = ~np.ma.getmaskarray(y_data)
+    y = np.ma.filled(y_data, 1.)
+    e = np.ma.filled(y_err, 0.)
+
+    #Set up the data and weights in log space. See least_squares_fit_plaw()
+    X = np.log(x_data)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Y = np.log(y)
+        Y_err = 0.5 * np.log((y + e)/(y - e))
+        W = np.where(valid, 1/Y_err**2, 0.)
+    Y = np.where(valid, Y, 0.)
+
+    #X'WX and X'WY for X = [1, log(nu)]
+    XWX = np.empty((len(y), 2, 2))
+    XWX[:, 0, 0] = np.sum(W, axis=1)
+    XWX[:, 0, 1] = XWX[:, 1, 0] = np.sum(W*X, axis=1)
+    XWX[:, 1, 1] = np.sum(W*X**2, axis=1)
+    XWY = np.stack((np.sum(W*Y, axis=1), np.sum(W*X*Y, axis=1)), axis=1)
+
+    #pinv won't converge on non-finite matrices so fit those with a dummy and flag them afterwards
+    bad = ~np.all(np.isfinite(XWX), axis=(1, 2)) | ~np.all(np.isfinite(XWY), axis=1)
+    XWX[bad] = np.eye(2)
+    XWY[bad] = 0.
+    covar_mat = np.linalg.pinv(XWX)
+    b = np.matmul(covar_mat, XWY[..., np.newaxis])[..., 0]
+    covar_mat[bad] = np.nan
+    b[bad] = np.nan
+
+    K = np.exp(b[:, 0])
+    a = b[:, 1]
+    return a, K, covar_mat
+
+#---------------------------------------------------------------
+def est_pulsar_flux_array(query, freq):
+    """
+    Array version of est_pulsar_flux(). Estimates the flux of every pulsar in an ATNF query at once.
+    As with est_pulsar_flux(), a power law is fit to pulsars with more than one flux density,
+    pulsars with one flux density use a spectral index of -1.4 +/- 1.0 (Bates 2013)
+    and pulsars without a flux density return NaNs.
+    This doesn't use the spectral model cache (see get_spectral_model()): all of the pulsars are fit in one vectorised pass,
+    which is cheaper than looking up and evaluating their cached models one at a time
+
+    Parameters:
+    -----------
+    query: object
+        The return from psrqpy.QueryATNF(...).pandas for any number of pulsars
+    freq: float
+        The frequency to estimate the fluxes at in Hz
+
+    Returns:
+    --------
+    flux: numpy.array
+        The estimated fluxes in Jy
+    flux_err: numpy.array
+        The estimated fluxes' uncertainties in Jy
+    spind: numpy.array
+        The spectral indexes used
+    spind_err: numpy.array
+        The spectral indexes' uncertainties
+    """
+    freqs, fluxes, flux_errs = flux_from_atnf_df(query)
+    n_flux = np.ma.count(fluxes, axis=1)
+    plaw = n_flux > 1
+    single = n_flux == 1
+
+    spind = np.full(len(n_flux), np.nan)
+    spind_err = np.full(len(n_flux), np.nan)
+    flux = np.full(len(n_flux), np.nan)
+    flux_err = np.full(len(n_flux), np.nan)
+
+    if np.any(plaw):
+        a, K, covar_mat = least_squares_fit_plaw_array(freqs, fluxes[plaw], flux_errs[plaw])
+        flux[plaw], flux_err[plaw] = flux_from_plaw(freq, K, a, covar_mat.T)
+        spind[plaw] = a
+        spind_err[plaw] = np.sqrt(np.abs(covar_mat[:, 1, 1]))
+
+    if np.any(single):
+        first = np.argmax(~np.ma.getmaskarray(fluxes[single]), axis=1)
+        rows = np.arange(len(first))
+        spind[single] = -1.4
+        spind_err[single] = 1.
+        flux[single], flux_err[single] = flux_from_spind(freq, freqs[first],\
+                                                         fluxes[single].data[rows, first],\
+                                                         flux_errs[single].data[rows, first],\
+                                                         spind[single], spind_err[single])
+
+    logger.info("Estimated the flux of {0} pulsars. {1} had insufficient data for a power law and {2} had no flux values"\
+                .format(len(n_flux), np.count_nonzero(single), np.count_nonzero(n_flux == 0)))
+    return flux, flux_err, spind, spind_err
+
+#---------------------------------------------------------------
+def find_pulsar_w50_array(query):
+    """
+    Array version of find_pulsar_w50(). Finds the W50 of every pulsar in an ATNF query at once, estimating it where unavailable
+
+    Parameters:
+    -----------
+    query: object
+        The return from psrqpy.QueryATNF(...).pandas for any number of pulsars
+
+    Returns:
+    --------
+    w50: numpy.array
+        The pulsars' W50 in seconds
+    w50_err: numpy.array
+        The W50s' uncertainties in seconds
+    """
+    W_50 = np.asarray(query["W50"], dtype=float)/1000.
+    W_50_err = np.asarray(query["W50_ERR"], dtype=float)/1000.
+    period = np.asarray(query["P0"], dtype=float)
+
+    #standard 5% error when it's not on the archive
+    W_50_err = np.where(np.isnan(W_50_err), W_50*0.05, W_50_err)
+
+    #Rankin1993 estimate, see find_pulsar_w50()
+    estimate = np.isnan(W_50)
+    coeff = 4.8
+    coeff_err = np.where(period < 0.05, 4., 2.)
+    W_50 = np.where(estimate, (coeff*period**0.5/360.)*period, W_50)
+    W_50_err = np.where(estimate, (coeff_err*period**0.5/360.)*period, W_50_err)
+    return W_50, W_50_err
+
+#---------------------------------------------------------------
+def find_times(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None, min_z_power=0.3, query=None, obs_context=None):
     """
     Find the total integration time of a pulsar in the primary beam of an obsid
 
@@ -664,6 +1387,8 @@ def find_times(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None,
         OPTIONAL - The beginning of the processed observing time
     end: int
         OPTIONAL - The end of the processed observing time
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities. If supplied, the metadata and observation times are taken from it. Default: None
 
     Returns:
     -------
@@ -677,9 +1402,15 @@ def find_times(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None,
     #type assurances
     obsid = int(obsid)
 
-    if not metadata or not full_meta:
-        metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
-    obs_beg, obs_end = mwa_metadb_utils.obs_max_min(obsid, meta=full_meta)
+    beam_model = "analytic"
+    if obs_context is not None:
+        metadata, full_meta = obs_context.obs_metadata, obs_context.full_meta
+        obs_beg, obs_end = obs_context.obs_beg, obs_context.obs_end
+        beam_model = obs_context.beam_model
+    else:
+        if not metadata or not full_meta:
+            metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
+        obs_beg, obs_end = mwa_metadb_utils.obs_max_min(obsid, meta=full_meta)
 
     t_int=None
     if beg is None or end is None:
@@ -687,13 +1418,15 @@ def find_times(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None,
         beg = obs_beg
         end = obs_end
         dur = end - beg + 1
-        enter_norm, exit_norm = pulsar_beam_coverage(obsid, pulsar, beg=beg, end=end, metadata=metadata, full_meta=full_meta, min_z_power=min_z_power, query=query)
+        enter_norm, exit_norm = pulsar_beam_coverage(obsid, pulsar, beg=beg, end=end, metadata=metadata, full_meta=full_meta, min_z_power=min_z_power, query=query,\
+                                                     obs_context=obs_context, beam_model=beam_model)
         enter_time = beg + enter_norm * dur
         exit_time = beg + exit_norm * dur
         t_int = (exit_norm - enter_norm ) * dur
 
     if t_int is None:
-        enter_norm, exit_norm = pulsar_beam_coverage(obsid, pulsar, beg=beg, end=end, metadata=metadata, full_meta=full_meta, min_z_power=min_z_power, query=query)
+        enter_norm, exit_norm = pulsar_beam_coverage(obsid, pulsar, beg=beg, end=end, metadata=metadata, full_meta=full_meta, min_z_power=min_z_power, query=query,\
+                                                     obs_context=obs_context, beam_model=beam_model)
         if beg is not None and end is not None:
             dur = end-beg
         else: #use entire obs duration
@@ -713,8 +1446,78 @@ def find_times(obsid, pulsar, beg=None, end=None, metadata=None, full_meta=None,
     return enter_time, exit_time, t_int
 
 #---------------------------------------------------------------
+def pulsar_beam_power(pulsar, obsid, beg=None, end=None, p_ra=None, p_dec=None, query=None, min_z_power=0.3, obs_context=None):
+    """
+    Finds when a pulsar is in the beam (see find_times()), its mean beam power over that time and its zenith angle.
+    When an ObservationContext is supplied the result is stored in it and is only calculated once per
+    (obsid, pulsar, beg, end, p_ra, p_dec, min_z_power, beam_model)
+
+    Parameters:
+    -----------
+    pulsar: str
+        the J name of the pulsar. e.g. J2241-5236
+    obsid: int
+        The observation ID. e.g. 1226406800
+    beg: int
+        OPTIONAL - The beginning of the observing time. Default: None
+    end: float
+        OPTIONAL - The end of the observing time. Default: None
+    p_ra: str
+        OPTIONAL - the target's right ascension. Default: None
+    p_dec: str
+        OPTIONAL - the target's declination. Default: None
+    query: object
+        OPTIONAL - The return of the psrqpy function for this pulsar. Default: None
+    min_z_power: float
+        OPTIONAL - The minimum zenith normalised power for the pulsar to be considered in the beam. Default: 0.3
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities where the result is memoised. If None, one will be made for this call only. Default: None
+
+    Returns:
+    --------
+    coverage: dictionary
+        The keys are:
+        "enter", "exit", "t_int": the outputs of find_times()
+        "beam_power": the mean zenith normalised beam power while the pulsar is in the beam
+        "za": the zenith angle of the pulsar in degrees
+    """
+    #get ra and dec if not supplied
+    if p_ra is None or p_dec is None and query is None:
+        logger.debug("Obtaining pulsar RA and Dec from ATNF")
+        query = psrqpy.QueryATNF(psrs=[pulsar], loadfromdb=data_load.ATNF_LOC).pandas
+        p_ra = query["RAJ"][0]
+        p_dec = query["DECJ"][0]
+    elif p_ra is None and p_dec is None and query is not None:
+        p_ra = query["RAJ"][0]
+        p_dec= query["DECJ"][0]
+
+    if obs_context is None:
+        obs_context = ObservationContext(obsid)
+    key = (int(obsid), pulsar, beg, end, p_ra, p_dec, min_z_power, obs_context.beam_model)
+    if key in obs_context.beam_powers:
+        return obs_context.beam_powers[key]
+
+    obsid, obs_ra, obs_dec, _, delays, centrefreq, channels = obs_context.obs_metadata
+
+    #get enter time
+    logger.debug("Calculating beginning time for pulsar coverage")
+    enter, leave, t_int = find_times(obsid, pulsar, beg=beg, end=end, min_z_power=min_z_power, query=query, obs_context=obs_context)
+    start_time =  enter-int(obsid)
+
+    beam_power = fpio.get_beam_power_over_time([obsid, obs_ra, obs_dec, t_int, delays,\
+                                                centrefreq, channels],\
+                                                np.array([[pulsar, p_ra, p_dec]]),\
+                                                dt=100, start_time=start_time)
+    logger.debug("pul_ra: {} pul_dec: {}".format(p_ra, p_dec))
+    _, _, zas = mwa_metadb_utils.mwa_alt_az_za(obsid, ra=p_ra, dec=p_dec)
+
+    coverage = {"enter":enter, "exit":leave, "t_int":t_int, "beam_power":np.mean(beam_power), "za":zas}
+    obs_context.beam_powers[key] = coverage
+    return coverage
+
 def find_t_sys_gain(pulsar, obsid, beg=None, end=None, p_ra=None, p_dec=None,\
-                    obs_metadata=None, full_meta=None, query=None, min_z_power=0.3, trcvr=data_load.TRCVR_FILE):
+                    obs_metadata=None, full_meta=None, query=None, min_z_power=0.3, trcvr=data_load.TRCVR_FILE,\
+                    obs_context=None, coverage=None):
 
     """
     Finds the system temperature and gain for an observation.
@@ -740,6 +1543,10 @@ def find_t_sys_gain(pulsar, obsid, beg=None, end=None, p_ra=None, p_dec=None,\
         OPTIONAL - The return of the psrqpy function for this pulsar
     trcvr: str
         The location of the MWA receiver temp csv file. Default = <vcstools_data_dir>MWA_Trcvr_tile_56.csv
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities. If None, one will be made for this call only. Default: None
+    coverage: dictionary
+        OPTIONAL - The output of pulsar_beam_power() for this pulsar and time range. If None, it will be found. Default: None
 
     Returns:
     --------
@@ -752,67 +1559,84 @@ def find_t_sys_gain(pulsar, obsid, beg=None, end=None, p_ra=None, p_dec=None,\
     gain_err: float
         The gain's uncertainty
     """
-
-    #get ra and dec if not supplied
-    if p_ra is None or p_dec is None and query is None:
-        logger.debug("Obtaining pulsar RA and Dec from ATNF")
-        query = psrqpy.QueryATNF(psrs=[pulsar], loadfromdb=data_load.ATNF_LOC).pandas
-        p_ra = query["RAJ"][0]
-        p_dec = query["DECJ"][0]
-    elif p_ra is None and p_dec is None and query is not None:
-        p_ra = query["RAJ"][0]
-        p_dec= query["DECJ"][0]
-
     #get metadata if not supplied
-    if not obs_metadata or not full_meta:
-        logger.debug("Obtaining obs metadata")
-        obs_metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
+    if obs_context is None:
+        obs_context = ObservationContext(obsid, obs_metadata=obs_metadata, full_meta=full_meta, trcvr=trcvr)
+    centrefreq = obs_context.centrefreq
 
-    obsid, obs_ra, obs_dec, _, delays, centrefreq, channels = obs_metadata
+    if coverage is None:
+        coverage = pulsar_beam_power(pulsar, obsid, beg=beg, end=end, p_ra=p_ra, p_dec=p_dec, query=query,\
+                                     min_z_power=min_z_power, obs_context=obs_context)
+    beam_power = coverage["beam_power"]
 
-    #get enter time
-    logger.debug("Calculating beginning time for pulsar coverage")
-    enter, _, t_int = find_times(obsid, pulsar, beg=beg, end=end, metadata=obs_metadata, full_meta=full_meta, min_z_power=min_z_power, query=query)
-
-    #obs_start, _ = mwa_metadb_utils.obs_max_min(obsid)
-    start_time =  enter-int(obsid)
-
-    #Get important info
-    trec_table = Table.read(trcvr,format="csv")
     ntiles = 128 #TODO actually we excluded some tiles during beamforming, so we'll need to account for that here
 
-    beam_power = fpio.get_beam_power_over_time([obsid, obs_ra, obs_dec, t_int, delays,\
-                                                centrefreq, channels],\
-                                                np.array([[pulsar, p_ra, p_dec]]),\
-                                                dt=100, start_time=start_time)
-    beam_power = np.mean(beam_power)
+    # Get T_sys by adding Trec and Tsky. The sky temperature is only calculated once per observation
+    t_sys, t_sys_err = obs_context.get_t_sys()
 
-    # Usa a primary beam function to convolve the sky temperature with the primary beam
-    # (prints suppressed)
-    sys.stdout = open(os.devnull, 'w')
-    _, _, Tsky_XX, _, _, _, Tsky_YY, _ = pbtant.make_primarybeammap(int(obsid), delays, centrefreq*1e6, 'analytic', plottype='None')
-    sys.stdout = sys.__stdout__
-
-    #TODO can be inaccurate for coherent but is too difficult to simulate
-    t_sky = (Tsky_XX + Tsky_YY) / 2.
-    # Get T_sys by adding Trec and Tsky (other temperatures are assumed to be negligible
-    t_sys_table = t_sky + submit_to_database.get_Trec(trec_table, centrefreq)
-    t_sys = np.mean(t_sys_table)
-    t_sys_err = t_sys*0.02 #TODO: figure out what t_sys error is
-
-    logger.debug("pul_ra: {} pul_dec: {}".format(p_ra, p_dec))
-    _, _, zas = mwa_metadb_utils.mwa_alt_az_za(obsid, ra=p_ra, dec=p_dec)
-    theta = np.radians(zas)
+    theta = np.radians(coverage["za"])
     gain = submit_to_database.from_power_to_gain(beam_power, centrefreq*1e6, ntiles, coh=True)
     logger.debug("beam_power: {} theta: {} pi: {}".format(beam_power, theta, np.pi))
     gain_err = gain * ((1. - beam_power)*0.12 + 2.*(theta/(0.5*np.pi))**2. + 0.1)
 
     return t_sys, t_sys_err, gain, gain_err
 
+#---------------------------------------------------------------
+def radiometer_sn(s_mean, s_mean_err, gain, gain_err, t_sys, t_sys_err, W_50, W_50_err, period, t_int,\
+                  n_p=2, df=30.72e6):
+    """
+    The radiometer equation and its uncertainty, used by est_pulsar_sn(). All inputs may be floats or numpy arrays
+    S/N = (s_mean * gain * sqrt(n_p * t_int * df * (period - W_50)/W_50)) / t_sys
+    The uncertainties of period, df and t_int are assumed to be zero
+
+    Parameters:
+    -----------
+    s_mean, s_mean_err: float
+        The mean flux and its uncertainty in Jy
+    gain, gain_err: float
+        The gain and its uncertainty in K/Jy
+    t_sys, t_sys_err: float
+        The system temperature and its uncertainty in K
+    W_50, W_50_err: float
+        The pulse width and its uncertainty in seconds
+    period: float
+        The pulsar's period in seconds
+    t_int: float
+        The integration time in seconds
+    n_p: int
+        OPTIONAL - The number of polarisations. Default: 2
+    df: float
+        OPTIONAL - The bandwidth in Hz. Default: 30.72e6
+
+    Returns:
+    --------
+    sn: float
+        The signal to noise ratio
+    sn_err: float
+        The uncertainty in the signal to noise ratio
+    """
+    SN = ((s_mean * gain)/t_sys) * np.sqrt(n_p * t_int * df * (period - W_50)/W_50)
+
+    #Calculate SN uncertainty using variance formula
+    dc_expr = np.sqrt((period-W_50)/W_50)
+    var_s_mean = (gain * np.sqrt(n_p * t_int * df)) * dc_expr / t_sys
+    var_gain = s_mean * np.sqrt(n_p * t_int * df) * dc_expr / t_sys
+    var_W_50 = s_mean * gain * np.sqrt(n_p * t_int * df)/t_sys * (period/(-2.*W_50**2.)) * dc_expr**-1
+    var_t_sys = -s_mean * gain * np.sqrt(n_p * t_int * df) * dc_expr / t_sys**2.
+    var_s_mean      = var_s_mean**2.    * s_mean_err**2.
+    var_gain        = var_gain**2.      * gain_err**2.
+    var_W_50        = var_W_50**2.      * W_50_err**2.
+    var_t_sys       = var_t_sys**2.     * t_sys_err**2.
+
+    logger.debug("variance estimates for s_mean: {0}, gain: {1}, W_50: {2}, t_sys: {3}"\
+                .format(var_s_mean, var_gain, var_W_50, var_t_sys))
+    SN_err = np.sqrt(var_s_mean + var_gain + var_W_50 + var_t_sys)
+    return SN, SN_err
+
 #---------------------------------------------------------------
 def est_pulsar_sn(pulsar, obsid,\
                  beg=None, end=None, p_ra=None, p_dec=None, obs_metadata=None, full_meta=None, plot_flux=False,\
-                 query=None, min_z_power=0.3, trcvr=data_load.TRCVR_FILE):
+                 query=None, min_z_power=0.3, trcvr=data_load.TRCVR_FILE, obs_context=None, save_cache=True):
 
     """
     Estimates the signal to noise ratio for a pulsar in a given observation using the radiometer equation
@@ -837,6 +1661,11 @@ def est_pulsar_sn(pulsar, obsid,\
         OPTIONAL - the array generated from mwa_metadb_utils.get_common_obs_metadata(obsid)
     plot_flux: boolean
         OPTIONAL - whether or not to produce a plot of the flux estimation. Default = False
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities. Supply this when estimating the S/N of many pulsars in the same observation. Default: None
+    save_cache: boolean
+        OPTIONAL - Whether to save a newly fit spectral model to disk straight away. Set to False in loops and call
+        save_spectral_model_cache() once at the end. Default: True
 
     Returns:
     --------
@@ -857,53 +1686,41 @@ def est_pulsar_sn(pulsar, obsid,\
         p_dec = query["DECJ"][0]
 
     #get metadata if not supplied
-    if not obs_metadata or not full_meta:
-        logger.debug("Obtaining obs metadata")
-        obs_metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
+    if obs_context is None:
+        obs_context = ObservationContext(obsid, obs_metadata=obs_metadata, full_meta=full_meta, trcvr=trcvr)
+    obs_metadata = obs_context.obs_metadata
 
     n_p = 2 #constant
     df = 30.72e6 #(24*1.28e6)
 
     #estimate flux
     s_mean, s_mean_err = est_pulsar_flux(pulsar, obsid, plot_flux=plot_flux,\
-                         metadata=obs_metadata, query=query)
+                         metadata=obs_metadata, query=query, save_cache=save_cache)
     #fluxes may be Nones. If so, return None
     if s_mean is None and s_mean_err is None:
         return None, None
 
     #find integration time
-    enter, leave, t_int = find_times(obsid, pulsar, beg=beg, end=end, metadata=obs_metadata, full_meta=full_meta, min_z_power=min_z_power, query=query)
+    enter, leave, t_int = find_times(obsid, pulsar, beg=beg, end=end, min_z_power=min_z_power, query=query, obs_context=obs_context)
     if t_int<=0.:
         logger.warning("{} not in beam for obs files or specificed beginning and end times"\
                     .format(pulsar))
         return 0., 0.
 
-    #find system temp and gain
+    #find system temp and gain. The beam power and zenith angle are only calculated once per pulsar and time range
+    coverage = pulsar_beam_power(pulsar, obsid, beg=enter, end=leave, p_ra=p_ra, p_dec=p_dec, query=query,\
+                                 min_z_power=min_z_power, obs_context=obs_context)
     t_sys, t_sys_err, gain, gain_err = find_t_sys_gain(pulsar, obsid,\
                                 beg=enter, end=leave, p_ra=p_ra, p_dec=p_dec, query=query,\
-                                obs_metadata=obs_metadata, full_meta=full_meta, trcvr=trcvr, min_z_power=min_z_power)
+                                trcvr=trcvr, min_z_power=min_z_power, obs_context=obs_context, coverage=coverage)
 
     #Find W_50
     W_50, W_50_err = find_pulsar_w50(pulsar, query=query)
 
     #calculate SN
     period = float(query["P0"][0])
-    SN = ((s_mean * gain)/t_sys) * np.sqrt(n_p * t_int * df * (period - W_50)/W_50)
-
-    #Calculate SN uncertainty using variance formula. Assuming error from period, df and t_int is zero
-    dc_expr = np.sqrt((period-W_50)/W_50)
-    var_s_mean = (gain * np.sqrt(n_p * t_int * df)) * dc_expr / t_sys
-    var_gain = s_mean * np.sqrt(n_p * t_int * df) * dc_expr / t_sys
-    var_W_50 = s_mean * gain * np.sqrt(n_p * t_int * df)/t_sys * (period/(-2.*W_50**2.)) * dc_expr**-1
-    var_t_sys = -s_mean * gain * np.sqrt(n_p * t_int * df) * dc_expr / t_sys**2.
-    var_s_mean      = var_s_mean**2.    * s_mean_err**2.
-    var_gain        = var_gain**2.      * gain_err**2.
-    var_W_50        = var_W_50**2.      * W_50_err**2.
-    var_t_sys       = var_t_sys**2.     * t_sys_err**2.
-
-    logger.debug("variance estimates for s_mean: {0}, gain: {1}, W_50: {2}, t_sys: {3}"\
-                .format(var_s_mean, var_gain, var_W_50, var_t_sys))
-    SN_err = np.sqrt(var_s_mean + var_gain + var_W_50 + var_t_sys)
+    SN, SN_err = radiometer_sn(s_mean, s_mean_err, gain, gain_err, t_sys, t_sys_err, W_50, W_50_err,\
+                               period, t_int, n_p=n_p, df=df)
 
     logger.debug("S_mean: {0} +/- {1}".format(s_mean, s_mean_err))
     logger.debug("Gain: {0} +/- {1}".format(gain, gain_err))
@@ -916,35 +1733,279 @@ def est_pulsar_sn(pulsar, obsid,\
 
     return SN, SN_err
 
+def est_pulsar_set_sn(query, obsid, beg=None, end=None, obs_metadata=None, full_meta=None,\
+                      min_z_power=0.3, trcvr=data_load.TRCVR_FILE, obs_context=None):
+    """
+    Array version of est_pulsar_sn(). Estimates the signal to noise ratio of every pulsar in an ATNF query for an observation.
+    The fluxes, W50s and radiometer equation are calculated for all pulsars at once,
+    only the beam coverage and gain are calculated per pulsar
+
+    Parameters:
+    ----------
+    query: object
+        The return from psrqpy.QueryATNF(...).pandas for any number of pulsars
+    obsid: int
+        Observation ID e.g. 1226406800
+    beg: int
+        OPTIONAL - beginning of the observing time. If None, will use the beginning of the obs. Default: None
+    end: int
+        OPTIONAL - end of the observing time. If None, will use the end of the obs. Default: None
+    obs_metadata: list
+        OPTIONAL - the array generated from mwa_metadb_utils.get_common_obs_metadata(obsid)
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities. If None, one will be made. Default: None
+
+    Returns:
+    --------
+    result: dictionary
+        A dictionary of arrays (one value per pulsar) with the keys:
+        "pulsar", "flux", "flux_err", "spind", "spind_err", "w50", "w50_err", "t_int", "sn" and "sn_err".
+        As with est_pulsar_sn(), the S/N is NaN for pulsars without flux values and 0 for pulsars that aren't in the beam
+    """
+    if obs_context is None:
+        obs_context = ObservationContext(obsid, obs_metadata=obs_metadata, full_meta=full_meta,\
+                                         beg=beg, end=end, trcvr=trcvr)
+    if beg is None:
+        beg = obs_context.beg
+    if end is None:
+        end = obs_context.end
+
+    pulsars = np.asarray(query["PSRJ"])
+    n_psr = len(pulsars)
+    flux, flux_err, spind, spind_err = est_pulsar_flux_array(query, obs_context.centrefreq*1e6)
+    W_50, W_50_err = find_pulsar_w50_array(query)
+    period = np.asarray(query["P0"], dtype=float)
+
+    t_int = np.zeros(n_psr)
+    t_sys, t_sys_err, gain, gain_err = np.full((4, n_psr), np.nan)
+    for i, pulsar in enumerate(pulsars):
+        #As in est_pulsar_sn(), only work out the beam coverage if there's a flux to scale
+        if np.isnan(flux[i]):
+            continue
+        psr_query = {key:[query[key][i]] for key in query.keys()}
+        enter, leave, t_int[i] = find_times(obsid, pulsar, beg=beg, end=end, min_z_power=min_z_power,\
+                                            query=psr_query, obs_context=obs_context)
+        if t_int[i] <= 0.:
+            logger.warning("{} not in beam for obs files or specificed beginning and end times".format(pulsar))
+            continue
+        t_sys[i], t_sys_err[i], gain[i], gain_err[i] = find_t_sys_gain(pulsar, obsid, beg=enter, end=leave,\
+                                                            p_ra=psr_query["RAJ"][0], p_dec=psr_query["DECJ"][0],\
+                                                            query=psr_query, trcvr=trcvr, min_z_power=min_z_power,\
+                                                            obs_context=obs_context)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sn, sn_err = radiometer_sn(flux, flux_err, gain, gain_err, t_sys, t_sys_err, W_50, W_50_err,\
+                                   period, t_int)
+    not_in_beam = ~np.isnan(flux) & (t_int <= 0.)
+    sn[not_in_beam] = 0.
+    sn_err[not_in_beam] = 0.
+
+    return {"pulsar":pulsars, "flux":flux, "flux_err":flux_err, "spind":spind, "spind_err":spind_err,\
+            "w50":W_50, "w50_err":W_50_err, "t_int":t_int, "sn":sn, "sn_err":sn_err}
+
 def multi_psr_snfe(pulsar_list, obsid,\
                    beg=None, end=None, obs_metadata=None, full_meta=None, plot_flux=False,\
-                   query=None, min_z_power=0.3, trcvr=data_load.TRCVR_FILE):
+                   query=None, min_z_power=0.3, trcvr=data_load.TRCVR_FILE, obs_context=None):
+    """
+    Estimates the signal to noise ratio for many pulsars in the same observation.
+    The observation-level quantities (metadata, times, T_sys) are only calculated once and shared between the pulsars
+    and the fluxes and S/Ns are calculated for all pulsars at once. See est_pulsar_set_sn()
 
+    Parameters:
+    ----------
+    pulsar_list: list
+        A list of the pulsar J names
+    obsid: int
+        Observation ID e.g. 1226406800
+    beg: int
+        OPTIONAL - beginning of the observing time. If None, will use the beginning of the obs. Default: None
+    end: int
+        OPTIONAL - end of the observing time. If None, will use the end of the obs. Default: None
+    obs_metadata: list
+        OPTIONAL - the array generated from mwa_metadb_utils.get_common_obs_metadata(obsid)
+    plot_flux: boolean
+        OPTIONAL - whether or not to produce a plot of the flux estimation. Default = False
+    query: object
+        OPTIONAL - The return from psrqpy.QueryATNF for the pulsars. If None, will query the ATNF database. Default: None
+    obs_context: ObservationContext
+        OPTIONAL - The shared observation quantities. If None, one will be made. Default: None
 
-    if obs_metadata is None or full_meta is None:
-        logger.debug("Obtaining obs metadata")
-        obs_metadata, full_meta = mwa_metadb_utils.get_common_obs_metadata(obsid, return_all=True)
+    Returns:
+    --------
+    sn_dict: dictionary
+        sn_dict[pulsar] = [sn, sn_err]. The S/N is None for pulsars without flux values
+    """
+    if obs_context is None:
+        obs_context = ObservationContext(obsid, obs_metadata=obs_metadata, full_meta=full_meta,\
+                                         beg=beg, end=end, trcvr=trcvr)
 
-    obs_beg, obs_end = mwa_metadb_utils.obs_max_min(obsid, meta=full_meta)
-    if beg is None:
-        beg = obs_beg
-    if end is None:
-        end = obs_end
+    if query is None:
+        query = psrqpy.QueryATNF(psrs=pulsar_list, loadfromdb=data_load.ATNF_LOC).pandas
+    result = est_pulsar_set_sn(query, obsid, beg=obs_context.beg, end=obs_context.end,\
+                               min_z_power=min_z_power, trcvr=trcvr, obs_context=obs_context)
 
-    mega_query = psrqpy.QueryATNF(psrs=pulsar_list, loadfromdb=data_load.ATNF_LOC).pandas
     sn_dict = {}
-    for i, pulsar in enumerate(mega_query["PSRJ"]):
-        psr_query = {}
-        for key in mega_query.keys():
-            psr_query[key] = [mega_query[key][i]]
+    for i, pulsar in enumerate(result["pulsar"]):
+        if plot_flux:
+            psr_query = {key:[query[key][i]] for key in query.keys()}
+            est_pulsar_flux(pulsar, obsid, plot_flux=True, metadata=obs_context.obs_metadata, query=psr_query, save_cache=False)
+        if np.isnan(result["flux"][i]):
+            sn_dict[pulsar] = [None, None]
+        else:
+            sn_dict[pulsar] = [result["sn"][i], result["sn_err"][i]]
+    if plot_flux:
+        save_spectral_model_cache()
 
-        sn, sn_e = est_pulsar_sn(pulsar, obsid,\
-                                 beg=beg, end=end, obs_metadata=obs_metadata, full_meta=full_meta, plot_flux=plot_flux,\
-                                 query=psr_query, min_z_power=min_z_power, trcvr=trcvr)
+    return sn_dict
 
-        sn_dict[pulsar]=[sn, sn_e]
+#---------------------------------------------------------------
+SN_GRID_COLUMNS = ["obsid", "pulsar", "enter", "exit", "t_int", "flux", "flux_err", "w50", "w50_err", "sn", "sn_err"]
+#The query and options shared by the S/N grid workers. Set by _sn_grid_init()
+_sn_grid_state = {}
 
-    return sn_dict
+def _sn_grid_init(query, kwargs):
+    """
+    Initialises an S/N grid worker so the ATNF query is only sent to each process once
+    """
+    _sn_grid_state["query"] = query
+    _sn_grid_state["kwargs"] = kwargs
+
+def _sn_grid_obs(obsid):
+    """
+    Calculates the S/N grid rows for a single observation. Returns (obsid, rows) where rows is None if the observation failed
+    """
+    query = _sn_grid_state["query"]
+    kwargs = _sn_grid_state["kwargs"]
+    try:
+        obs_context = ObservationContext(obsid, beam_model=kwargs["beam_model"],\
+                                         lst_tol=kwargs["lst_tol"], use_tsky_cache=kwargs["use_tsky_cache"])
+        #work out which pulsars are in the beam all at once, then only estimate the S/N of those
+        tracks = find_beam_tracks(obsid, query, min_z_power=kwargs["min_z_power"],\
+                                  beam_model=kwargs["beam_model"], obs_context=obs_context)
+        in_beam = [i for i, pulsar in enumerate(query["PSRJ"]) if tracks[pulsar][0] is not None]
+        rows = []
+        if in_beam:
+            beam_query = query.iloc[in_beam].reset_index(drop=True)
+            result = est_pulsar_set_sn(beam_query, obsid, min_z_power=kwargs["min_z_power"],\
+                                       obs_context=obs_context)
+            for i, pulsar in enumerate(result["pulsar"]):
+                enter, exit = tracks[pulsar]
+                rows.append([obsid, pulsar, enter, exit] +\
+                            [result[key][i] for key in ["t_int", "flux", "flux_err", "w50", "w50_err", "sn", "sn_err"]])
+    except Exception as e:
+        logger.error("S/N grid failed for obsid {0}: {1}".format(obsid, e))
+        return obsid, None
+    return obsid, rows
+
+def read_sn_grid_checkpoint(outfile):
+    """
+    Reads the observation IDs that have been completed in an S/N grid output file. See sn_grid()
+
+    Parameters:
+    -----------
+    outfile: str
+        The S/N grid csv file
+
+    Returns:
+    --------
+    done: set
+        The completed observation IDs
+    """
+    done = set()
+    if os.path.exists(outfile + ".done"):
+        with open(outfile + ".done") as f:
+            done = {int(line) for line in f if line.strip()}
+    return done
+
+def sn_grid(obsids, outfile, pulsars=None, n_procs=1, min_z_power=0.3, beam_model="analytic",\
+            lst_tol=TSKY_LST_TOL, use_tsky_cache=True, query=None):
+    """
+    Estimates the S/N of every pulsar in every observation. The observations are split between a pool of processes
+    so each process reuses the observation-level quantities for all of the pulsars in its observation.
+    Only pulsars in the beam are written, all others have an S/N of 0.
+
+    Rows are streamed to a csv file as each observation finishes and the observation ID is then recorded in <outfile>.done.
+    If the function is rerun with the same outfile the completed observations are skipped,
+    so an interrupted grid can be resumed. Observations that fail are logged and retried on the next run.
+
+    Parameters:
+    -----------
+    obsids: list
+        The observation IDs
+    outfile: str
+        The csv file to write the S/N grid to
+    pulsars: list
+        OPTIONAL - The pulsar J names. If None, will use every pulsar in the catalogue. Default: None
+    n_procs: int
+        OPTIONAL - The number of processes to use. Default: 1
+    min_z_power: float
+        OPTIONAL - The minimum zenith normalised power for a pulsar to be considered in the beam. Default: 0.3
+    beam_model: str
+        OPTIONAL - The primary beam model. Default: 'analytic'
+    lst_tol: float
+        OPTIONAL - The LST tolerance in hours used by the T_sky cache. Default: TSKY_LST_TOL
+    use_tsky_cache: boolean
+        OPTIONAL - Whether to use the on-disk T_sky cache. Default: True
+    query: object
+        OPTIONAL - The return from psrqpy.QueryATNF(...).pandas for the pulsars. Default: None
+
+    Returns:
+    --------
+    failed: list
+        The observation IDs that failed
+    """
+    done = read_sn_grid_checkpoint(outfile)
+    todo = [int(obsid) for obsid in obsids if int(obsid) not in done]
+    logger.info("S/N grid: {0} observations already done, {1} to do".format(len(obsids) - len(todo), len(todo)))
+    if not todo:
+        return []
+
+    #drop the rows of any observation that was interrupted while it was being written
+    if os.path.exists(outfile):
+        with open(outfile) as f:
+            rows = [row for row in csv.reader(f)]
+        rows = [row for row in rows[1:] if int(row[0]) in done]
+    else:
+        rows = []
+    with open(outfile, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SN_GRID_COLUMNS)
+        writer.writerows(rows)
+
+    if query is None:
+        query = psrqpy.QueryATNF(psrs=pulsars, loadfromdb=data_load.ATNF_LOC).pandas
+    kwargs = {"min_z_power":min_z_power, "beam_model":beam_model, "lst_tol":lst_tol, "use_tsky_cache":use_tsky_cache}
+
+    if n_procs > 1:
+        pool = multiprocessing.Pool(n_procs, initializer=_sn_grid_init, initargs=(query, kwargs))
+        results = pool.imap_unordered(_sn_grid_obs, todo)
+    else:
+        pool = None
+        _sn_grid_init(query, kwargs)
+        results = map(_sn_grid_obs, todo)
+
+    failed = []
+    try:
+        with open(outfile, "a", newline="") as f, open(outfile + ".done", "a") as done_file:
+            writer = csv.writer(f)
+            for n, (obsid, obs_rows) in enumerate(results):
+                if obs_rows is None:
+                    failed.append(obsid)
+                    continue
+                writer.writerows(obs_rows)
+                f.flush()
+                done_file.write("{}\n".format(obsid))
+                done_file.flush()
+                logger.info("S/N grid: {0}/{1} observations done. {2} pulsars in obsid {3}"\
+                            .format(n + 1, len(todo), len(obs_rows), obsid))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if failed:
+        logger.warning("S/N grid failed for {0} observations: {1}".format(len(failed), failed))
+    return failed
 
 #---------------------------------------------------------------
 if __name__ == "__main__":
@@ -969,8 +2030,20 @@ if __name__ == "__main__":
     parser.add_argument("--min_z_power", type=float, default=0.3, help="The minimum zenith normalised power used to determine if the pulsar\
                         is in the beam or not")
     parser.add_argument("--plot_est", action="store_true", help="Use this tag to create a plot of flux estimation.")
+    parser.add_argument("--lst_tol", type=float, default=TSKY_LST_TOL, help="The LST tolerance in hours used to share sky temperatures in the T_sky cache")
+    parser.add_argument("--no_tsky_cache", action="store_true", help="Use this tag to always calculate the sky temperature instead of using the T_sky cache")
+    parser.add_argument("--freqs", type=float, nargs='+', help="The frequencies (MHz) to calculate sky temperatures for in TSKY mode")
+    parser.add_argument("--sweet_spots", type=int, nargs='+', default=None, help="The sweet spot grid numbers to calculate in TSKY mode.\
+                        If None, will use all of them. Default: None")
+    parser.add_argument("--obsids", type=int, nargs='+', default=None, help="The Observation IDs to use in GRID mode.\
+                        If None, will use every VCS observation. Default: None")
+    parser.add_argument("--outfile", type=str, default="sn_grid.csv", help="The csv file to write to in GRID mode.\
+                        If it already exists, the completed observations are skipped. Default: sn_grid.csv")
+    parser.add_argument("--n_procs", type=int, default=1, help="The number of processes to use in GRID mode. Default: 1")
     parser.add_argument("--mode", type=str, help="""MODES: 'SNFE' = Estimate S/N and flux for a single pulsar in an obsid\n
-                                                'ATNF' = Plot the spectral energy distribution for any number of pulsars using data from ATNF.""")
+                                                'ATNF' = Plot the spectral energy distribution for any number of pulsars using data from ATNF.\n
+                                                'TSKY' = Pre-calculate the T_sky cache for the sweet spot pointings at all LSTs.\n
+                                                'GRID' = Estimate the S/N of every pulsar (or those given) in every observation (or those given).""")
     args = parser.parse_args()
 
     logger.setLevel(loglevels[args.loglvl])
@@ -995,13 +2068,28 @@ if __name__ == "__main__":
             raj = args.pointing.split("_")[0]
             decj = args.pointing.split("_")[1]
 
+        obs_context = ObservationContext(args.obsid, lst_tol=args.lst_tol, use_tsky_cache=not args.no_tsky_cache)
         SN, SN_err = est_pulsar_sn(pulsar, args.obsid,\
-                beg=args.beg, end=args.end, p_ra=raj, p_dec=decj, plot_flux=args.plot_est, query=query, min_z_power=args.min_z_power)
+                beg=args.beg, end=args.end, p_ra=raj, p_dec=decj, plot_flux=args.plot_est, query=query, min_z_power=args.min_z_power,\
+                obs_context=obs_context)
     elif args.mode == "ATNF":
         if not args.pulsar:
             logger.error("Pulsar name must be supplied. Exiting...")
             sys.exit(1)
         ATNF_spectral_data_plot(args.pulsar)
+    elif args.mode == "TSKY":
+        if not args.freqs:
+            logger.error("Frequencies must be supplied. Exiting...")
+            sys.exit(1)
+        prewarm_tsky_cache(args.freqs, sweet_spots=args.sweet_spots, lst_tol=args.lst_tol)
+    elif args.mode == "GRID":
+        obsids = args.obsids
+        if obsids is None:
+            obsids = mwa_metadb_utils.find_obsids_meta_pages()
+        failed = sn_grid(obsids, args.outfile, pulsars=args.pulsar, n_procs=args.n_procs, min_z_power=args.min_z_power,\
+                         lst_tol=args.lst_tol, use_tsky_cache=not args.no_tsky_cache)
+        if failed:
+            sys.exit(1)
     else:
         logger.error("Valid mode not selected. Please refer to documentation for options")
         sys.exit(1)
@@ -0,0 +1,167 @@
+"""
+Helpers for the on-disk caches used by vcstools.
+The caches are stored in the directory given by the VCSTOOLS_CACHE_DIR environment variable
+(default: ~/.cache/vcstools). Writes are atomic and guarded by a lock file so many jobs
+(e.g. a SLURM array) can populate and share the same cache.
+"""
+
+import os
+import pickle
+import fcntl
+import tempfile
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir(subdir=None):
+    """
+    Returns (and creates if necessary) the vcstools cache directory
+
+    Parameters:
+    -----------
+    subdir: str
+        OPTIONAL - A sub directory of the cache directory. Default: None
+
+    Returns:
+    --------
+    cache_dir: str
+        The path of the cache directory
+    """
+    cache_dir = os.environ.get("VCSTOOLS_CACHE_DIR",
+                               os.path.join(os.path.expanduser("~"), ".cache", "vcstools"))
+    if subdir:
+        cache_dir = os.path.join(cache_dir, subdir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """
+    Context manager that holds an advisory lock on <path>.lock while in use
+
+    Parameters:
+    -----------
+    path: str
+        The path of the file to lock
+    shared: boolean
+        OPTIONAL - If True, take a shared (read) lock instead of an exclusive one. Default: False
+    """
+    with open("{}.lock".format(path), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_pickle(path, default=None):
+    """
+    Loads a pickled object. Returns default if the file doesn't exist or can't be read
+
+    Parameters:
+    -----------
+    path: str
+        The path of the pickle file
+    default: object
+        OPTIONAL - What to return if the file can't be loaded. Default: None
+    """
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        logger.warning("Could not read cache file {0}: {1}".format(path, e))
+        return default
+
+
+def dump_pickle(path, obj):
+    """
+    Atomically writes a pickled object so readers never see a partially written file
+
+    Parameters:
+    -----------
+    path: str
+        The path of the pickle file
+    obj: object
+        The object to pickle
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_pickle(path, new_entries):
+    """
+    Merges a dictionary into a pickled dictionary while holding the file's lock.
+    This means entries written by other processes since this one last read the file are kept.
+
+    Parameters:
+    -----------
+    path: str
+        The path of the pickle file
+    new_entries: dict
+        The entries to add
+
+    Returns:
+    --------
+    cache: dict
+        The merged dictionary
+    """
+    with file_lock(path):
+        cache = load_pickle(path, default={})
+        cache.update(new_entries)
+        dump_pickle(path, cache)
+    return cache
+
+
+def prune_cache_dir(cache_dir, max_bytes, suffix=".pkl"):
+    """
+    Removes the least recently used files from a cache directory until it is smaller than max_bytes.
+    Files are aged by their modification time, so readers should touch a file when they use it.
+
+    Parameters:
+    -----------
+    cache_dir: str
+        The cache directory
+    max_bytes: int
+        The maximum total size of the cached files in bytes
+    suffix: str
+        OPTIONAL - Only files ending with this are counted and removed. Default: '.pkl'
+
+    Returns:
+    --------
+    removed: int
+        The number of files removed
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(suffix):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.debug("Removed {0} old files from the cache {1}".format(removed, cache_dir))
+    return removed